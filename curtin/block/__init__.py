@@ -1,5 +1,6 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from collections import OrderedDict
 from contextlib import contextmanager
 import errno
 import itertools
@@ -7,10 +8,16 @@ import os
 import stat
 import sys
 import tempfile
+import threading
+import time
 
+from curtin import streams
 from curtin import util
+from curtin.block import image
 from curtin.block import lvm
+from curtin.block import signatures
 from curtin.log import LOG
+from curtin.reporter import events
 from curtin.udev import udevadm_settle
 
 
@@ -210,6 +217,12 @@ def _lsblock(args=None):
     """
     get lsblock data as dict
     """
+    if not args and _inventory is not None:
+        return _inventory.devices()
+    return _probe_lsblock(args)
+
+
+def _probe_lsblock(args=None):
     # lsblk  --help | sed -n '/Available/,/^$/p' |
     #     sed -e 1d -e '$d' -e 's,^[ ]\+,,' -e 's, .*,,' | sort
     keys = ['ALIGNMENT', 'DISC-ALN', 'DISC-GRAN', 'DISC-MAX', 'DISC-ZERO',
@@ -231,21 +244,199 @@ def _lsblock(args=None):
     return _lsblock_pairs_to_dict(out)
 
 
+class BlockInventory(object):
+    """
+    Snapshot of the lsblk and blkid data of all block devices.
+
+    The data is gathered by one lsblk and one blkid run when first queried
+    and queries are answered from memory after that.  Operations changing
+    devices (partitioning, mkfs, wipes, assembling devices on top of
+    others) invalidate() the devices they changed, which are then probed
+    again, with their partitions and on their own, when next queried.
+    It may be used by several threads.
+    """
+
+    def __init__(self):
+        self._lsblk = None
+        self._blkid = None
+        self._stale = set()
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._lsblk is None:
+            self._lsblk = _probe_lsblock()
+            self._blkid = _probe_blkid()
+            self._stale.clear()
+        if not self._stale:
+            return
+        stale = sorted(p for p in self._stale if os.path.exists(p))
+        self._stale.clear()
+        if not stale:
+            return
+        found = _probe_lsblock(stale)
+        self._lsblk.update(found)
+        # the devices named as given and their partitions
+        knames = set(path_to_kname(p) for p in stale)
+        paths = stale + sorted(v['device_path'] for (k, v) in found.items()
+                               if k not in knames)
+        self._blkid.update(_probe_blkid(paths))
+
+    def invalidate(self, paths=None):
+        """Drop the data of the devices at paths, and of their partitions,
+        or of all devices if paths is None."""
+        with self._lock:
+            if paths is None or self._lsblk is None:
+                self._lsblk = self._blkid = None
+                return
+            for path in paths:
+                kname = path_to_kname(path)
+                for key in [k for k in self._lsblk
+                            if _kname_or_partition(k, kname)]:
+                    # probed again, should a partition have been renamed
+                    self._stale.add(self._lsblk.pop(key)['device_path'])
+                for key in [k for k in self._blkid
+                            if _kname_or_partition(path_to_kname(k), kname)]:
+                    del self._blkid[key]
+                    self._stale.add(key)
+                self._stale.add(path)
+
+    def devices(self):
+        """Return the lsblk data of all devices, like _lsblock()."""
+        with self._lock:
+            self._load()
+            return dict((k, v.copy()) for (k, v) in self._lsblk.items())
+
+    def device(self, path):
+        """Return the lsblk data of the device at path or None."""
+        with self._lock:
+            self._load()
+            entry = self._lsblk.get(path_to_kname(path))
+            return entry.copy() if entry else None
+
+    def tags(self, path):
+        """Return the blkid tags of the device at path, {} if it has none.
+        """
+        with self._lock:
+            self._load()
+            if path in self._blkid:
+                return self._blkid[path].copy()
+            kname = path_to_kname(path)
+            for (key, tags) in self._blkid.items():
+                if path_to_kname(key) == kname:
+                    return tags.copy()
+            return {}
+
+    def blkid(self, devs=None):
+        """Return the blkid data of devs, or of all devices, like blkid()."""
+        with self._lock:
+            self._load()
+            if not devs:
+                return dict((k, v.copy()) for (k, v) in self._blkid.items())
+            found = dict((dev, self.tags(dev)) for dev in devs)
+        return dict((k, v) for (k, v) in found.items() if v)
+
+    def volume_uuid(self, path):
+        """Return the uuid of the device at path, like get_volume_uuid()."""
+        # the first of the uuids reported, as 'blkid -o export' lists them
+        for (key, value) in self.tags(path).items():
+            if 'UUID' in key:
+                return value
+        return ''
+
+
+def _probe_blkid(devs=None):
+    """Return blkid() data of devs, empty if none have blkid tags."""
+    try:
+        return blkid(devs=devs, cache=False)
+    except util.ProcessExecutionError as e:
+        # blkid exits 2 when no device was identified
+        if e.exit_code != 2:
+            raise
+        return {}
+
+
+def _kname_or_partition(kname, disk_kname):
+    """
+    return True if kname is disk_kname or the kname of one of its partitions,
+    but not of another disk sharing its prefix (sdaa for sda, nvme0n10 for
+    nvme0n1).
+    """
+    if kname == disk_kname:
+        return True
+    # the kernel separates the partition number with a 'p' from disk names
+    # ending in a digit
+    prefix = disk_kname + ('p' if disk_kname[-1:].isdigit() else '')
+    return kname.startswith(prefix) and kname[len(prefix):].isdigit()
+
+
+# the BlockInventory answering queries within block_inventory()
+_inventory = None
+
+
+@contextmanager
+def block_inventory():
+    """
+    Answer lsblk and blkid queries (_lsblock(), blkid(),
+    get_blockdev_sector_size(), get_volume_uuid() and is_zfs_member())
+    from a BlockInventory within the context.
+    """
+    global _inventory
+    previous = _inventory
+    _inventory = BlockInventory()
+    try:
+        yield _inventory
+    finally:
+        _inventory = previous
+
+
+def invalidate_inventory(*paths):
+    """
+    Drop the block_inventory() data of the devices at paths, which were
+    changed, or of all devices if no paths are given.
+    """
+    if _inventory is not None:
+        _inventory.invalidate(list(paths) if paths else None)
+
+
+def _holder_tree(kname, base='/sys/class/block'):
+    """
+    return the knames of the partitions of device kname and of the devices
+    built on it (its holders), recursively, read from sysfs
+    """
+    found = []
+    sysfs = os.path.join(base, kname.replace('/', '!'))
+    try:
+        entries = os.listdir(sysfs)
+    except OSError:
+        return found
+    children = [e for e in sorted(entries)
+                if os.path.exists(os.path.join(sysfs, e, 'partition'))]
+    if 'holders' in entries:
+        children.extend(sorted(os.listdir(os.path.join(sysfs, 'holders'))))
+    for child in children:
+        child = child.replace('!', '/')
+        found.append(child)
+        found.extend(_holder_tree(child, base=base))
+    return found
+
+
 def get_unused_blockdev_info():
     """
     return a list of unused block devices.
     These are devices that do not have anything mounted on them.
     """
 
-    # get a list of top level block devices, then iterate over it to get
-    # devices dependent on those.  If the lsblk call for that specific
-    # call has nothing 'MOUNTED", then this is an unused block device
-    bdinfo = _lsblock(['--nodeps'])
+    # one lsblk call for all devices, the devices on top of each top level
+    # device are found in sysfs.  If nothing in that tree is mounted, then
+    # this is an unused block device
+    bdinfo = _lsblock()
     unused = {}
     for devname, data in bdinfo.items():
-        cur = _lsblock([data['device_path']])
-        mountpoints = [x for x in cur if cur[x].get('MOUNTPOINT')]
-        if len(mountpoints) == 0:
+        # like 'lsblk --nodeps', only top level devices
+        if data.get('TYPE') == 'part':
+            continue
+        tree = [devname] + _holder_tree(devname)
+        if not any(bdinfo.get(k, {}).get('MOUNTPOINT') for k in tree):
             unused[devname] = data
     return unused
 
@@ -422,6 +613,8 @@ def blkid(devs=None, cache=True):
     """
     get data about block devices from blkid and convert to dict
     """
+    if cache and _inventory is not None:
+        return _inventory.blkid(devs)
     if devs is None:
         devs = []
 
@@ -583,6 +776,10 @@ def get_blockdev_sector_size(devpath):
     Get the logical and physical sector size of device at devpath
     Returns a tuple of integer values (logical, physical).
     """
+    if _inventory is not None:
+        entry = _inventory.device(devpath)
+        if entry:
+            return (int(entry['LOG-SEC']), int(entry['PHY-SEC']))
     info = _lsblock([devpath])
     LOG.debug('get_blockdev_sector_size: info:\n%s' % util.json_dumps(info))
     # (LP: 1598310) The call to _lsblock() may return multiple results.
@@ -605,6 +802,8 @@ def get_volume_uuid(path):
     Get uuid of disk with given path. This address uniquely identifies
     the device and remains consistant across reboots
     """
+    if _inventory is not None:
+        return _inventory.volume_uuid(path)
     (out, _err) = util.subp(["blkid", "-o", "export", path], capture=True)
     for line in out.splitlines():
         if "UUID" in line:
@@ -848,12 +1047,16 @@ def exclusive_open(path, exclusive=True):
         raise
 
 
-def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
+def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True,
+              progress=None):
     """
     wipe the existing file at path.
     if reader is provided, it will be called as a 'reader(buflen)'
     to provide data for each write.  Otherwise, zeros are used.
-    writes will be done in size of buflen.
+    writes will be done in size of buflen, to block devices with
+    O_DIRECT unless that is disabled (see image.update_direct_io).
+    if progress is provided, it is called as 'progress(wiped, size)'
+    after each write.
     """
     if reader:
         readfunc = reader
@@ -868,31 +1071,96 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
               path, size, buflen)
 
     with exclusive_open(path, exclusive=exclusive) as fp:
-        while True:
-            pbuf = readfunc(buflen)
-            pos = fp.tell()
-            if len(pbuf) != buflen and len(pbuf) + pos < size:
-                raise ValueError(
-                    "short read on reader got %d expected %d after %d" %
-                    (len(pbuf), buflen, pos))
-
-            if pos + buflen >= size:
-                fp.write(pbuf[0:size-pos])
-                break
-            else:
-                fp.write(pbuf)
+        direct = None
+        if is_block_device(path):
+            # fp holds the exclusive open
+            direct = image.open_direct(path)
+        if direct is None:
+            _wipe_fp(fp, readfunc, buflen, size, progress=progress)
+            return
+        with direct:
+            _wipe_fp(fp, readfunc, buflen, size, direct=direct,
+                     progress=progress)
+
+
+def _wipe_fp(fp, readfunc, buflen, size, direct=None, progress=None):
+    pos = 0
+    while True:
+        pbuf = readfunc(buflen)
+        if len(pbuf) != buflen and len(pbuf) + pos < size:
+            raise ValueError(
+                "short read on reader got %d expected %d after %d" %
+                (len(pbuf), buflen, pos))
+
+        if pos + buflen >= size:
+            pbuf = pbuf[0:size-pos]
+        if direct:
+            direct.write(pos, pbuf)
+        else:
+            fp.write(pbuf)
+        pos += len(pbuf)
+        if progress:
+            progress(pos, size)
+        if pos >= size:
+            break
+
+
+# bytes zeroed or discarded by each ioctl of wipe_ioctl()
+WIPE_IOCTL_SIZE = 1024 * 1024 * 1024
+
+
+def _wipe_ranges(fp, size, func, progress=None):
+    """
+    apply zero_range or discard_range func to the first size bytes of fp in
+    WIPE_IOCTL_SIZE steps, returning False if the device does not support it
+    """
+    for pos in range(0, size, WIPE_IOCTL_SIZE):
+        length = min(WIPE_IOCTL_SIZE, size - pos)
+        if not image.try_range(func, fp.fileno(), pos, length):
+            return False
+        if progress:
+            progress(pos + length, size)
+    return True
+
+
+def wipe_ioctl(path, discard=False, exclusive=True, progress=None):
+    """
+    wipe the existing file at path by having the device zero it (BLKZEROOUT,
+    which the kernel offloads to the device where possible) or, if discard,
+    by discarding all of its blocks (BLKDISCARD).
+    discarded blocks may still read back as the old data, so the start and
+    end of the volume and its partitions are zeroed after a discard.
+    files and devices not supporting the ioctls are wiped by writing zeros.
+    progress is passed on to wipe_file.
+    """
+    size = util.file_size(path)
+    wiped = False
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        if is_block_device(path):
+            if discard:
+                LOG.debug("discarding %s bytes of %s", size, path)
+                wiped = _wipe_ranges(fp, size, image.discard_range,
+                                     progress=progress)
+                discard = wiped
+            if not wiped:
+                LOG.debug("zeroing %s bytes of %s", size, path)
+                wiped = _wipe_ranges(fp, size, image.zero_range,
+                                     progress=progress)
+    if not wiped:
+        LOG.debug("%s: zeroing by ioctl not possible, writing zeros", path)
+        wipe_file(path, exclusive=exclusive, progress=progress)
+    elif discard:
+        quick_zero(path, partitions=True, exclusive=exclusive)
 
 
 def quick_zero(path, partitions=True, exclusive=True):
     """
-    zero 1M at front, 1M at end, and 1M at front
+    zero 1M at front, 1M at end, and the metadata of any known formats
+    found elsewhere (see signatures.find_signatures).
     if this is a block device and partitions is true, then
-    zero 1M at front and end of each partition.
+    do the same for each partition.
     """
-    buflen = 1024
-    count = 1024
-    zero_size = buflen * count
-    offsets = [0, -zero_size]
+    zero_size = 1024 * 1024
     is_block = is_block_device(path)
     if not (is_block or os.path.isfile(path)):
         raise ValueError("%s: not an existing file or block device", path)
@@ -909,9 +1177,46 @@ def quick_zero(path, partitions=True, exclusive=True):
                   pt, kname, ptnum)
         quick_zero(pt, partitions=False)
 
-    LOG.debug("wiping 1M on %s at offsets %s", path, offsets)
-    return zero_file_at_offsets(path, offsets, buflen=buflen, count=count,
-                                exclusive=exclusive)
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        ranges = [(0, min(zero_size, size)),
+                  (max(size - zero_size, 0), min(zero_size, size))]
+        for (name, offset, length) in signatures.find_signatures(fp, size):
+            LOG.debug("wiping %s metadata on %s at offset %s",
+                      name, path, offset)
+            ranges.append((offset, length))
+        merged = _merge_ranges(ranges)
+        LOG.debug("wiping %s at byte ranges %s", path,
+                  ', '.join('%d-%d' % (start, end - 1)
+                            for (start, end) in merged if end > start))
+        _zero_ranges(fp, merged)
+
+
+def _merge_ranges(ranges):
+    """
+    return the sorted [start, end) ranges covering the (offset, length)
+    ranges, with overlapping and adjacent ranges merged.
+    """
+    merged = []
+    for (offset, length) in sorted(ranges):
+        if merged and offset <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], offset + length)
+        else:
+            merged.append([offset, offset + length])
+    return merged
+
+
+def _zero_ranges(fp, merged, buflen=1024 * 1024):
+    """
+    write zeros to the [start, end) ranges of fp (see _merge_ranges),
+    writing up to buflen bytes at a time.
+    """
+    buf = b'\0' * buflen
+    for (start, end) in merged:
+        fp.seek(start)
+        for pos in range(start, end, buflen):
+            fp.write(buf[:min(buflen, end - pos)])
 
 
 def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
@@ -926,7 +1231,6 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
         m_short += " Shortened to {wsize} bytes."
         m_badoff += " Skipping."
 
-    buf = b'\0' * buflen
     tot = buflen * count
     msg_vals = {'path': path, 'tot': buflen * count}
 
@@ -957,28 +1261,28 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
                     raise ValueError(m_short.format(**msg_vals))
                 else:
                     LOG.debug(m_short.format(**msg_vals))
-            fp.seek(pos)
-            for i in range(count):
-                pos = fp.tell()
-                if pos + buflen > size:
-                    fp.write(buf[0:size-pos])
-                else:
-                    fp.write(buf)
+            _zero_ranges(fp, [(pos, pos + min(tot, size - pos))])
 
 
-def wipe_volume(path, mode="superblock", exclusive=True):
+def wipe_volume(path, mode="superblock", exclusive=True, progress=None):
     """wipe a volume/block device
 
     :param path: a path to a block device
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
        zero: write zeros to the entire volume
-       random: write random data (/dev/urandom) to the entire volume
+       random: write random data (see streams.random_chunks) to the entire
+               volume
+       zeroout: have the device zero the entire volume (BLKZEROOUT)
+       discard: discard all blocks of the volume (BLKDISCARD) and zero
+                its superblocks and those of its partitions
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
                     volume and beginning and end of any partitions that are
                     known to be on this device.
     :param exclusive: boolean to control how path is opened
+    :param progress: called as progress(wiped, size) as the zero, random,
+                     zeroout and discard modes wipe the volume
     """
     if mode == "pvremove":
         # We need to use --force --force in case it's already in a volgroup and
@@ -991,16 +1295,169 @@ def wipe_volume(path, mode="superblock", exclusive=True):
                   rcs=[0, 5], capture=True)
         lvm.lvm_scan()
     elif mode == "zero":
-        wipe_file(path, exclusive=exclusive)
+        wipe_file(path, exclusive=exclusive, progress=progress)
     elif mode == "random":
-        with open("/dev/urandom", "rb") as reader:
-            wipe_file(path, reader=reader.read, exclusive=exclusive)
+        with streams.random_reader() as reader:
+            wipe_file(path, reader=reader.read, exclusive=exclusive,
+                      progress=progress)
+    elif mode == "zeroout":
+        wipe_ioctl(path, exclusive=exclusive, progress=progress)
+    elif mode == "discard":
+        wipe_ioctl(path, discard=True, exclusive=exclusive,
+                   progress=progress)
     elif mode == "superblock":
         quick_zero(path, partitions=False, exclusive=exclusive)
     elif mode == "superblock-recursive":
         quick_zero(path, partitions=True, exclusive=exclusive)
     else:
         raise ValueError("wipe mode %s not supported" % mode)
+    invalidate_inventory(path)
+
+
+# seconds between the progress events published by wipe_volumes()
+WIPE_PROGRESS_INTERVAL = 10
+
+
+def volume_disks(path):
+    """
+    return the set of knames of the disks that writing to path writes to:
+    the disk itself, the disk holding a partition or the disks underlying a
+    dm or md device. files are their own disk.
+    """
+    if not is_block_device(path):
+        return set([os.path.realpath(path)])
+    disks = set()
+    for kname in get_device_slave_knames(path):
+        (disk, _ptnum) = get_blockdev_for_partition(dev_path(kname),
+                                                    strict=False)
+        disks.add(path_to_kname(disk))
+    return disks
+
+
+def _wipe_rate(size, seconds):
+    """describe wiping size bytes in seconds"""
+    mbytes = size / 1000000.0
+    if not size:
+        return "%.3f seconds" % seconds
+    return "%.1f MB in %.3f seconds, %.1f MB/s" % (
+        mbytes, seconds, mbytes / max(seconds, 0.001))
+
+
+def run_disk_jobs(jobs, func, workers=None, per_disk=1):
+    """
+    call func(*job) for each of jobs, tuples starting with the path of a
+    volume, at the same time on up to workers (default all) threads, while
+    at most per_disk of them write to any one disk (see volume_disks).
+    if any of the calls fail no new ones are started and the first error
+    is raised once the running ones finish.
+    returns an OrderedDict of path -> return value of func
+    """
+    jobs = list(jobs)
+    if workers is None:
+        workers = len(jobs)
+    disks = [volume_disks(job[0]) for job in jobs]
+    results = OrderedDict((job[0], None) for job in jobs)
+    pending = list(range(len(jobs)))
+    busy = dict((disk, 0) for disk in itertools.chain(*disks))
+    errors = []
+    lock = threading.Condition()
+
+    def next_job():
+        with lock:
+            while pending and not errors:
+                for job in pending:
+                    if all(busy[disk] < per_disk for disk in disks[job]):
+                        pending.remove(job)
+                        for disk in disks[job]:
+                            busy[disk] += 1
+                        return job
+                lock.wait()
+            return None
+
+    def run():
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            (result, error) = (None, None)
+            try:
+                result = func(*jobs[job])
+            except Exception as e:
+                error = e
+            with lock:
+                results[jobs[job][0]] = result
+                for disk in disks[job]:
+                    busy[disk] -= 1
+                if error:
+                    errors.append(error)
+                lock.notify_all()
+
+    threads = [threading.Thread(target=run)
+               for _ in range(max(min(workers, len(jobs)), 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def wipe_volumes(jobs, exclusive=True, workers=None):
+    """
+    wipe the volumes of jobs, (path, mode) tuples, see wipe_volume.
+
+    volumes on different disks are wiped at the same time, up to workers
+    (default all) of them, while volumes sharing a disk (see volume_disks)
+    are wiped one after another.  an event reports the progress and
+    throughput of each wipe and a summary one the throughput of all of them.
+    if any of the wipes fail no new ones are started and the first error
+    is raised once the running ones finish.
+    returns an OrderedDict of path -> (bytes wiped, seconds taken)
+    """
+    jobs = list(jobs)
+
+    def wipe(path, mode):
+        start = time.time()
+        done = {'size': 0, 'reported': start}
+        try:
+            with events.ReportEventStack(
+                    name=path_to_kname(path), parent=summary,
+                    description="wiping %s with mode %s" % (path,
+                                                            mode)) as stack:
+
+                def progress(wiped, size):
+                    now = time.time()
+                    done['size'] = wiped
+                    if now - done['reported'] >= WIPE_PROGRESS_INTERVAL:
+                        done['reported'] = now
+                        events.report_progress_event(
+                            stack.fullname, "wiping %s: %d%%, %s" % (
+                                path, wiped * 100 // max(size, 1),
+                                _wipe_rate(wiped, now - start)))
+
+                wipe_volume(path, mode=mode, exclusive=exclusive,
+                            progress=progress)
+                result = (done['size'], time.time() - start)
+                stack.message = "wiped %s with mode %s: %s" % (
+                    path, mode, _wipe_rate(*result))
+        except Exception as e:
+            LOG.error("wiping %s with mode %s failed: %s", path, mode, e)
+            raise
+        LOG.info(stack.message)
+        return result
+
+    start = time.time()
+    with events.ReportEventStack(
+            name="wipe-volumes",
+            description="wiping %d volumes" % len(jobs)) as summary:
+        results = run_disk_jobs(jobs, wipe, workers=workers)
+        summary.message = "wiped %d volumes: %s" % (
+            len(jobs), _wipe_rate(sum(size for (size, _s) in results.values()),
+                                  time.time() - start))
+    LOG.info(summary.message)
+    return results
 
 
 def storage_config_required_packages(storage_config, mapping):
@@ -0,0 +1,709 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+# This module writes disk images to block devices and files, skipping the
+# all-zero regions of the image, or all but the ranges listed in a block map
+# (bmap) of the image, to one or several devices at once.
+
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import stat
+import struct
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue  # pylint: disable=import-error
+
+from curtin import config
+from curtin import util
+from curtin.log import LOG
+
+# from linux/fs.h: _IO(0x12, 119), _IO(0x12, 127) and _IO(0x12, 104)
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+BLKSSZGET = 0x1268
+
+# granularity of zero detection, a multiple of any logical sector size
+ZERO_BLOCK_SIZE = 64 * 1024
+# largest single write of coalesced data blocks
+MAX_WRITE_SIZE = 4 * 1024 * 1024
+
+# ioctl errors meaning the request is not supported by the device
+_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOTSUP)
+
+# chunks queued ahead of each MirrorWriter thread
+MIRROR_QUEUE_DEPTH = 16
+_CLOSE = object()
+_ABORT = object()
+
+# O_DIRECT writes of block devices, see update_direct_io
+DIRECT_IO_DEFAULTS = {
+    'enabled': True,
+    'queue_depth': 4,
+    'buffer_size': 4 * 1024 * 1024,
+}
+_direct_io = dict(DIRECT_IO_DEFAULTS)
+
+
+def update_direct_io(cfg):
+    """Configure O_DIRECT writes from the direct_io config:
+
+    direct_io:
+      enabled: true
+      queue_depth: 4
+      buffer_size: 4M
+
+    queue_depth writes of up to buffer_size bytes are kept in flight per
+    device."""
+    _direct_io.clear()
+    _direct_io.update(DIRECT_IO_DEFAULTS)
+    if not cfg:
+        return
+    if 'enabled' in cfg:
+        _direct_io['enabled'] = config.value_as_boolean(cfg['enabled'])
+    if cfg.get('queue_depth'):
+        _direct_io['queue_depth'] = int(cfg['queue_depth'])
+    if cfg.get('buffer_size'):
+        _direct_io['buffer_size'] = int(util.human2bytes(cfg['buffer_size']))
+    if _direct_io['queue_depth'] < 1 or _direct_io['buffer_size'] < 1:
+        raise ValueError("Invalid direct_io config: %s" % cfg)
+
+
+def zero_range(fd, offset, length):
+    """Zero length bytes of the block device fd at offset (BLKZEROOUT).
+
+    The kernel offloads this to the device (WRITE SAME, WRITE ZEROES or
+    unmap) when it can and writes zeros itself otherwise."""
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+
+
+def discard_range(fd, offset, length):
+    """Discard length bytes of the block device fd at offset (BLKDISCARD).
+
+    Discarded blocks only read back as zeros on devices reporting
+    discard_zeroes_data."""
+    fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', offset, length))
+
+
+def try_range(func, fd, offset, length):
+    """Call zero_range or discard_range func for the range, returning False
+    rather than raising if the device does not support it."""
+    try:
+        func(fd, offset, length)
+    except (IOError, OSError) as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        LOG.debug("%s of %d bytes at %d not supported: %s", func.__name__,
+                  length, offset, e)
+        return False
+    return True
+
+
+def discard_zeroes_data(fd):
+    """Return True if discarded blocks of block device fd read as zeros."""
+    st = os.fstat(fd)
+    syspath = os.path.realpath('/sys/dev/block/%d:%d' % (
+        os.major(st.st_rdev), os.minor(st.st_rdev)))
+    if os.path.exists(os.path.join(syspath, 'partition')):
+        syspath = os.path.dirname(syspath)
+    try:
+        value = util.load_file(
+            os.path.join(syspath, 'queue', 'discard_zeroes_data'))
+    except (IOError, OSError):
+        return False
+    return value.strip() == '1'
+
+
+def logical_block_size(fd):
+    """Return the logical sector size of the block device fd."""
+    try:
+        buf = fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0))
+    except (IOError, OSError):
+        return 512
+    return struct.unpack('i', buf)[0]
+
+
+def open_direct(path):
+    """Return a DirectWriter of path, or None if O_DIRECT writes are
+    disabled or not supported by python or the device."""
+    if not (_direct_io['enabled'] and hasattr(os, 'O_DIRECT') and
+            hasattr(os, 'pwrite')):
+        return None
+    try:
+        return DirectWriter(path, queue_depth=_direct_io['queue_depth'],
+                            buffer_size=_direct_io['buffer_size'])
+    except (IOError, OSError) as e:
+        if e.errno != errno.EINVAL:
+            raise
+        LOG.debug("%s does not support O_DIRECT: %s", path, e)
+        return None
+
+
+class DirectWriter(object):
+    """Write to a block device with O_DIRECT, bypassing the page cache.
+
+    Data passed to write() is copied into a page aligned buffer from a pool
+    of queue_depth buffers of buffer_size bytes and written by one of
+    queue_depth threads, so that many writes are in flight at once and
+    write() only blocks when all buffers are.  Writing does not fill the
+    page cache of the installer with data that is never read back.  Parts
+    of writes not aligned to the logical block size of the device are
+    written through the page cache after the writes in flight.  Errors of
+    the writes are raised by the next write() or close()."""
+
+    def __init__(self, path, queue_depth=4, buffer_size=4 * 1024 * 1024):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+        self.align = logical_block_size(self.fd)
+        self.buffer_size = max(
+            buffer_size - buffer_size % mmap.PAGESIZE, mmap.PAGESIZE)
+        self._buffered_fd = None
+        self._error = None
+        self._discard = False
+        self._buffers = queue.Queue()
+        self._work = queue.Queue()
+        for _i in range(queue_depth):
+            self._buffers.put(mmap.mmap(-1, self.buffer_size))
+        self._threads = []
+        for index in range(queue_depth):
+            thread = threading.Thread(target=self._run,
+                                      name="direct-writer-%d" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                self._work.task_done()
+                return
+            (buf, offset, length) = item
+            try:
+                if self._error is None and not self._discard:
+                    _pwrite_all(self.fd, memoryview(buf)[:length], offset)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._buffers.put(buf)
+                self._work.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, offset, data):
+        """Write data at offset of the device."""
+        self._check()
+        view = memoryview(data)
+        end = offset + len(view)
+        # the part aligned to the logical block size is written directly
+        first = -(-offset // self.align) * self.align
+        last = end - end % self.align
+        if first >= last:
+            self._write_buffered(view, offset)
+            return
+        if first > offset:
+            self._write_buffered(view[:first - offset], offset)
+        for pos in range(first, last, self.buffer_size):
+            length = min(self.buffer_size, last - pos)
+            buf = self._buffers.get()
+            buf[:length] = view[pos - offset:pos - offset + length]
+            self._work.put((buf, pos, length))
+        if last < end:
+            self._write_buffered(view[last - offset:], last)
+
+    def _write_buffered(self, view, offset):
+        # after the writes in flight, which may share its pages
+        self._work.join()
+        self._check()
+        if self._buffered_fd is None:
+            self._buffered_fd = os.open(self.path, os.O_WRONLY)
+        _pwrite_all(self._buffered_fd, view, offset)
+
+    def _stop(self):
+        for _thread in self._threads:
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        """Wait for the writes in flight, sync the device and close it."""
+        if self.fd is None:
+            return
+        try:
+            self._stop()
+            self._check()
+            if self._buffered_fd is not None:
+                os.fsync(self._buffered_fd)
+            # flush the volatile cache of the device
+            os.fsync(self.fd)
+        finally:
+            self._close_fds()
+
+    def abort(self):
+        """Stop writing and close the device without syncing it."""
+        if self.fd is None:
+            return
+        self._discard = True
+        self._stop()
+        self._close_fds()
+
+    def _close_fds(self):
+        for fd in (self.fd, self._buffered_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self._buffered_fd = None
+        # the buffers are unmapped once no longer referenced
+        self._buffers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if etype is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _pwrite_all(fd, view, offset):
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class ImageWriter(object):
+    """Write an image sequentially to a block device or file.
+
+    Blocks of ZERO_BLOCK_SIZE zeros are not written.  Runs of them are
+    seeked over in regular files (which are truncated first, leaving
+    holes) and cleared with BLKDISCARD, where the device guarantees
+    zeros after a discard, or BLKZEROOUT on block devices.  Data is
+    written in large coalesced writes, to block devices with a
+    DirectWriter unless O_DIRECT is disabled, and synced once by close."""
+
+    def __init__(self, path, block_size=ZERO_BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.offset = 0
+        self.written = 0
+        self.zeroed = 0
+        self.skipped = 0
+        self._zero = b'\0' * block_size
+        # written where zeroing by ioctl is not supported
+        self._zero_buf = None
+        self._carry = b''
+        self._data = []
+        self._data_len = 0
+        self._zero_len = 0
+        self._start = time.time()
+        self._direct = None
+        if os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode):
+            self.fd = os.open(path, os.O_WRONLY)
+            self.is_block = True
+            self._direct = open_direct(path)
+            self._zero_func = zero_range
+            if discard_zeroes_data(self.fd):
+                self._zero_func = discard_range
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            self.is_block = False
+            self._zero_func = None
+
+    def write(self, data):
+        """Write data at the current end of the image."""
+        if self._carry:
+            data = self._carry + data
+        bsize = self.block_size
+        end = len(data) - len(data) % bsize
+        for pos in range(0, end, bsize):
+            block = data[pos:pos + bsize]
+            if block == self._zero:
+                self._add_zeros(bsize)
+            else:
+                self._add_data(block)
+        self._carry = data[end:]
+
+    def skip(self, length):
+        """Advance length bytes without writing, leaving the contents of
+        the target (holes in regular files) in place."""
+        if self._carry:
+            self._add_data(self._carry)
+            self._carry = b''
+        if self._data_len:
+            self._flush_data()
+        if self._zero_len:
+            self._flush_zeros()
+        self.offset += length
+        self.skipped += length
+
+    def _add_data(self, block):
+        if self._zero_len:
+            self._flush_zeros()
+        self._data.append(block)
+        self._data_len += len(block)
+        if self._data_len >= MAX_WRITE_SIZE:
+            self._flush_data()
+
+    def _add_zeros(self, length):
+        if self._data_len:
+            self._flush_data()
+        self._zero_len += length
+
+    def _write(self, buf):
+        if self._direct:
+            self._direct.write(self.offset, buf)
+        else:
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(self.fd, view):]
+        self.offset += len(buf)
+        self.written += len(buf)
+
+    def _flush_data(self):
+        self._write(b''.join(self._data))
+        self._data = []
+        self._data_len = 0
+
+    def _flush_zeros(self):
+        length = self._zero_len
+        self._zero_len = 0
+        if self._zero_func:
+            try:
+                self._zero_func(self.fd, self.offset, length)
+            except (IOError, OSError) as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                LOG.debug("%s does not support zeroing by ioctl, writing "
+                          "zeros: %s", self.path, e)
+                self._zero_func = None
+        if self.is_block and not self._zero_func:
+            # a run of zeros may be gigabytes long, it is written in
+            # MAX_WRITE_SIZE pieces of one buffer
+            if self._zero_buf is None:
+                self._zero_buf = memoryview(b'\0' * MAX_WRITE_SIZE)
+            while length:
+                count = min(length, MAX_WRITE_SIZE)
+                self._write(self._zero_buf[:count])
+                length -= count
+            return
+        self.offset += length
+        self.zeroed += length
+
+    def close(self):
+        """Write any pending data, sync the image and close it."""
+        if self.fd is None:
+            return
+        try:
+            if self._carry:
+                self._add_data(self._carry)
+                self._carry = b''
+            if self._data_len:
+                self._flush_data()
+            if self._zero_len:
+                self._flush_zeros()
+            if self._direct:
+                self._direct.close()
+            if not self.is_block:
+                os.ftruncate(self.fd, self.offset)
+            os.fsync(self.fd)
+        finally:
+            if self._direct:
+                self._direct.abort()
+            os.close(self.fd)
+            self.fd = None
+        elapsed = max(time.time() - self._start, 0.001)
+        LOG.info("Wrote %s to %s in %.2fs (%s/s), %s of zeros and %s "
+                 "unmapped not written", util.bytes2human(self.written),
+                 self.path, elapsed,
+                 util.bytes2human(int(self.written / elapsed)),
+                 util.bytes2human(self.zeroed), util.bytes2human(self.skipped))
+
+    def abort(self):
+        """Close the image without writing pending data."""
+        if self.fd is not None:
+            if self._direct:
+                self._direct.abort()
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if etype is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Bmap(object):
+    """A block map of an image, as written by bmaptool create.
+
+    ranges lists (start, end, checksum) of each mapped byte range of the
+    image, checksum being the checksum_type hexdigest of its data."""
+
+    def __init__(self, image_size, block_size, checksum_type, ranges):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        self.ranges = ranges
+
+    @property
+    def mapped_size(self):
+        return sum(end - start for (start, end, _chksum) in self.ranges)
+
+
+def parse_bmap(content):
+    """Parse the bmap xml in content, returning a Bmap.
+
+    Versions 1.x (sha1 checksums) and 2.x (ChecksumType) are supported and
+    the checksum of the bmap itself is verified if present."""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as e:
+        raise ValueError("Invalid bmap: %s" % e)
+    major = int(root.get('version', '1.0').split('.')[0])
+    if root.tag != 'bmap' or major not in (1, 2):
+        raise ValueError("Unsupported bmap version %s" % root.get('version'))
+
+    def field(name, required=True):
+        elem = root.find(name)
+        if elem is None or not elem.text:
+            if required:
+                raise ValueError("Invalid bmap: %s missing" % name)
+            return None
+        return elem.text.strip()
+
+    if major == 1:
+        checksum_type, range_attr, file_field = 'sha1', 'sha1', 'BmapFileSHA1'
+    else:
+        checksum_type = field('ChecksumType')
+        range_attr, file_field = 'chksum', 'BmapFileChecksum'
+    if checksum_type not in hashlib.algorithms_available:
+        raise ValueError("Unsupported bmap checksum type %s" % checksum_type)
+
+    file_checksum = field(file_field, required=False)
+    if file_checksum:
+        # the checksum is of the bmap with its own value replaced by zeros
+        zeroed = content.replace(file_checksum, '0' * len(file_checksum), 1)
+        actual = hashlib.new(checksum_type, zeroed.encode('utf-8'))
+        if actual.hexdigest() != file_checksum:
+            raise ValueError("bmap checksum mismatch: expected %s, got %s" %
+                             (file_checksum, actual.hexdigest()))
+
+    image_size = int(field('ImageSize'))
+    block_size = int(field('BlockSize'))
+    ranges = []
+    for elem in root.findall('BlockMap/Range'):
+        match = re.match(r'^(\d+)(?:-(\d+))?$', (elem.text or '').strip())
+        if not match:
+            raise ValueError("Invalid bmap range: %s" % elem.text)
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        start = first * block_size
+        end = min((last + 1) * block_size, image_size)
+        if ranges and start < ranges[-1][1] or start >= end:
+            raise ValueError("Invalid bmap range: %s" % elem.text)
+        ranges.append((start, end, elem.get(range_attr)))
+    return Bmap(image_size, block_size, checksum_type, ranges)
+
+
+class BmapWriter(object):
+    """Write the mapped ranges of an image read sequentially.
+
+    Only the ranges listed in bmap are written by an ImageWriter, each is
+    verified against its checksum as it is written.  Unmapped data of the
+    image is read past."""
+
+    def __init__(self, path, bmap):
+        self.path = path
+        self.bmap = bmap
+        self.writer = ImageWriter(path)
+        self.pos = 0
+        self._ranges = iter(bmap.ranges)
+        self._range = None
+        self._digest = None
+        self._next_range()
+
+    def _next_range(self):
+        self._range = next(self._ranges, None)
+        if self._range and self._range[2]:
+            self._digest = hashlib.new(self.bmap.checksum_type)
+        else:
+            self._digest = None
+
+    def write(self, data):
+        """Write the mapped parts of data, the next bytes of the image."""
+        while data:
+            if self._range is None or self.pos < self._range[0]:
+                # unmapped: up to the next range or to the end of data
+                count = len(data)
+                if self._range:
+                    count = min(count, self._range[0] - self.pos)
+                self.writer.skip(count)
+            else:
+                (start, end, chksum) = self._range
+                count = min(len(data), end - self.pos)
+                part = data[:count]
+                self.writer.write(part)
+                if self._digest:
+                    self._digest.update(part)
+                if self.pos + count == end:
+                    self._verify()
+            self.pos += count
+            data = data[count:]
+
+    def _verify(self):
+        (start, end, chksum) = self._range
+        if self._digest and self._digest.hexdigest() != chksum:
+            raise ValueError(
+                "%s mismatch of image bytes %d-%d: expected %s, got %s" %
+                (self.bmap.checksum_type, start, end - 1, chksum,
+                 self._digest.hexdigest()))
+        self._next_range()
+
+    def close(self):
+        """Check the whole map was written, then close the writer."""
+        if self._range is not None:
+            self.writer.abort()
+            raise ValueError(
+                "image ended at byte %d, before mapped range %d-%d" %
+                (self.pos, self._range[0], self._range[1] - 1))
+        if self.pos < self.bmap.image_size:
+            self.writer.skip(self.bmap.image_size - self.pos)
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        self.writer.abort()
+
+    def __exit__(self, etype, value, trace):
+        if etype is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+
+class ImageWriteError(IOError):
+    """Writing an image failed on some of the targets of a MirrorWriter.
+
+    results maps the path of each target to None, if the image was written,
+    or to the exception writing it raised."""
+
+    def __init__(self, results):
+        self.results = results
+        failed = ["%s: %s" % (path, error)
+                  for (path, error) in sorted(results.items()) if error]
+        super(ImageWriteError, self).__init__(
+            "Failed to write image to %d of %d devices: %s" %
+            (len(failed), len(results), "; ".join(failed)))
+
+
+class MirrorWriter(object):
+    """Write the same image to several writers at once.
+
+    Each writer (ImageWriter or BmapWriter) runs on its own thread, fed
+    with the data passed to write() through a queue of at most depth
+    chunks, so the image is read and decompressed once and written to all
+    targets concurrently.  A writer that fails is dropped while the others
+    carry on; close() raises ImageWriteError if any failed."""
+
+    def __init__(self, writers, depth=MIRROR_QUEUE_DEPTH):
+        self.writers = writers
+        self.errors = [None] * len(writers)
+        self.results = None
+        self._queues = [queue.Queue(depth) for _writer in writers]
+        self._threads = []
+        for index in range(len(writers)):
+            thread = threading.Thread(target=self._run, args=(index,),
+                                      name="image-writer-%d" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, index):
+        writer = self.writers[index]
+        items = self._queues[index]
+        while True:
+            item = items.get()
+            if item is _ABORT:
+                writer.abort()
+                return
+            if self.errors[index] is not None:
+                # keep consuming, the other writers must not block
+                if item is _CLOSE:
+                    return
+                continue
+            try:
+                if item is _CLOSE:
+                    writer.close()
+                else:
+                    writer.write(item)
+            except Exception as e:
+                LOG.warn("Writing image to %s failed: %s", writer.path, e)
+                self.errors[index] = e
+                writer.abort()
+            if item is _CLOSE:
+                return
+
+    def write(self, data):
+        if all(self.errors):
+            raise ImageWriteError(self._results())
+        for items in self._queues:
+            items.put(data)
+
+    def _finish(self, item):
+        for items in self._queues:
+            items.put(item)
+        for thread in self._threads:
+            thread.join()
+        self.results = self._results()
+
+    def _results(self):
+        return dict((writer.path, error)
+                    for (writer, error) in zip(self.writers, self.errors))
+
+    def close(self):
+        """Complete the image on every writer, raising ImageWriteError if
+        any failed."""
+        if self.results is not None:
+            return
+        self._finish(_CLOSE)
+        for path in sorted(self.results):
+            if self.results[path] is None:
+                LOG.info("Image written to %s", path)
+        if any(self.errors):
+            raise ImageWriteError(self.results)
+
+    def abort(self):
+        """Stop all writers without completing the image."""
+        if self.results is None:
+            self._finish(_ABORT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if etype is None:
+            self.close()
+        else:
+            self.abort()
+
+# vi: ts=4 expandtab syntax=python
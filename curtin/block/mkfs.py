@@ -5,9 +5,12 @@
 
 from curtin import util
 from curtin import block
+from curtin.log import LOG
 
+import multiprocessing
 import string
 import os
+import time
 from uuid import uuid4
 
 mkfs_commands = {
@@ -202,6 +205,7 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False):
 
     cmd.append(path)
     util.subp(cmd, capture=True)
+    block.invalidate_inventory(path)
 
     # if fs_family does not support specifying uuid then use blkid to find it
     # if blkid is unable to then just return None for uuid
@@ -216,15 +220,51 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False):
     return uuid
 
 
-def mkfs_from_config(path, info, strict=False):
-    """Make filesystem on block device with given path according to storage
-       config given"""
+def mkfs_batch(jobs, workers=None, per_disk=1):
+    """Make the filesystems of jobs, (path, fstype, options) tuples where
+       options is a dict of keyword arguments for mkfs, at the same time.
+
+       Up to workers (default the number of cpus) mkfs commands run at once,
+       and at most per_disk of them on the partitions of any one disk.
+       Returns an OrderedDict of the uuid of the filesystem of each path.
+       If any of the mkfs fail no new ones are started and the first error
+       is raised once the running ones finish."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def run(path, fstype, options):
+        LOG.info("creating %s filesystem on %s", fstype, path)
+        start = time.time()
+        try:
+            uuid = mkfs(path, fstype, **options)
+        except Exception as e:
+            LOG.error("creating %s filesystem on %s failed: %s",
+                      fstype, path, e)
+            raise
+        LOG.info("created %s filesystem on %s in %.3f seconds",
+                 fstype, path, time.time() - start)
+        return uuid
+
+    return block.run_disk_jobs(jobs, run, workers=workers, per_disk=per_disk)
+
+
+def mkfs_job(path, info, strict=False):
+    """Return the mkfs_batch job making the filesystem of storage config
+       info on block device with given path"""
     fstype = info.get('fstype')
     if fstype is None:
         raise ValueError("fstype must be specified")
     # NOTE: Since old metadata on partitions that have not been wiped can cause
     #       some mkfs commands to refuse to work, it's best to use force=True
-    mkfs(path, fstype, strict=strict, force=True, uuid=info.get('uuid'),
-         label=info.get('label'))
+    return (path, fstype, {'strict': strict, 'force': True,
+                           'uuid': info.get('uuid'),
+                           'label': info.get('label')})
+
+
+def mkfs_from_config(path, info, strict=False):
+    """Make filesystem on block device with given path according to storage
+       config given"""
+    (path, fstype, options) = mkfs_job(path, info, strict=strict)
+    mkfs(path, fstype, **options)
 
 # vi: ts=4 expandtab syntax=python
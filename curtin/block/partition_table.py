@@ -0,0 +1,333 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+# This module builds msdos and gpt partition tables in memory and writes
+# them to a disk or image file with a few positional writes, without
+# spawning parted or sgdisk.
+
+import errno
+import fcntl
+import os
+import stat
+import struct
+import uuid
+import zlib
+
+from curtin import util
+from curtin.block import image
+from curtin.log import LOG
+
+# from linux/fs.h: _IO(0x12, 95)
+BLKRRPART = 0x125f
+
+# gpt partition type guids of curtin's partition flags, the types sgdisk
+# gives to the codes in block_meta.SGDISK_FLAGS
+GPT_TYPES = {
+    'boot': 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B',
+    'lvm': 'E6D6D379-F507-44C2-A23C-238F2A3DF928',
+    'raid': 'A19D880F-05FC-4D3B-A006-743F0F84911E',
+    'bios_grub': '21686148-6449-6E6F-744E-656564454649',
+    'prep': '9E1A2D38-C612-4316-AA26-8B49521E5A8B',
+    'swap': '0657FD6D-A4AB-43C4-84E5-0933C84B4F4F',
+    'home': '933AC7E1-2EB4-4F13-B844-0E14E2AEF915',
+    'linux': '0FC63DAF-8483-4772-8E79-3D69D8477DE4',
+}
+
+# msdos system ids of curtin's partition flags
+MSDOS_TYPES = {
+    'extended': 0x05,
+    'lvm': 0x8e,
+    'raid': 0xfd,
+    'prep': 0x41,
+    'swap': 0x82,
+    'linux': 0x83,
+}
+MSDOS_PROTECTIVE = 0xee
+# msdos tables address 32 bit sector numbers
+MSDOS_MAX_SECTORS = 1 << 32
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+GPT_ENTRIES = 128
+MBR_ENTRY = struct.Struct('<B3sB3sII')
+# size of the boot code at the start of the mbr, kept when writing tables
+MBR_BOOTCODE_SIZE = 440
+
+
+class Partition(object):
+    """A partition of sectors start to end (inclusive) of a table."""
+
+    def __init__(self, number, start, end, flag=None, bootable=False,
+                 guid=None, name=None):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.flag = flag
+        self.bootable = bootable
+        self.guid = guid or str(uuid.uuid4())
+        self.name = name or ''
+
+    @property
+    def size(self):
+        return self.end + 1 - self.start
+
+    def __repr__(self):
+        return 'Partition(%s, %s, %s, flag=%s)' % (
+            self.number, self.start, self.end, self.flag)
+
+
+class PartitionTable(object):
+    """An msdos or gpt partition table of a disk of sectors logical sectors
+    of sector_size bytes."""
+
+    def __init__(self, label, sectors, sector_size=512, bootcode=None,
+                 signature=None, guid=None):
+        if label == 'dos':
+            label = 'msdos'
+        if label not in ('msdos', 'gpt'):
+            raise ValueError('invalid partition table type: %s' % label)
+        self.label = label
+        self.sectors = sectors
+        self.sector_size = sector_size
+        self.bootcode = (bootcode or b'')[:MBR_BOOTCODE_SIZE].ljust(
+            MBR_BOOTCODE_SIZE, b'\0')
+        if len(signature or b'') != 4 or signature == b'\0\0\0\0':
+            signature = os.urandom(4)
+        self.signature = signature
+        self.guid = guid or str(uuid.uuid4())
+        self.partitions = []
+        # sectors used by the gpt partition entry array
+        self._entry_sectors = -(-GPT_ENTRIES * GPT_ENTRY.size // sector_size)
+        if self.first_usable > self.last_usable:
+            raise ValueError('disk of %d sectors is too small for a %s '
+                             'partition table' % (sectors, label))
+
+    @property
+    def first_usable(self):
+        if self.label == 'gpt':
+            return 2 + self._entry_sectors
+        return 1
+
+    @property
+    def last_usable(self):
+        if self.label == 'gpt':
+            return self.sectors - 2 - self._entry_sectors
+        return min(self.sectors, MSDOS_MAX_SECTORS) - 1
+
+    @property
+    def extended(self):
+        for part in self.partitions:
+            if self.label == 'msdos' and part.flag == 'extended':
+                return part
+        return None
+
+    def add(self, number, start, end, flag=None, **kwargs):
+        """Add partition number from sector start to end to the table."""
+        part = Partition(number, start, end, flag=flag, **kwargs)
+        if start > end:
+            raise ValueError('%s ends before it starts' % part)
+        if start < self.first_usable or end > self.last_usable:
+            raise ValueError('%s is outside of the usable sectors %d to %d' %
+                             (part, self.first_usable, self.last_usable))
+        if any(p.number == number for p in self.partitions):
+            raise ValueError('%s number is already used' % part)
+
+        if self.label == 'gpt':
+            if number < 1 or number > GPT_ENTRIES:
+                raise ValueError('%s number is not 1 to %d' %
+                                 (part, GPT_ENTRIES))
+            others = self.partitions
+        elif number > 4:
+            ext = self.extended
+            if ext is None:
+                raise ValueError('%s is logical, but there is no extended '
+                                 'partition' % part)
+            # logical partitions need a sector for their extended boot record
+            # before them, inside the extended partition
+            if start <= ext.start or end > ext.end:
+                raise ValueError('%s is not inside of %s' % (part, ext))
+            others = [p for p in self.partitions if p.number > 4]
+            if any(p.start < start <= p.end + 1 for p in others):
+                raise ValueError('%s has no room for its boot record' % part)
+        else:
+            if number < 1:
+                raise ValueError('%s number is not 1 to 4' % part)
+            if flag == 'extended' and self.extended:
+                raise ValueError('%s is a second extended partition' % part)
+            others = [p for p in self.partitions if p.number <= 4]
+
+        for other in others:
+            if start <= other.end and other.start <= end:
+                raise ValueError('%s overlaps %s' % (part, other))
+        self.partitions.append(part)
+        return part
+
+    def layout(self):
+        """Return a list of (offset, data) writes that store the table."""
+        if self.label == 'gpt':
+            return self._gpt_layout()
+        return self._msdos_layout()
+
+    def _sector(self, lba, data):
+        return (lba * self.sector_size,
+                data.ljust(self.sector_size, b'\0'))
+
+    def _boot_record(self, entries, bootcode=None, signature=None):
+        """Return an mbr or extended boot record of bootcode and up to 4
+        (bootable, system_id, start, size) entries, None for unused."""
+        bootcode = bootcode or b'\0' * MBR_BOOTCODE_SIZE
+        signature = signature or b'\0\0\0\0'
+        entries = list(entries) + [None] * (4 - len(entries))
+        return (bootcode + signature + b'\0\0' +
+                b''.join(_mbr_entry(*e) if e else b'\0' * MBR_ENTRY.size
+                         for e in entries) +
+                b'\x55\xaa')
+
+    def _mbr(self, entries):
+        return self._boot_record(entries, self.bootcode, self.signature)
+
+    def _msdos_layout(self):
+        entries = [None] * 4
+        for part in self.partitions:
+            if part.number <= 4:
+                entries[part.number - 1] = (
+                    part.bootable, _msdos_type(part.flag), part.start,
+                    part.size)
+        writes = [self._sector(0, self._mbr(entries))]
+        # a stale gpt would still be found by tools reading the disk
+        if not any(p.start <= 1 for p in self.partitions):
+            writes.append(self._sector(1, b''))
+        if not any(p.end >= self.sectors - 1 for p in self.partitions):
+            writes.append(self._sector(self.sectors - 1, b''))
+
+        # logical partitions are a chain of extended boot records, each
+        # describing one logical partition and the location of the next
+        ext = self.extended
+        if ext is None:
+            return writes
+        logicals = sorted((p for p in self.partitions if p.number > 4),
+                          key=lambda p: p.number)
+        if not logicals:
+            writes.append(self._sector(ext.start, self._boot_record([])))
+        ebrs = [ext.start] + [part.start - 1 for part in logicals[1:]]
+        for (i, part) in enumerate(logicals):
+            entries = [(part.bootable, _msdos_type(part.flag),
+                        part.start - ebrs[i], part.size)]
+            if i + 1 < len(logicals):
+                entries.append((False, MSDOS_TYPES['extended'],
+                                ebrs[i + 1] - ext.start,
+                                logicals[i + 1].end + 1 - ebrs[i + 1]))
+            writes.append(self._sector(ebrs[i], self._boot_record(entries)))
+        return writes
+
+    def _gpt_layout(self):
+        entries = [b'\0' * GPT_ENTRY.size] * GPT_ENTRIES
+        for part in self.partitions:
+            type_guid = GPT_TYPES.get(part.flag, GPT_TYPES['linux'])
+            entries[part.number - 1] = GPT_ENTRY.pack(
+                uuid.UUID(type_guid).bytes_le, uuid.UUID(part.guid).bytes_le,
+                part.start, part.end, 0,
+                part.name.encode('utf-16-le')[:72])
+        array = b''.join(entries)
+        array_crc = _crc32(array)
+        array = array.ljust(self._entry_sectors * self.sector_size, b'\0')
+        last = self.sectors - 1
+
+        def header(lba, alternate, entries_lba):
+            fields = [GPT_SIGNATURE, GPT_REVISION, GPT_HEADER.size, 0, 0,
+                      lba, alternate, self.first_usable, self.last_usable,
+                      uuid.UUID(self.guid).bytes_le, entries_lba,
+                      GPT_ENTRIES, GPT_ENTRY.size, array_crc]
+            fields[3] = _crc32(GPT_HEADER.pack(*fields))
+            return GPT_HEADER.pack(*fields).ljust(self.sector_size, b'\0')
+
+        # a protective mbr covering the whole disk
+        pmbr = self._mbr([(False, MSDOS_PROTECTIVE, 1,
+                           min(last, MSDOS_MAX_SECTORS - 1))])
+        backup_entries = last - self._entry_sectors
+        return [
+            (0, pmbr.ljust(self.sector_size, b'\0') + header(1, last, 2) +
+             array),
+            (backup_entries * self.sector_size,
+             array + header(last, 1, backup_entries)),
+        ]
+
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _msdos_type(flag):
+    return MSDOS_TYPES.get(flag, MSDOS_TYPES['linux'])
+
+
+def _chs(lba, heads=255, sectors=63):
+    """Return the packed cylinder/head/sector address of lba."""
+    cylinder = lba // (heads * sectors)
+    if cylinder > 1023:
+        return b'\xfe\xff\xff'
+    head = (lba // sectors) % heads
+    sector = lba % sectors + 1
+    return struct.pack('BBB', head, ((cylinder >> 2) & 0xc0) | sector,
+                       cylinder & 0xff)
+
+
+def _mbr_entry(bootable, system_id, start, size):
+    if start + size > MSDOS_MAX_SECTORS:
+        raise ValueError('sectors %d to %d can not be addressed by an msdos '
+                         'partition table' % (start, start + size - 1))
+    return MBR_ENTRY.pack(0x80 if bootable else 0, _chs(start), system_id,
+                          _chs(start + size - 1), start, size)
+
+
+def new_table(path, label):
+    """Return an empty PartitionTable of label for the disk or image file
+    at path, keeping the boot code and disk signature of its mbr."""
+    with open(path, 'rb') as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        sector_size = image.logical_block_size(fp.fileno())
+        fp.seek(0)
+        bootcode = fp.read(MBR_BOOTCODE_SIZE)
+        signature = fp.read(4)
+    return PartitionTable(label, size // sector_size,
+                          sector_size=sector_size, bootcode=bootcode,
+                          signature=signature)
+
+
+def reread_partitions(path):
+    """Have the kernel reread the partition table of block device path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+        return
+    except (IOError, OSError) as e:
+        # busy, a partition of the device is in use
+        LOG.debug('BLKRRPART on %s failed: %s', path, e)
+        if e.errno not in (errno.EBUSY, errno.EINVAL):
+            raise
+    finally:
+        os.close(fd)
+    # partprobe tells the kernel about each partition instead
+    util.subp(['partprobe', path])
+
+
+def write_table(path, table):
+    """Write PartitionTable table to the disk or image file at path."""
+    LOG.info('writing %s partition table with %d partitions to %s',
+             table.label, len(table.partitions), path)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        for (offset, data) in table.layout():
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+        os.fsync(fd)
+        is_block = stat.S_ISBLK(os.fstat(fd).st_mode)
+    finally:
+        os.close(fd)
+    if is_block:
+        reread_partitions(path)
+
+# vi: ts=4 expandtab syntax=python
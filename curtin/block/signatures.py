@@ -0,0 +1,106 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Locate the metadata of known storage formats on a volume.
+
+The superblock wipe modes zero the start and end of a volume, which misses
+metadata stored elsewhere, such as btrfs superblock mirrors and LUKS2
+secondary headers.  find_signatures reports where the metadata of each
+format found on a volume is, so that it can be zeroed as well.
+"""
+
+from collections import namedtuple
+import struct
+
+from curtin.log import LOG
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+MD_MAGICS = (struct.pack('<I', 0xa92b4efc), struct.pack('>I', 0xa92b4efc))
+BCACHE_MAGIC = struct.pack('>QQ', 0xc68573f64e1a45ca, 0x8265f57f48ba6d81)
+LUKS_MAGICS = (b'LUKS\xba\xbe', b'SKUL\xba\xbe')
+ZFS_MAGICS = (struct.pack('<Q', 0x00bab10c), struct.pack('>Q', 0x00bab10c))
+ZFS_LABEL_SIZE = 256 * KiB
+# zfs uberblocks are in the second half of each label, at least 1K apart
+ZFS_UBERBLOCKS = tuple(range(128 * KiB, ZFS_LABEL_SIZE, KiB))
+GPT_ENTRIES_SIZE = 16 * KiB
+
+# length bytes at each of offsets(size) are metadata of format name if one
+# of magics is found at any of magic_offsets within them.
+Signature = namedtuple('Signature', ('name', 'magics', 'magic_offsets',
+                                     'length', 'offsets'))
+
+
+def _md_090_offset(size):
+    return (size & ~(64 * KiB - 1)) - 64 * KiB
+
+
+def _zfs_labels(size):
+    end = size - size % ZFS_LABEL_SIZE
+    return [0, ZFS_LABEL_SIZE, end - 2 * ZFS_LABEL_SIZE, end - ZFS_LABEL_SIZE]
+
+
+SIGNATURES = (
+    # mbr, protective mbr of gpt and fat or ntfs boot sectors
+    Signature('dos', (b'\x55\xaa',), (510,), 512, lambda size: [0]),
+    # primary gpt header and entries, for 512 and 4096 byte sectors
+    Signature('gpt', (b'EFI PART',), (0,), 4 * KiB + GPT_ENTRIES_SIZE,
+              lambda size: [512, 4 * KiB]),
+    # backup gpt entries and header
+    Signature('gpt', (b'EFI PART',), (GPT_ENTRIES_SIZE,),
+              GPT_ENTRIES_SIZE + 512,
+              lambda size: [size - GPT_ENTRIES_SIZE - 512]),
+    Signature('gpt', (b'EFI PART',), (GPT_ENTRIES_SIZE,),
+              GPT_ENTRIES_SIZE + 4 * KiB,
+              lambda size: [size - GPT_ENTRIES_SIZE - 4 * KiB]),
+    Signature('md 0.90', MD_MAGICS, (0,), 4 * KiB,
+              lambda size: [_md_090_offset(size)]),
+    # md 1.0, 1.1 and 1.2 superblocks
+    Signature('md', MD_MAGICS[:1], (0,), 4 * KiB,
+              lambda size: [(size - 8 * KiB) & ~(4 * KiB - 1), 0, 4 * KiB]),
+    # lvm label, in any of the first four sectors, and metadata area header
+    Signature('lvm2', (b'LABELONE',), (0,), 512,
+              lambda size: [0, 512, 1024, 1536]),
+    Signature('lvm2', (b' LVM2 x[5A%r0N*>',), (4,), 512,
+              lambda size: [4 * KiB]),
+    Signature('bcache', (BCACHE_MAGIC,), (24,), 4 * KiB,
+              lambda size: [4 * KiB]),
+    # luks1 and luks2 headers, luks2 secondary headers from 16K to 4M
+    Signature('luks', LUKS_MAGICS, (0,), 4 * KiB,
+              lambda size: [0] + [16 * KiB << i for i in range(9)]),
+    Signature('zfs', ZFS_MAGICS, ZFS_UBERBLOCKS, ZFS_LABEL_SIZE, _zfs_labels),
+    # btrfs superblock and its mirrors
+    Signature('btrfs', (b'_BHRfS_M',), (64,), 4 * KiB,
+              lambda size: [64 * KiB, 64 * MiB, 256 * GiB]),
+    Signature('ext', (b'\x53\xef',), (56,), KiB, lambda size: [KiB]),
+    Signature('xfs', (b'XFSB',), (0,), 512, lambda size: [0]),
+    # swap header, ending in the magic, for 4K to 64K pages
+    Signature('swap', (b'SWAPSPACE2', b'SWAP-SPACE'),
+              (4086, 8182, 16374, 65526), 64 * KiB, lambda size: [0]),
+    Signature('iso9660', (b'CD001',), (1,), 2 * KiB,
+              lambda size: [32 * KiB]),
+)
+
+
+def find_signatures(fp, size):
+    """
+    return a sorted list of (name, offset, length) of the metadata of known
+    formats found in the first size bytes of the file object fp.
+    """
+    found = set()
+    for sig in SIGNATURES:
+        span = max(sig.magic_offsets) + max(len(m) for m in sig.magics)
+        for offset in sig.offsets(size):
+            if offset < 0 or offset + span > size:
+                continue
+            fp.seek(offset)
+            data = fp.read(span)
+            if any(data[mo:mo + len(magic)] == magic
+                   for mo in sig.magic_offsets for magic in sig.magics):
+                length = min(sig.length, size - offset)
+                LOG.debug('found %s metadata at offset %s', sig.name, offset)
+                found.add((sig.name, offset, length))
+    return sorted(found, key=lambda f: (f[1], f[2], f[0]))
+
+# vi: ts=4 expandtab syntax=python
@@ -1,8 +1,10 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from collections import OrderedDict, namedtuple
-from curtin import (block, config, util)
-from curtin.block import (bcache, mdadm, mkfs, clear_holders, lvm, iscsi, zfs)
+from contextlib import contextmanager
+from curtin import (block, config, image_cache, streams, url_helper, util)
+from curtin.block import (bcache, image, mdadm, mkfs, clear_holders, lvm,
+                          iscsi, partition_table, zfs)
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 
@@ -15,8 +17,15 @@ import platform
 import string
 import sys
 import tempfile
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue  # pylint: disable=import-error
+
 FstabData = namedtuple(
     "FstabData", ('spec', 'path', 'fstype', 'options', 'freq', 'passno',
                   'device'))
@@ -68,30 +77,173 @@ def logtime(msg, func, *args, **kwargs):
         return func(*args, **kwargs)
 
 
-def write_image_to_disk(source, dev):
+def open_image(source, cache=None):
+    """
+    Return a reader of the image of source.  The image is read from the
+    image cache if one is given, otherwise it is streamed from its url,
+    resuming the download after transient failures.  If the source
+    declares a sha256 or sha512, reading to the end of the image raises
+    streams.ChecksumError unless the data matched it.
+    """
+    checksum = streams.source_checksum(source)
+    reader = None
+    if cache:
+        # a failed download into the cache is resumed by the next install
+        path = cache.fetch(source['uri'], sha256=source.get('sha256'))
+        if path:
+            reader = open(path, "rb")
+            if checksum and checksum[0] == 'sha256':
+                # verified when the cache entry was filled
+                return reader
+    if reader is None:
+        reader = url_helper.ResumableReader(source['uri'])
+    if checksum:
+        reader = streams.ChecksumReader(reader, checksum, name=source['uri'])
+    return reader
+
+
+def load_bmap(url):
+    """
+    Load the block map (bmap) of an image from a url or local path.
+    """
+    path = url[7:] if url.startswith("file://") else url
+    if os.path.isfile(path):
+        content = util.load_file(path)
+    else:
+        content = url_helper.geturl(url, retries=url_helper.DOWNLOAD_RETRIES)
+    return image.parse_bmap(content)
+
+
+def _image_writer(devnode, bmap=None):
+    if bmap:
+        LOG.info("Writing %s of image mapped by bmap to %s",
+                 util.bytes2human(bmap.mapped_size), devnode)
+        return image.BmapWriter(devnode, bmap)
+    return image.ImageWriter(devnode)
+
+
+def write_chunks_to_disk(chunks, devnodes, bmap=None):
+    """
+    Write the image data in the iterable chunks to block device devnodes,
+    a single device or a list of them.  All-zero regions of the image are
+    not written and each device is synced once at the end.  If a bmap is
+    given, only its mapped ranges are written, each verified against its
+    checksum.  Several devices are written concurrently from the one
+    stream, image.ImageWriteError reporting the devices that failed.
+    Returns a dictionary of devnode to None for each device written.
+    """
+    if isinstance(devnodes, util.string_types):
+        devnodes = [devnodes]
+    writers = []
+    try:
+        for devnode in devnodes:
+            writers.append(_image_writer(devnode, bmap=bmap))
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+    if len(writers) == 1:
+        writer = writers[0]
+    else:
+        writer = image.MirrorWriter(writers)
+    with writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    if len(writers) == 1:
+        return {writer.path: None}
+    return writer.results
+
+
+def write_stream_to_disk(reader, devnodes, ctype, bmap=None):
+    """
+    Write the image read from reader to block device devnodes,
+    decompressing ctype compressed data in process using all available
+    cpus.  Returns the results of write_chunks_to_disk.
+    """
+    with streams.decompressed_reader(reader, ctype=ctype) as stream:
+        return write_chunks_to_disk(stream, devnodes, bmap=bmap)
+
+
+def pipe_stream_to_disk(reader, devnodes, extractor=None, bmap=None):
     """
-    Write disk image to block device
+    Write the image read from reader to block device devnodes, filtered
+    through the shell pipeline extractor if given.  Returns the results of
+    write_chunks_to_disk.
     """
-    LOG.info('writing image to disk %s, %s', source, dev)
+    chunks = streams.read_chunks(reader)
+    if extractor:
+        chunks = streams.command_chunks(['sh', '-c', extractor], chunks)
+    return write_chunks_to_disk(chunks, devnodes, bmap=bmap)
+
+
+def report_image_results(results, devnames):
+    """
+    Report a finish event for each device an image was written to, results
+    mapping the devnode of each to None or the error writing it raised.
+    """
+    for (devnode, devname) in sorted(devnames.items()):
+        if devnode not in results:
+            continue
+        error = results[devnode]
+        if error is None:
+            result = events.status.SUCCESS
+            description = "wrote image to %s" % devnode
+        else:
+            result = events.status.FAIL
+            description = "writing image to %s failed: %s" % (devnode, error)
+        events.report_finish_event("write-image/%s" % devname, description,
+                                   result=result, level="INFO")
+
+
+def write_image_to_disk(source, dev, cache=None):
+    """
+    Write disk image to block device dev, or to each of a list of devices,
+    reading it from the image cache if one is given.  The image is read and
+    decompressed once for all devices.  If the source has a 'bmap', only
+    the ranges mapped by it are written.  The result of writing each
+    device is reported as an event.  Returns the root device found on the
+    (first) device.
+    """
+    devs = [dev] if isinstance(dev, util.string_types) else dev
+    LOG.info('writing image to disk %s, %s', source, ', '.join(devs))
+    # decompressed in process rather than by a command in a pipeline
+    stream_types = {
+        'dd-zst': 'zst',
+        'dd-lz4': 'lz4',
+    }
     extractor = {
-        'dd-tgz': '|tar -xOzf -',
-        'dd-txz': '|tar -xOJf -',
-        'dd-tbz': '|tar -xOjf -',
-        'dd-tar': '|smtar -xOf -',
-        'dd-bz2': '|bzcat',
-        'dd-gz': '|zcat',
-        'dd-xz': '|xzcat',
-        'dd-raw': ''
+        'dd-tgz': 'tar -xOzf -',
+        'dd-txz': 'tar -xOJf -',
+        'dd-tbz': 'tar -xOjf -',
+        'dd-tar': 'smtar -xOf -',
+        'dd-bz2': 'bzcat',
+        'dd-gz': 'zcat',
+        'dd-xz': 'xzcat',
+        'dd-raw': None,
     }
-    (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=['sh', '-c',
-                    ('wget "$1" --progress=dot:mega -O - ' +
-                     extractor[source['type']] + '| dd bs=4M of="$2"'),
-                    '--', source['uri'], devnode])
-    util.subp(['partprobe', devnode])
+    entries = [block.get_dev_name_entry(d) for d in devs]
+    devnodes = [devnode for (_devname, devnode) in entries]
+    bmap = None
+    if source.get('bmap'):
+        bmap = load_bmap(source['bmap'])
+    devnames = dict((devnode, devname) for (devname, devnode) in entries)
+    try:
+        with open_image(source, cache=cache) as reader:
+            if source['type'] in stream_types:
+                results = write_stream_to_disk(
+                    reader, devnodes, stream_types[source['type']], bmap=bmap)
+            else:
+                results = pipe_stream_to_disk(
+                    reader, devnodes, extractor[source['type']], bmap=bmap)
+    except image.ImageWriteError as e:
+        report_image_results(e.results, devnames)
+        raise
+    report_image_results(results, devnames)
+    for devnode in devnodes:
+        util.subp(['partprobe', devnode])
     udevadm_settle()
     paths = ["curtin", "system-data/var/lib/snapd"]
-    return block.get_root_device([devname], paths=paths)
+    return block.get_root_device([entries[0][0]], paths=paths)
 
 
 def get_bootpt_cfg(cfg, enabled=False, fstype=None, root_fstype=None):
@@ -280,12 +432,107 @@ def get_poolname(info, storage_config):
     return poolname
 
 
+class VolumePaths(object):
+    """
+    Paths get_path_to_storage_volume() resolved storage config entries to,
+    and the device paths devsync() has synced since.
+
+    Lookups of an entry after the first are answered from memory, and a
+    device synced for one entry is not synced again for another.  Handlers
+    creating or changing the volume of an entry invalidate() it, which
+    also drops the entries resolved through it (the partitions of a disk,
+    the bcache device of a backing device) and marks the devices synced
+    for them unsynced, so that they are resolved and synced again when
+    next looked up.  The disk synced for a partition stays synced, as
+    changing a partition does not change the partition table.
+    It may be used by several threads.
+    """
+
+    def __init__(self):
+        self._paths = {}
+        self._parents = {}
+        self._devsync = {}
+        self._synced = set()
+        self._lock = threading.RLock()
+
+    def path(self, volume):
+        """Return the path of volume or None if it was not resolved."""
+        with self._lock:
+            return self._paths.get(volume)
+
+    def is_synced(self, devpath):
+        with self._lock:
+            return devpath in self._synced
+
+    def add(self, volume, path, devsync_path, parent=None):
+        """Record that volume, resolved through parent, is at path and that
+        devsync_path was synced for it."""
+        with self._lock:
+            self._paths[volume] = path
+            self._devsync[volume] = devsync_path
+            self._synced.add(devsync_path)
+            self._parents[volume] = parent
+
+    def synced(self, devpath):
+        """Record that devpath was synced."""
+        with self._lock:
+            self._synced.add(devpath)
+
+    def invalidate(self, volumes):
+        """Drop volumes and the volumes resolved through them."""
+        with self._lock:
+            volumes = list(volumes)
+            while volumes:
+                volume = volumes.pop()
+                path = self._paths.pop(volume, None)
+                devsync_path = self._devsync.pop(volume, None)
+                if devsync_path == path:
+                    self._synced.discard(devsync_path)
+                self._parents.pop(volume, None)
+                volumes.extend(k for (k, v) in self._parents.items()
+                               if v == volume)
+
+
+# the VolumePaths of get_path_to_storage_volume() within volume_paths()
+_volume_paths = None
+
+
+@contextmanager
+def volume_paths():
+    """
+    Answer repeated get_path_to_storage_volume() lookups from a VolumePaths
+    within the context.
+    """
+    global _volume_paths
+    previous = _volume_paths
+    _volume_paths = VolumePaths()
+    try:
+        yield _volume_paths
+    finally:
+        _volume_paths = previous
+
+
+def invalidate_volume_paths(*volumes):
+    """
+    Drop the volume_paths() data of the storage config entries volumes,
+    whose volumes were created or changed.
+    """
+    if _volume_paths is not None:
+        _volume_paths.invalidate(volumes)
+
+
 def get_path_to_storage_volume(volume, storage_config):
     # Get path to block device for volume. Volume param should refer to id of
     # volume in storage config
+    paths = _volume_paths
+    if paths is not None:
+        volume_path = paths.path(volume)
+        if volume_path:
+            return volume_path
 
     LOG.debug('get_path_to_storage_volume for volume {}'.format(volume))
     devsync_vol = None
+    parent = None
     vol = storage_config.get(volume)
     if not vol:
         raise ValueError("volume with id '%s' not found" % volume)
@@ -293,8 +540,8 @@ def get_path_to_storage_volume(volume, storage_config):
     # Find path to block device
     if vol.get('type') == "partition":
         partnumber = determine_partition_number(vol.get('id'), storage_config)
-        disk_block_path = get_path_to_storage_volume(vol.get('device'),
-                                                     storage_config)
+        parent = vol.get('device')
+        disk_block_path = get_path_to_storage_volume(parent, storage_config)
         disk_kname = block.path_to_kname(disk_block_path)
         partition_kname = block.partition_kname(disk_kname, partnumber)
         volume_path = block.kname_to_path(partition_kname)
@@ -351,8 +598,9 @@ def get_path_to_storage_volume(volume, storage_config):
         # block devs are in the slaves dir there. Then, those blockdevs can be
         # checked against the kname of the devs in the config for the desired
         # bcache device. This is not very elegant though
-        backing_device_path = get_path_to_storage_volume(
-            vol.get('backing_device'), storage_config)
+        parent = vol.get('backing_device')
+        backing_device_path = get_path_to_storage_volume(parent,
+                                                         storage_config)
         backing_device_kname = block.path_to_kname(backing_device_path)
         sys_path = list(filter(lambda x: backing_device_kname in x,
                                glob.glob("/sys/block/bcache*/slaves/*")))[0]
@@ -366,10 +614,13 @@ def get_path_to_storage_volume(volume, storage_config):
         raise NotImplementedError("cannot determine the path to storage \
             volume '%s' with type '%s'" % (volume, vol.get('type')))
 
-    # sync devices
+    # sync devices, once for all the volumes on them
     if not devsync_vol:
         devsync_vol = volume_path
-    devsync(devsync_vol)
+    if paths is None or not paths.is_synced(devsync_vol):
+        devsync(devsync_vol)
+    if paths is not None:
+        paths.add(volume, volume_path, devsync_vol, parent=parent)
 
     LOG.debug('return volume path {}'.format(volume_path))
     return volume_path
@@ -406,7 +657,9 @@ def disk_handler(info, storage_config):
                 # there.
                 block.wipe_volume(disk, mode='superblock')
             elif ptable in _dos_names:
-                util.subp(["parted", disk, "--script", "mklabel", "msdos"])
+                partition_table.write_table(
+                    disk, partition_table.new_table(disk, 'msdos'))
+                block.invalidate_inventory(disk)
             else:
                 raise ValueError('invalid partition table type: %s', ptable)
         holders = clear_holders.get_holders(disk)
@@ -414,6 +667,7 @@ def disk_handler(info, storage_config):
             LOG.info('Detected block holders on disk %s: %s', disk, holders)
             clear_holders.clear_holders(disk)
             clear_holders.assert_clear(disk)
+            block.invalidate_inventory()
 
     # Make the name if needed
     if info.get('name'):
@@ -445,77 +699,120 @@ def find_previous_partition(disk_id, part_id, storage_config):
     return last_partnum
 
 
+# 'sgdisk --list-types'
+SGDISK_FLAGS = {"boot": 'ef00',
+                "lvm": '8e00',
+                "raid": 'fd00',
+                "bios_grub": 'ef02',
+                "prep": '4100',
+                "swap": '8200',
+                "home": '8302',
+                "linux": '8300'}
+
+
 def partition_handler(info, storage_config):
     device = info.get('device')
     size = info.get('size')
     flag = info.get('flag')
-    disk_ptable = storage_config.get(device).get('ptable')
-    partition_type = None
     if not device:
         raise ValueError("device must be set for partition to be created")
     if not size:
         raise ValueError("size must be specified for partition to be created")
+    disk_ptable = storage_config.get(device).get('ptable')
 
-    disk = get_path_to_storage_volume(device, storage_config)
-    partnumber = determine_partition_number(info.get('id'), storage_config)
-    disk_kname = block.path_to_kname(disk)
-    disk_sysfs_path = block.sys_block_path(disk)
-    # consider the disks logical sector size when calculating sectors
-    try:
-        lbs_path = os.path.join(disk_sysfs_path, 'queue', 'logical_block_size')
-        with open(lbs_path, 'r') as f:
-            logical_block_size_bytes = int(f.readline())
-    except Exception:
-        logical_block_size_bytes = 512
-    LOG.debug(
-        "{} logical_block_size_bytes: {}".format(disk_kname,
-                                                 logical_block_size_bytes))
+    # all partitions of a disk are created together, by the handler of the
+    # first of them
+    disk_partitions = [k for (k, v) in storage_config.items()
+                       if v.get('type') == 'partition' and
+                       v.get('device') == device]
+    if disk_partitions[0] == info.get('id'):
+        create_partitions(device, storage_config)
 
-    if partnumber > 1:
-        if partnumber == 5 and disk_ptable == "msdos":
-            for key, item in storage_config.items():
-                if item.get('type') == "partition" and \
-                        item.get('device') == device and \
-                        item.get('flag') == "extended":
-                    extended_part_no = determine_partition_number(
-                        key, storage_config)
-                    break
-            pnum = extended_part_no
-        else:
-            pnum = find_previous_partition(device, info['id'], storage_config)
-
-        LOG.debug("previous partition number for '%s' found to be '%s'",
-                  info.get('id'), pnum)
-        partition_kname = block.partition_kname(disk_kname, pnum)
-        previous_partition = os.path.join(disk_sysfs_path, partition_kname)
-        LOG.debug("previous partition: {}".format(previous_partition))
-        # XXX: sys/block/X/{size,start} is *ALWAYS* in 512b value
-        previous_size = int(
-            util.load_file(os.path.join(previous_partition, "size")))
-        previous_size_sectors = int(previous_size * 512 /
-                                    logical_block_size_bytes)
-        previous_start = int(
-            util.load_file(os.path.join(previous_partition, "start")))
-        previous_start_sectors = int(previous_start * 512 /
-                                     logical_block_size_bytes)
-        LOG.debug("previous partition.size_sectors: {}".format(
-                  previous_size_sectors))
-        LOG.debug("previous partition.start_sectors: {}".format(
-                  previous_start_sectors))
+    # Handle preserve flag
+    if config.value_as_boolean(info.get('preserve')):
+        return
+
+    # Make the name if needed
+    if (storage_config.get(device).get('name') and
+            not (disk_ptable == "msdos" and flag == "extended")):
+        make_dname(info.get('id'), storage_config)
 
+
+def _sysfs_partition_sectors(disk_sysfs_path, disk_kname, partnumber,
+                             logical_block_size_bytes):
+    """Return (start, size) in logical sectors of an existing partition."""
+    partition_kname = block.partition_kname(disk_kname, partnumber)
+    partition = os.path.join(disk_sysfs_path, partition_kname)
+    LOG.debug("previous partition: {}".format(partition))
+    # XXX: sys/block/X/{size,start} is *ALWAYS* in 512b value
+    size = int(util.load_file(os.path.join(partition, "size")))
+    start = int(util.load_file(os.path.join(partition, "start")))
+    return (int(start * 512 / logical_block_size_bytes),
+            int(size * 512 / logical_block_size_bytes))
+
+
+def plan_partitions(device, storage_config, logical_block_size_bytes,
+                    disk_sysfs_path, disk_kname):
+    """
+    Return the layout of the partitions of disk device in storage_config, a
+    list of dicts with the partition 'id', 'number', 'flag', 'offset' and
+    'length' in sectors and whether to 'preserve' it.  Partitions are
+    placed after the previous ones in the plan, the positions of preserved
+    partitions are read from sysfs.
+    """
+    disk_info = storage_config.get(device)
+    disk_ptable = disk_info.get('ptable')
     # Align to 1M at the beginning of the disk and at logical partitions
     alignment_offset = int((1 << 20) / logical_block_size_bytes)
-    if partnumber == 1:
-        # start of disk
-        offset_sectors = alignment_offset
-    else:
-        # further partitions
-        if disk_ptable == "gpt" or flag != "logical":
-            # msdos primary and any gpt part start after former partition end
-            offset_sectors = previous_start_sectors + previous_size_sectors
+    # partition number -> (start, size) in sectors
+    placed = {}
+    plan = []
+    for (part_id, info) in storage_config.items():
+        if info.get('type') != 'partition' or info.get('device') != device:
+            continue
+        flag = info.get('flag')
+        partnumber = determine_partition_number(part_id, storage_config)
+        preserve = config.value_as_boolean(info.get('preserve'))
+        if (not preserve and
+                config.value_as_boolean(disk_info.get('preserve'))):
+            raise NotImplementedError("Partition '%s' is not marked to be \
+                preserved, but device '%s' is. At this time, preserving \
+                devices but not also the partitions on the devices is not \
+                supported, because of the possibility of damaging partitions \
+                intended to be preserved." % (part_id, device))
+
+        if partnumber > 1:
+            if partnumber == 5 and disk_ptable == "msdos":
+                for key, item in storage_config.items():
+                    if item.get('type') == "partition" and \
+                            item.get('device') == device and \
+                            item.get('flag') == "extended":
+                        extended_part_no = determine_partition_number(
+                            key, storage_config)
+                        break
+                pnum = extended_part_no
+            else:
+                pnum = find_previous_partition(device, part_id,
+                                               storage_config)
+            LOG.debug("previous partition number for '%s' found to be '%s'",
+                      part_id, pnum)
+            if pnum not in placed:
+                placed[pnum] = _sysfs_partition_sectors(
+                    disk_sysfs_path, disk_kname, pnum,
+                    logical_block_size_bytes)
+            (previous_start_sectors, previous_size_sectors) = placed[pnum]
+
+        if partnumber == 1:
+            # start of disk
+            offset_sectors = alignment_offset
         else:
-            # msdos extended/logical partitions
-            if flag == "logical":
+            # further partitions
+            if disk_ptable == "gpt" or flag != "logical":
+                # msdos primary and any gpt part start after former partition
+                # end
+                offset_sectors = previous_start_sectors + previous_size_sectors
+            else:
+                # msdos extended/logical partitions
                 if partnumber == 5:
                     # First logical partition
                     # start at extended partition start + alignment_offset
@@ -523,116 +820,167 @@ def partition_handler(info, storage_config):
                                       alignment_offset)
                 else:
                     # Further logical partitions
-                    # start at former logical partition end + alignment_offset
+                    # start at former logical partition end +
+                    # alignment_offset
                     offset_sectors = (previous_start_sectors +
                                       previous_size_sectors +
                                       alignment_offset)
 
-    length_bytes = util.human2bytes(size)
-    # start sector is part of the sectors that define the partitions size
-    # so length has to be "size in sectors - 1"
-    length_sectors = int(length_bytes / logical_block_size_bytes) - 1
-    # logical partitions can't share their start sector with the extended
-    # partition and logical partitions can't go head-to-head, so we have to
-    # realign and for that increase size as required
-    if info.get('flag') == "extended":
-        logdisks = getnumberoflogicaldisks(device, storage_config)
-        length_sectors = length_sectors + (logdisks * alignment_offset)
-
-    # Handle preserve flag
-    if config.value_as_boolean(info.get('preserve')):
-        return
-    elif config.value_as_boolean(storage_config.get(device).get('preserve')):
-        raise NotImplementedError("Partition '%s' is not marked to be \
-            preserved, but device '%s' is. At this time, preserving devices \
-            but not also the partitions on the devices is not supported, \
-            because of the possibility of damaging partitions intended to be \
-            preserved." % (info.get('id'), device))
-
-    # Set flag
-    # 'sgdisk --list-types'
-    sgdisk_flags = {"boot": 'ef00',
-                    "lvm": '8e00',
-                    "raid": 'fd00',
-                    "bios_grub": 'ef02',
-                    "prep": '4100',
-                    "swap": '8200',
-                    "home": '8302',
-                    "linux": '8300'}
-
-    LOG.info("adding partition '%s' to disk '%s' (ptable: '%s')",
-             info.get('id'), device, disk_ptable)
-    LOG.debug("partnum: %s offset_sectors: %s length_sectors: %s",
-              partnumber, offset_sectors, length_sectors)
-
-    # Wipe the partition if told to do so, do not wipe dos extended partitions
-    # as this may damage the extended partition table
-    if config.value_as_boolean(info.get('wipe')):
-        LOG.info("Preparing partition location on disk %s", disk)
-        if info.get('flag') == "extended":
-            LOG.warn("extended partitions do not need wiping, so skipping: "
-                     "'%s'" % info.get('id'))
+        length_bytes = util.human2bytes(info.get('size'))
+        # start sector is part of the sectors that define the partitions
+        # size so length has to be "size in sectors - 1"
+        length_sectors = int(length_bytes / logical_block_size_bytes) - 1
+        # logical partitions can't share their start sector with the extended
+        # partition and logical partitions can't go head-to-head, so we have
+        # to realign and for that increase size as required
+        if flag == "extended":
+            logdisks = getnumberoflogicaldisks(device, storage_config)
+            length_sectors = length_sectors + (logdisks * alignment_offset)
+
+        if preserve:
+            placed[partnumber] = _sysfs_partition_sectors(
+                disk_sysfs_path, disk_kname, partnumber,
+                logical_block_size_bytes)
         else:
-            # wipe the start of the new partition first by zeroing 1M at the
-            # length of the previous partition
-            wipe_offset = int(offset_sectors * logical_block_size_bytes)
-            LOG.debug('Wiping 1M on %s at offset %s', disk, wipe_offset)
-            # We don't require exclusive access as we're wiping data at an
-            # offset and the current holder maybe part of the current storage
-            # configuration.
-            block.zero_file_at_offsets(disk, [wipe_offset], exclusive=False)
-
-    if disk_ptable == "msdos":
-        if flag in ["extended", "logical", "primary"]:
-            partition_type = flag
+            placed[partnumber] = (offset_sectors, length_sectors + 1)
+        plan.append({'id': part_id, 'number': partnumber, 'flag': flag,
+                     'offset': offset_sectors, 'length': length_sectors,
+                     'preserve': preserve, 'wipe': info.get('wipe')})
+    return plan
+
+
+def create_partitions(device, storage_config):
+    """
+    Create the partitions of disk device in storage_config with a single
+    parted or sgdisk run, which writes the partition table once.
+    """
+    disk_ptable = storage_config.get(device).get('ptable')
+    if disk_ptable not in ("msdos", "gpt"):
+        raise ValueError("parent partition has invalid partition table")
+
+    disk = get_path_to_storage_volume(device, storage_config)
+    disk_kname = block.path_to_kname(disk)
+    disk_sysfs_path = block.sys_block_path(disk)
+    # consider the disks logical sector size when calculating sectors
+    try:
+        lbs_path = os.path.join(disk_sysfs_path, 'queue', 'logical_block_size')
+        with open(lbs_path, 'r') as f:
+            logical_block_size_bytes = int(f.readline())
+    except Exception:
+        logical_block_size_bytes = 512
+    LOG.debug(
+        "{} logical_block_size_bytes: {}".format(disk_kname,
+                                                 logical_block_size_bytes))
+
+    plan = plan_partitions(device, storage_config, logical_block_size_bytes,
+                           disk_sysfs_path, disk_kname)
+    # without partitions to keep the whole table is written by curtin,
+    # otherwise parted or sgdisk add the new partitions to the existing one
+    table = None
+    if not any(part['preserve'] for part in plan):
+        table = partition_table.new_table(disk, disk_ptable)
+    cmd = []
+    for part in plan:
+        if part['preserve']:
+            continue
+        (partnumber, flag) = (part['number'], part['flag'])
+        (offset_sectors, length_sectors) = (part['offset'], part['length'])
+        LOG.info("adding partition '%s' to disk '%s' (ptable: '%s')",
+                 part['id'], device, disk_ptable)
+        LOG.debug("partnum: %s offset_sectors: %s length_sectors: %s",
+                  partnumber, offset_sectors, length_sectors)
+
+        # Wipe the partition if told to do so, do not wipe dos extended
+        # partitions as this may damage the extended partition table
+        if config.value_as_boolean(part['wipe']):
+            LOG.info("Preparing partition location on disk %s", disk)
+            if flag == "extended":
+                LOG.warn("extended partitions do not need wiping, so "
+                         "skipping: '%s'" % part['id'])
+            else:
+                # wipe the start of the new partition first by zeroing 1M at
+                # the length of the previous partition
+                wipe_offset = int(offset_sectors * logical_block_size_bytes)
+                LOG.debug('Wiping 1M on %s at offset %s', disk, wipe_offset)
+                # We don't require exclusive access as we're wiping data at
+                # an offset and the current holder maybe part of the current
+                # storage configuration.
+                block.zero_file_at_offsets(disk, [wipe_offset],
+                                           exclusive=False)
+
+        if table:
+            table.add(partnumber, offset_sectors,
+                      offset_sectors + length_sectors, flag=flag)
+        elif disk_ptable == "msdos":
+            if flag in ["extended", "logical", "primary"]:
+                partition_type = flag
+            else:
+                partition_type = "primary"
+            cmd.extend(["mkpart", partition_type, "%ss" % offset_sectors,
+                        "%ss" % str(offset_sectors + length_sectors)])
         else:
-            partition_type = "primary"
-        cmd = ["parted", disk, "--script", "mkpart", partition_type,
-               "%ss" % offset_sectors, "%ss" % str(offset_sectors +
-                                                   length_sectors)]
-        util.subp(cmd, capture=True)
-    elif disk_ptable == "gpt":
-        if flag and flag in sgdisk_flags:
-            typecode = sgdisk_flags[flag]
+            typecode = SGDISK_FLAGS.get(flag, SGDISK_FLAGS['linux'])
+            cmd.extend(["--new", "%s:%s:%s" % (partnumber, offset_sectors,
+                                               length_sectors +
+                                               offset_sectors),
+                        "--typecode=%s:%s" % (partnumber, typecode)])
+
+    if table:
+        partition_table.write_table(disk, table)
+    elif cmd:
+        if disk_ptable == "msdos":
+            cmd = ["parted", disk, "--script"] + cmd
         else:
-            typecode = sgdisk_flags['linux']
-        cmd = ["sgdisk", "--new", "%s:%s:%s" % (partnumber, offset_sectors,
-               length_sectors + offset_sectors),
-               "--typecode=%s:%s" % (partnumber, typecode), disk]
+            cmd = ["sgdisk"] + cmd + [disk]
         util.subp(cmd, capture=True)
     else:
-        raise ValueError("parent partition has invalid partition table")
-
-    # Make the name if needed
-    if storage_config.get(device).get('name') and partition_type != 'extended':
-        make_dname(info.get('id'), storage_config)
+        return
+    block.invalidate_inventory(disk)
+    # sync the disk once for all the new partitions, so that looking them
+    # up in their handlers does not sync it again for each of them
+    invalidate_volume_paths(device)
+    devsync(disk)
+    if _volume_paths is not None:
+        _volume_paths.synced(disk)
 
 
 def format_handler(info, storage_config):
-    volume = info.get('volume')
-    if not volume:
-        raise ValueError("volume must be specified for partition '%s'" %
-                         info.get('id'))
+    format_batch_handler([info], storage_config)
+
+
+def format_batch_handler(infos, storage_config):
+    """Make the filesystems of format entries infos at the same time, one
+       at a time on the partitions of any one disk."""
+    jobs = []
+    bcache_paths = []
+    for info in infos:
+        volume = info.get('volume')
+        if not volume:
+            raise ValueError("volume must be specified for partition '%s'" %
+                             info.get('id'))
+
+        # Get path to volume
+        volume_path = get_path_to_storage_volume(volume, storage_config)
+
+        # Handle preserve flag
+        if config.value_as_boolean(info.get('preserve')):
+            # Volume marked to be preserved, not formatting
+            continue
 
-    # Get path to volume
-    volume_path = get_path_to_storage_volume(volume, storage_config)
+        LOG.debug("mkfs {} info: {}".format(volume_path, info))
+        jobs.append(mkfs.mkfs_job(volume_path, info))
+        if storage_config.get(volume).get('type') == 'bcache':
+            bcache_paths.append(volume_path)
 
-    # Handle preserve flag
-    if config.value_as_boolean(info.get('preserve')):
-        # Volume marked to be preserved, not formatting
-        return
+    # Make filesystems using block library
+    if jobs:
+        mkfs.mkfs_batch(jobs)
 
-    # Make filesystem using block library
-    LOG.debug("mkfs {} info: {}".format(volume_path, info))
-    mkfs.mkfs_from_config(volume_path, info)
-
-    device_type = storage_config.get(volume).get('type')
-    LOG.debug('Formated device type: %s', device_type)
-    if device_type == 'bcache':
+    if bcache_paths:
         # other devs have a udev watch on them. Not bcache (LP: #1680597).
         LOG.debug('Detected bcache device format, calling udevadm trigger to '
-                  'generate by-uuid symlinks on "%s"', volume_path)
-        udevadm_trigger([volume_path])
+                  'generate by-uuid symlinks on "%s"', bcache_paths)
+        udevadm_trigger(bcache_paths)
 
 
 def mount_data(info, storage_config):
@@ -823,6 +1171,7 @@ def lvm_volgroup_handler(info, storage_config):
         # Use zero to clear target devices of any metadata
         util.subp(['vgcreate', '--force', '--zero=y', '--yes',
                    name] + device_paths, capture=True)
+        block.invalidate_inventory(*device_paths)
 
     # refresh lvmetad
     lvm.lvm_scan()
@@ -866,6 +1215,7 @@ def lvm_partition_handler(info, storage_config):
             cmd.extend(["--extents", "100%FREE"])
 
         util.subp(cmd)
+        block.invalidate_inventory(os.path.join("/dev", volgroup, name))
 
     # refresh lvmetad
     lvm.lvm_scan()
@@ -909,6 +1259,8 @@ def dm_crypt_handler(info, storage_config):
            "--key-file", tmp_keyfile]
 
     util.subp(cmd)
+    block.invalidate_inventory(volume_path,
+                               os.path.join("/dev", "mapper", dm_name))
 
     os.remove(tmp_keyfile)
 
@@ -963,6 +1315,7 @@ def raid_handler(info, storage_config):
                      "{}".format(md_devname))
 
             mdadm.mdadm_assemble(md_devname, device_paths, spare_device_paths)
+            block.invalidate_inventory(md_devname)
 
             # try again after attempting to assemble
             if not mdadm.md_check(md_devname, raidlevel,
@@ -975,6 +1328,8 @@ def raid_handler(info, storage_config):
     mdadm.mdadm_create(md_devname, raidlevel,
                        device_paths, spare_device_paths,
                        info.get('mdname', ''))
+    block.invalidate_inventory(md_devname, *(device_paths +
+                                             spare_device_paths))
 
     # Make dname rule for this dev
     make_dname(info.get('id'), storage_config)
@@ -1187,6 +1542,7 @@ def bcache_handler(info, storage_config):
             # make the cache device, extracting cacheset uuid
             (out, err) = util.subp(["make-bcache", "-C", cache_device],
                                    capture=True)
+            block.invalidate_inventory(cache_device)
             LOG.debug('out=[{}]'.format(out))
             [cset_uuid] = [line.split()[-1] for line in out.split("\n")
                            if line.startswith('Set UUID:')]
@@ -1218,6 +1574,7 @@ def bcache_handler(info, storage_config):
             raise ValueError(err)
         [bcache_dev] = holders
         LOG.debug('The just created bcache device is {}'.format(holders))
+        block.invalidate_inventory(backing_device, block.dev_path(bcache_dev))
 
         if cache_device:
             # if we specify both then we need to attach backing to cache
@@ -1293,6 +1650,7 @@ def zpool_handler(info, storage_config):
     LOG.info('Creating zpool %s with vdevs %s', poolname, vdevs_byid)
     zfs.zpool_create(poolname, vdevs_byid,
                      mountpoint=mountpoint, altroot=altroot)
+    block.invalidate_inventory(*vdevs)
 
 
 def zfs_handler(info, storage_config):
@@ -1428,6 +1786,122 @@ def zfsroot_update_storage_config(storage_config):
     return ret
 
 
+# storage config keys referring to other entries by id
+STORAGE_REFERENCES = ('device', 'volume', 'devices', 'spare_devices',
+                      'backing_device', 'cache_device', 'volgroup', 'pool',
+                      'vdevs')
+# entries appending to the same file of the target (or sharing a cache
+# device, for bcache) are handled in config order
+STORAGE_ORDERED_TYPES = {'mount': 'fstab', 'zfs': 'fstab',
+                         'dm_crypt': 'crypttab', 'raid': 'mdadm.conf',
+                         'bcache': 'bcache'}
+# storage entries handled at the same time unless 'storage: workers' is set.
+# handlers still share udev, lvm and dname state, so this is opt-in.
+STORAGE_WORKERS = 1
+
+
+def storage_dependencies(storage_config):
+    """
+    Return a dict of the ids of the entries each storage config entry must
+    be handled after: the entries it refers to, the previous partition on
+    the same device, logical volume in the same volume group or dataset in
+    the same pool, and the previous entry appending to the same file.
+    """
+    deps = OrderedDict((item_id, set()) for item_id in storage_config)
+    previous = {}
+    for (item_id, info) in storage_config.items():
+        for key in STORAGE_REFERENCES:
+            refs = info.get(key)
+            if not isinstance(refs, (list, tuple)):
+                refs = [refs]
+            deps[item_id].update(ref for ref in refs
+                                 if ref in storage_config and ref != item_id)
+        item_type = info.get('type')
+        chains = []
+        if item_type == 'partition':
+            chains.append(('partition', info.get('device')))
+        elif item_type == 'lvm_partition':
+            chains.append(('lvm_partition', info.get('volgroup')))
+        if item_type in STORAGE_ORDERED_TYPES:
+            chains.append((STORAGE_ORDERED_TYPES[item_type], None))
+        for chain in chains:
+            if chain in previous:
+                deps[item_id].add(previous[chain])
+            previous[chain] = item_id
+    return deps
+
+
+def run_storage_handlers(storage_config, handle, workers=1, batches=None):
+    """
+    Call handle(item_id) for each entry of storage_config, after those it
+    depends on, with up to workers entries handled at the same time.  Of
+    the entries that could be handled next the first in config order is.
+    batches maps entry types to a function called instead with the list of
+    ids of all the entries of that type that could be handled next.
+    The first exception raised by handle is raised once the entries being
+    handled finish, and no new entries are started after it.
+    """
+    pending = storage_dependencies(storage_config)
+    batches = batches or {}
+    results = queue.Queue()
+    running = 0
+    error = None
+
+    def run(item_ids):
+        item_type = storage_config[item_ids[0]].get('type')
+        try:
+            if item_type in batches:
+                batches[item_type](item_ids)
+            else:
+                handle(item_ids[0])
+        except Exception as e:
+            results.put((item_ids, e))
+        else:
+            results.put((item_ids, None))
+
+    def next_jobs(ready):
+        for item_id in ready:
+            item_type = storage_config[item_id].get('type')
+            if item_id not in pending:
+                # handled in the batch of an earlier entry
+                continue
+            elif item_type in batches:
+                yield [k for k in ready
+                       if storage_config[k].get('type') == item_type]
+            else:
+                yield [item_id]
+
+    while pending or running:
+        if error is None:
+            ready = [k for (k, deps) in pending.items() if not deps]
+            for item_ids in next_jobs(ready):
+                if running >= workers:
+                    break
+                for item_id in item_ids:
+                    del pending[item_id]
+                running += 1
+                if workers > 1:
+                    thread = threading.Thread(target=run, args=(item_ids,))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    run(item_ids)
+        if not running:
+            if error is None:
+                raise ValueError("storage config entries %s depend on each "
+                                 "other" % ', '.join(pending))
+            break
+        (item_ids, e) = results.get()
+        running -= 1
+        if e is not None:
+            error = error or e
+        for deps in pending.values():
+            deps.difference_update(item_ids)
+
+    if error is not None:
+        raise error
+
+
 def meta_custom(args):
     """Does custom partitioning based on the layout provided in the config
     file. Section with the name storage contains information on which
@@ -1474,26 +1948,135 @@ def meta_custom(args):
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(disk_paths)
 
-    for item_id, command in storage_config_dict.items():
-        handler = command_handlers.get(command['type'])
-        if not handler:
+    for command in storage_config_dict.values():
+        if command['type'] not in command_handlers:
             raise ValueError("unknown command type '%s'" % command['type'])
+
+    # entries not depending on each other, like the partitions and file
+    # systems of different disks, are handled at the same time
+    workers = int(cfg.get('storage', {}).get('workers', STORAGE_WORKERS))
+    # the events of entries handled at the same time would interleave under
+    # one name, so each entry reports as a child of a storage event instead
+    parent = None
+    if workers > 1:
+        parent = events.ReportEventStack(
+            name=stack_prefix, reporting_enabled=True, level="INFO",
+            description="configuring storage")
+
+    # the file systems that could be made next are made at the same time,
+    # so even one by one those on different disks are made concurrently
+    batch_handlers = {
+        'format': format_batch_handler,
+    }
+
+    def handle(item_id):
+        handle_batch([item_id])
+
+    def handle_batch(item_ids):
+        commands = [storage_config_dict[k] for k in item_ids]
+        command_type = commands[0]['type']
         with events.ReportEventStack(
-                name=stack_prefix, reporting_enabled=True, level="INFO",
-                description="configuring %s: %s" % (command['type'],
-                                                    command['id'])):
+                name=item_ids[0] if parent else stack_prefix, parent=parent,
+                reporting_enabled=True, level="INFO",
+                description="configuring %s: %s" % (command_type,
+                                                    ', '.join(item_ids))):
             try:
-                handler(command, storage_config_dict)
+                if len(commands) > 1:
+                    batch_handlers[command_type](commands,
+                                                 storage_config_dict)
+                else:
+                    command_handlers[command_type](commands[0],
+                                                   storage_config_dict)
             except Exception as error:
                 LOG.error("An error occured handling '%s': %s - %s" %
-                          (item_id, type(error).__name__, error))
+                          (', '.join(item_ids), type(error).__name__, error))
                 raise
+            finally:
+                # the volumes of the entries were created or changed
+                for item_id in item_ids:
+                    invalidate_volume_paths(item_id)
+
+    batches = dict((command_type, handle_batch)
+                   for command_type in batch_handlers)
+
+    # lsblk and blkid queries of the handlers are answered from one
+    # snapshot, the handlers invalidate the devices they change, and
+    # volume paths are resolved and synced once until their entry is handled
+    with block.block_inventory(), volume_paths():
+        if parent:
+            with parent:
+                run_storage_handlers(storage_config_dict, handle,
+                                     workers=workers, batches=batches)
+        else:
+            run_storage_handlers(storage_config_dict, handle,
+                                 workers=workers, batches=batches)
 
     if args.umount:
         util.do_umount(state['target'], recursive=True)
     return 0
 
 
+def simple_partition_table(devnode, ptfmt, boot=False):
+    """
+    Return the PartitionTable of simple mode partition format ptfmt (mbr,
+    gpt, uefi or prep) for devnode, with a separate boot partition if boot.
+    The root partition is the last one of the table.
+    """
+    label = 'msdos' if ptfmt == 'mbr' else 'gpt'
+    table = partition_table.new_table(devnode, label)
+    # partitions start at 1M and boot partitions are 512M
+    mb = (1 << 20) // table.sector_size
+    boot_end = mb + 512 * mb - 1
+    if ptfmt == 'mbr':
+        # leave room for a backup gpt header and entries at the end of the
+        # disk, for a later 'sgdisk --mbrtogpt'
+        end = table.last_usable - (-(-33 * 512 // table.sector_size))
+        if boot:
+            table.add(1, mb, boot_end)
+            table.add(2, boot_end + 1, end, bootable=True)
+        else:
+            table.add(1, mb, end, bootable=True)
+    elif ptfmt == 'gpt':
+        table.add(15, mb, 2 * mb - 1, flag='bios_grub')
+        if boot:
+            table.add(1, 2 * mb, boot_end + mb)
+            table.add(2, boot_end + mb + 1, table.last_usable)
+        else:
+            table.add(1, 2 * mb, table.last_usable)
+    elif ptfmt == 'uefi':
+        table.add(15, mb, boot_end, flag='boot')
+        table.add(1, boot_end + 1, table.last_usable)
+    elif ptfmt == 'prep':
+        table.add(1, mb, 9 * mb - 1, flag='prep')
+        table.add(2, 9 * mb, table.last_usable)
+    else:
+        raise ValueError("invalid partition format: %s" % ptfmt)
+    return table
+
+
+def partition_simple(devnode, ptfmt, boot=False):
+    """
+    Replace the partition table of devnode with the simple mode layout of
+    ptfmt, wiping the start of each new partition and all of a PReP one.
+    """
+    table = simple_partition_table(devnode, ptfmt, boot=boot)
+    mb = 1 << 20
+    offsets = [0, -mb]
+    for part in table.partitions:
+        offset = part.start * table.sector_size
+        if part.flag == 'prep':
+            block.zero_file_at_offsets(devnode, [offset], buflen=mb,
+                                       count=part.size * table.sector_size //
+                                       mb, exclusive=False)
+        else:
+            offsets.append(offset)
+    block.zero_file_at_offsets(devnode, offsets, exclusive=False)
+    partition_table.write_table(devnode, table)
+    block.invalidate_inventory(devnode)
+    udevadm_settle()
+    return table
+
+
 def meta_simple(args):
     """Creates a root partition. If args.mode == SIMPLE_BOOT, it will also
     create a separate /boot partition.
@@ -1503,6 +2086,7 @@ def meta_simple(args):
     cfg = config.load_command_config(args, state)
     devpath = None
     if cfg.get("storage") is not None:
+        wipes = []
         for i in cfg["storage"]["config"]:
             serial = i.get("serial")
             if serial is None:
@@ -1512,7 +2096,9 @@ def meta_simple(args):
             if grub is True:
                 devpath = diskPath
             if config.value_as_boolean(i.get('wipe')):
-                block.wipe_volume(diskPath, mode=i.get('wipe'))
+                wipes.append((diskPath, i.get('wipe')))
+        if wipes:
+            block.wipe_volumes(wipes)
 
     if args.target is not None:
         state['target'] = args.target
@@ -1589,16 +2175,18 @@ def meta_simple(args):
     if len(dd_images):
         # we have at least one dd-able image
         # we will only take the first one
-        rootdev = write_image_to_disk(dd_images[0], devname)
+        targets = [devname]
+        if config.value_as_boolean(
+                cfg.get('block-meta', {}).get('mirror-image', False)):
+            # the same image on every valid device, target first
+            targets.extend(d for d in devices if d != target and
+                           block.is_valid_device(d))
+            LOG.info("writing image to %s", ', '.join(targets))
+        rootdev = write_image_to_disk(dd_images[0], targets,
+                                      cache=image_cache.from_config(cfg))
         util.subp(['mount', rootdev, state['target']])
         return 0
 
-    # helper partition will forcibly set up partition there
-    ptcmd = ['partition', '--format=' + ptfmt]
-    if bootpt['enabled']:
-        ptcmd.append('--boot')
-    ptcmd.append(devnode)
-
     if bootpt['enabled'] and ptfmt in ("uefi", "prep"):
         raise ValueError("format=%s with boot partition not supported" % ptfmt)
 
@@ -1614,8 +2202,9 @@ def meta_simple(args):
         else:
             rootdev_ptnum = 1
 
-    logtime("creating partition with: %s" % ' '.join(ptcmd),
-            util.subp, ptcmd)
+    # forcibly replace any partition table there
+    logtime("creating %s partitions on %s" % (ptfmt, devnode),
+            partition_simple, devnode, ptfmt, boot=bootpt['enabled'])
 
     ptpre = ""
     if not os.path.exists("%s%s" % (devnode, rootdev_ptnum)):
@@ -1630,10 +2219,12 @@ def meta_simple(args):
         bootdev = "%s%s%s" % (devnode, ptpre, bootdev_ptnum)
 
     if ptfmt == "uefi":
-        # assumed / required from the partitioner pt_uefi
+        # as laid out by simple_partition_table
         uefi_ptnum = "15"
         uefi_label = "uefi-boot"
         uefi_dev = "%s%s%s" % (devnode, ptpre, uefi_ptnum)
+        cmd = ['mkfs', '-t', 'vfat', '-F', '32', '-n', uefi_label, uefi_dev]
+        logtime(' '.join(cmd), util.subp, cmd)
 
     rootdev = "%s%s%s" % (devnode, ptpre, rootdev_ptnum)
 
@@ -1667,7 +2258,7 @@ def meta_simple(args):
                          (bootpt['label'], bootpt['fstype']))
 
             if ptfmt == "uefi":
-                # label created in helpers/partition for uefi
+                # label created above for uefi
                 fp.write("LABEL=%s /boot/efi vfat defaults 0 0\n" %
                          uefi_label)
 
@@ -9,15 +9,15 @@ LOG = log.LOG
 
 
 def wipe_main(args):
-    for blockdev in args.devices:
-        try:
-            LOG.debug('Wiping volume %s with mode=%s', blockdev, args.mode)
-            block.wipe_volume(blockdev, mode=args.mode)
-        except Exception as e:
-            sys.stderr.write(
-                "Failed to wipe volume %s in mode %s: %s" %
-                (blockdev, args.mode, e))
-            sys.exit(1)
+    LOG.debug('Wiping volumes %s with mode=%s', args.devices, args.mode)
+    try:
+        block.wipe_volumes([(blockdev, args.mode)
+                            for blockdev in args.devices])
+    except Exception as e:
+        sys.stderr.write(
+            "Failed to wipe volumes %s in mode %s: %s" %
+            (' '.join(args.devices), args.mode, e))
+        sys.exit(1)
     sys.exit(0)
 
 
@@ -25,7 +25,8 @@ CMD_ARGUMENTS = (
     ((('-m', '--mode'),
       {'help': 'mode for wipe.', 'action': 'store',
        'default': 'superblock',
-       'choices': ['zero', 'superblock', 'superblock-recursive', 'random']}),
+       'choices': ['zero', 'superblock', 'superblock-recursive', 'random',
+                   'zeroout', 'discard']}),
      ('devices',
       {'help': 'devices to wipe', 'default': [], 'nargs': '+'}),
      )
@@ -1,6 +1,10 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import errno
+import hashlib
 import os
+import shutil
+import stat
 import sys
 import tempfile
 
@@ -8,11 +12,17 @@ import curtin.config
 from curtin.log import LOG
 from curtin import util
 from curtin.futil import write_files
+from curtin import image_cache
 from curtin.reporter import events
+from curtin import streams
+from curtin import tarball
+from curtin import treecopy
 from curtin import url_helper
 
 from . import populate_one_subcmd
 
+SQUASHFS_MAGIC = b'hsqs'
+
 CMD_ARGUMENTS = (
     ((('-t', '--target'),
       {'help': ('target directory to extract to (root) '
@@ -25,52 +35,113 @@ CMD_ARGUMENTS = (
 )
 
 
-def tar_xattr_opts(cmd=None):
-    # if tar cmd supports xattrs, return the required flags to extract them.
-    if cmd is None:
-        cmd = ['tar']
-
-    if isinstance(cmd, str):
-        cmd = [cmd]
-
-    (out, _err) = util.subp(cmd + ['--help'], capture=True)
-
-    if "xattr" in out:
-        return ['--xattrs', '--xattrs-include=*']
-    return []
+def _cache_verified(cache, sha256, checksum):
+    # entries found or filled by a sha256 are verified by the cache
+    return cache and sha256 and checksum[0] == 'sha256'
 
 
-def extract_root_tgz_url(url, target):
-    # extract a -root.tar.gz url in the 'target' directory
+def extract_root_tgz_url(url, target, reportstack=None, cache=None,
+                         sha256=None, checksum=None):
+    # extract a -root.tar.gz url in the 'target' directory, verifying the
+    # (type, hexdigest) checksum of the tarball as it is read
     path = _path_from_file_url(url)
     if path != url or os.path.isfile(path):
-        util.subp(args=['tar', '-C', target] + tar_xattr_opts() +
-                  ['-Sxpzf', path, '--numeric-owner'])
-        return
-
-    # Uses smtar to avoid specifying the compression type
-    util.subp(args=['sh', '-cf',
-                    ('wget "$1" --progress=dot:mega -O - |'
-                     'smtar -C "$2" ' + ' '.join(tar_xattr_opts()) +
-                     ' ' + '-Sxpf - --numeric-owner'),
-                    '--', url, target])
-
-
-def extract_root_fsimage_url(url, target):
+        reader = open(path, "rb")
+        size = util.file_size(path)
+    else:
+        if cache:
+            reader = cache.open(url, sha256=sha256)
+        else:
+            reader = url_helper.UrlReader(url)
+        size = reader.size
+    if checksum and not _cache_verified(cache, sha256, checksum):
+        reader = streams.ChecksumReader(reader, checksum, name=url)
+
+    meter = streams.ProgressMeter(
+        reportstack.fullname if reportstack else None,
+        "extracting %s" % url, total=size)
+    with reader:
+        tarball.extract_stream(reader, target, meter=meter)
+    meter.finish()
+
+
+def extract_root_fsimage_url(url, target, reportstack=None, cache=None,
+                             sha256=None, checksum=None):
+    # the image is verified against the (type, hexdigest) checksum before
+    # it is extracted, as it is downloaded where possible
     path = _path_from_file_url(url)
     if path != url or os.path.isfile(path):
-        return _extract_root_fsimage(path, target)
-
-    wfp = tempfile.NamedTemporaryFile(suffix=".img", delete=False)
-    wfp.close()
+        if checksum:
+            streams.verify_file(path, checksum, name=url)
+        return _extract_root_fsimage(path, target, reportstack=reportstack)
+
+    if cache:
+        path = cache.fetch(url, sha256=sha256)
+        if path:
+            if checksum and not _cache_verified(cache, sha256, checksum):
+                streams.verify_file(path, checksum, name=url)
+            return _extract_root_fsimage(path, target,
+                                         reportstack=reportstack)
+
+    # download to a path stable across attempts, an install restarted after
+    # a failed download resumes it
+    (download_dir, resumable) = _fsimage_download_dir()
+    path = os.path.join(download_dir, "%s.img" %
+                        hashlib.sha256(url.encode('utf-8')).hexdigest()[:16])
     try:
-        url_helper.download(url, wfp.name)
-        return _extract_root_fsimage(wfp.name, target)
+        url_helper.download(url, path, resume=resumable, checksum=checksum)
+        try:
+            return _extract_root_fsimage(path, target,
+                                         reportstack=reportstack)
+        finally:
+            os.unlink(path)
     finally:
-        os.unlink(wfp.name)
-
+        if not resumable:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def _fsimage_download_dir():
+    # return (directory, resumable) for fsimage downloads.  downloads are
+    # resumed from a directory only the current user can write to, which
+    # is used if it exists, is not a symlink and is owned by the user with
+    # no group or other permissions; otherwise a new temporary directory
+    # is used and downloads are not resumed.
+    path = os.path.join(tempfile.gettempdir(),
+                        "curtin-fsimage-%d" % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            not st.st_mode & 0o077):
+        return (path, True)
+    LOG.warn("Not resuming image downloads in %s, it is not private to "
+             "this user", path)
+    return (tempfile.mkdtemp(prefix="curtin-fsimage-"), False)
+
+
+def _is_squashfs(path):
+    with open(path, "rb") as fp:
+        return fp.read(len(SQUASHFS_MAGIC)) == SQUASHFS_MAGIC
+
+
+def unsquash_to_target(path, target, workers=None):
+    # unpack the squashfs image at path into target, decompressing blocks
+    # on 'workers' threads
+    if not workers:
+        workers = streams.decompress_workers()
+    LOG.debug("Unpacking squashfs %s to %s with %d workers", path, target,
+              workers)
+    util.subp(['unsquashfs', '-f', '-no-progress', '-processors',
+               str(workers), '-d', target, path], capture=True)
+
+
+def _extract_root_fsimage(path, target, reportstack=None):
+    if _is_squashfs(path) and util.which('unsquashfs'):
+        return unsquash_to_target(path, target)
 
-def _extract_root_fsimage(path, target):
     mp = tempfile.mkdtemp()
     try:
         util.subp(['mount', '-o', 'loop,ro', path, mp], capture=True)
@@ -79,17 +150,25 @@ def _extract_root_fsimage(path, target):
         os.rmdir(mp)
         raise e
     try:
-        return copy_to_target(mp, target)
+        return copy_to_target(mp, target, reportstack=reportstack)
     finally:
         util.subp(['umount', mp])
         os.rmdir(mp)
 
 
-def copy_to_target(source, target):
+def copy_to_target(source, target, reportstack=None):
     if source.startswith("cp://"):
         source = source[5:]
     source = os.path.abspath(source)
 
+    if treecopy.supported():
+        meter = streams.ProgressMeter(
+            reportstack.fullname if reportstack else None,
+            "copying %s" % source)
+        treecopy.copy_tree(source, target, meter=meter)
+        meter.finish()
+        return
+
     util.subp(args=['sh', '-c',
                     ('mkdir -p "$2" && cd "$2" && '
                      'rsync -aXHAS --one-file-system "$1/" .'),
@@ -121,20 +200,31 @@ def extract(args):
 
     LOG.debug("Installing sources: %s to target at %s" % (sources, target))
     stack_prefix = state.get('report_stack_prefix', '')
+    cache = (image_cache.from_config(cfg) or
+             image_cache.from_config(cfg, key='prefetch_cache'))
 
     for source in sources:
         with events.ReportEventStack(
                 name=stack_prefix, reporting_enabled=True, level="INFO",
                 description="acquiring and extracting image from %s" %
-                source['uri']):
+                source['uri']) as reportstack:
             if source['type'].startswith('dd-'):
                 continue
+            checksum = streams.source_checksum(source)
             if source['uri'].startswith("cp://"):
-                copy_to_target(source['uri'], target)
+                copy_to_target(source['uri'], target,
+                               reportstack=reportstack)
             elif source['type'] == "fsimage":
-                extract_root_fsimage_url(source['uri'], target=target)
+                extract_root_fsimage_url(source['uri'], target=target,
+                                         reportstack=reportstack,
+                                         cache=cache,
+                                         sha256=source.get('sha256'),
+                                         checksum=checksum)
             else:
-                extract_root_tgz_url(source['uri'], target=target)
+                extract_root_tgz_url(source['uri'], target=target,
+                                     reportstack=reportstack, cache=cache,
+                                     sha256=source.get('sha256'),
+                                     checksum=checksum)
 
     if cfg.get('write_files'):
         LOG.info("Applying write_files from config.")
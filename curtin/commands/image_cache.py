@@ -0,0 +1,243 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+"""Serve install source images from a local image cache over http.
+
+Requests for /<scheme>/<host>/<path> are answered with the upstream
+<scheme>://<host>/<path>.  The first request for it is sent the whole
+object as it is downloaded into the cache, later ones are served from
+local disk, with Range support.  Requests for an image while it is being
+downloaded into the cache are passed through to upstream."""
+
+import os
+import re
+import socket
+import sys
+
+try:
+    from http import server as http_server
+    import socketserver
+except ImportError:
+    # python2
+    import BaseHTTPServer as http_server  # pylint: disable=import-error
+    import SocketServer as socketserver  # pylint: disable=import-error
+
+from curtin import image_cache
+from curtin import url_helper
+from curtin import util
+from curtin import version
+from curtin.log import LOG
+from . import populate_one_subcmd
+
+DEFAULT_PORT = 8480
+BUFLEN = 1024 * 1024
+# upstream errors passed on to clients, others are reported as 502
+UPSTREAM_ERRORS = (401, 403, 404, 410)
+
+CMD_ARGUMENTS = (
+    (('action', {'help': 'action to take', 'choices': ['serve']}),
+     (('-l', '--listen'),
+      {'help': 'address to listen on [default all]', 'default': ''}),
+     (('-p', '--port'),
+      {'help': 'port to listen on [default %d]' % DEFAULT_PORT,
+       'type': int, 'default': DEFAULT_PORT}),
+     ('--path',
+      {'help': ('directory of the cache [default %s]' %
+                image_cache.DEFAULT_CACHE_DIR),
+       'default': image_cache.DEFAULT_CACHE_DIR}),
+     ('--max-size',
+      {'help': ('maximum size of the cache [default %s]' %
+                image_cache.DEFAULT_MAX_SIZE),
+       'default': image_cache.DEFAULT_MAX_SIZE}),
+     ('--allow-host',
+      {'help': ('upstream host images may be fetched from, required, '
+                'may be given more than once'),
+       'action': 'append', 'dest': 'allowed_hosts', 'metavar': 'HOST',
+       'required': True}),
+     )
+)
+
+
+def upstream_url(path, allowed_hosts):
+    """Return the upstream url of request path /<scheme>/<host>/<path>.
+
+    ValueError is raised for paths not naming an upstream whose host is
+    one of allowed_hosts, so that the server is not an open proxy."""
+    match = re.match(r'^/([a-z]+)/([^/]+)(/.*)?$', path)
+    if not match or match.group(1) not in image_cache.SERVER_SCHEMES:
+        raise ValueError("%s does not name an upstream url" % path)
+    (scheme, host, rest) = match.groups()
+    if host.split(':')[0] not in (allowed_hosts or ()):
+        raise ValueError("upstream host %s is not allowed" % host)
+    return '%s://%s%s' % (scheme, host, rest or '/')
+
+
+def parse_range(header, size):
+    """Return the (first, last) bytes of a single range Range header.
+
+    None is returned if the whole object should be sent, ValueError is
+    raised if the range is not satisfiable."""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    (first, last) = match.groups()
+    if not first:
+        # suffix range, the last bytes of the object
+        if int(last) == 0:
+            raise ValueError("unsatisfiable range %s" % header)
+        return (max(size - int(last), 0), size - 1)
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        raise ValueError("unsatisfiable range %s" % header)
+    if last < first:
+        return None
+    return (first, last)
+
+
+class ImageCacheHandler(http_server.BaseHTTPRequestHandler):
+    server_version = 'curtin-image-cache/' + version.version_string()
+
+    def log_message(self, fmt, *args):
+        LOG.debug("%s %s", self.address_string(), fmt % args)
+
+    def end_headers(self):
+        self._headers_sent = True
+        http_server.BaseHTTPRequestHandler.end_headers(self)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def _serve(self, body):
+        try:
+            url = upstream_url(self.path, self.server.allowed_hosts)
+        except ValueError as e:
+            self.send_error(404, str(e))
+            return
+        cache = self.server.cache
+        self._headers_sent = False
+        try:
+            path = cache.find(url, wait=False)
+            if path:
+                self._send_entry(path, body)
+            elif body:
+                # ranges are not sent while the cache is filled, the whole
+                # object is
+                self._send_reader(cache.fill(url))
+            else:
+                # HEAD requests do not fill the cache
+                self._send_upstream_headers(url_helper.head(url))
+        except url_helper.UrlError as e:
+            LOG.warn("Failed to fetch %s: %s", url, e)
+            if self._headers_sent:
+                # too late for an error status, the client sees the body
+                # end short of the Content-Length
+                self.close_connection = True
+                return
+            code = e.code if e.code in UPSTREAM_ERRORS else 502
+            self.send_error(code, str(e))
+        except (IOError, OSError, socket.error) as e:
+            # most likely the client went away
+            LOG.debug("Failed to send %s to %s: %s", url,
+                      self.address_string(), e)
+
+    def _send_entry(self, path, body):
+        meta = self.server.cache.load_meta(os.path.basename(path)) or {}
+        etag = meta.get('etag') or '"%s"' % os.path.basename(path)
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            crange = None
+            if_range = self.headers.get('If-Range')
+            if not if_range or if_range in (etag, meta.get('last_modified')):
+                try:
+                    crange = parse_range(self.headers.get('Range'), size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            (first, last) = crange or (0, size - 1)
+            self.send_response(206 if crange else 200)
+            if crange:
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            self.send_header('Content-Length', str(last + 1 - first))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            if meta.get('last_modified'):
+                self.send_header('Last-Modified', meta['last_modified'])
+            self.end_headers()
+            if body:
+                self._copy(fp, first, last + 1 - first)
+
+    def _copy(self, fp, offset, count):
+        self.wfile.flush()
+        if hasattr(self.connection, 'sendfile'):
+            # without copying the data through userspace where possible
+            self.connection.sendfile(fp, offset, count)
+            return
+        fp.seek(offset)
+        while count > 0:
+            buf = fp.read(min(count, BUFLEN))
+            if not buf:
+                break
+            self.wfile.write(buf)
+            count -= len(buf)
+
+    def _send_upstream_headers(self, headers):
+        self.send_response(200)
+        for name in ('Content-Length', 'Content-Type', 'ETag',
+                     'Last-Modified'):
+            if headers.get(name):
+                self.send_header(name, headers.get(name))
+        self.end_headers()
+
+    def _send_reader(self, reader):
+        # the whole upstream object, copied into the cache as it is sent
+        # where it can be cached
+        with reader:
+            self._send_upstream_headers(reader.info)
+            while True:
+                buf = reader.read(BUFLEN)
+                if not buf:
+                    break
+                self.wfile.write(buf)
+
+
+class ImageCacheServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    """Threaded http server of the images in cache."""
+
+    daemon_threads = True
+
+    def __init__(self, address, cache, allowed_hosts):
+        http_server.HTTPServer.__init__(self, address, ImageCacheHandler)
+        self.cache = cache
+        self.allowed_hosts = allowed_hosts
+
+
+def image_cache_main(args):
+    max_size = args.max_size
+    if max_size is not None:
+        max_size = int(util.human2bytes(max_size))
+    cache = image_cache.ImageCache(args.path, max_size=max_size)
+    server = ImageCacheServer((args.listen, args.port), cache,
+                              allowed_hosts=args.allowed_hosts)
+    LOG.info("Serving image cache %s on %s:%d", cache.path,
+             args.listen or '*', server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    sys.exit(0)
+
+
+def POPULATE_SUBCMD(parser):
+    populate_one_subcmd(parser, CMD_ARGUMENTS, image_cache_main)
+    parser.description = __doc__
+
+# vi: ts=4 expandtab syntax=python
@@ -13,6 +13,8 @@ import tempfile
 
 from curtin.block import iscsi
 from curtin import config
+from curtin import image_cache
+from curtin import prefetch
 from curtin import util
 from curtin import version
 from curtin.log import LOG, logged_time
@@ -406,9 +408,14 @@ def cmd_install(args):
     if not len(cfg.get('sources', [])):
         raise util.BadUsage("no sources provided to install")
 
+    server = cfg.get('image_cache_server')
     for i in cfg['sources']:
         # we default to tgz for old style sources config
         cfg['sources'][i] = util.sanitize_source(cfg['sources'][i])
+        if server:
+            # read images through a 'curtin image-cache serve' server
+            cfg['sources'][i] = image_cache.server_source(cfg['sources'][i],
+                                                          server)
 
     migrate_proxy_settings(cfg)
     for k in ('http_proxy', 'https_proxy', 'no_proxy'):
@@ -441,11 +448,21 @@ def cmd_install(args):
     writeline_and_stdout(logfile, INSTALL_START_MSG)
     args.reportstack.post_files = post_files
     workingd = None
+    prefetcher = None
     try:
+        # download sources while storage is prepared, extract reads them
+        # from the prefetch cache
+        prefetcher = prefetch.from_config(cfg)
+        if prefetcher and image_cache.from_config(cfg) is None:
+            # only extract reads the staging cache, dd images are still
+            # written to their disks as they are downloaded
+            cfg['prefetch_cache'] = prefetcher.cache_config()
         workingd = WorkingDir(cfg)
         dd_images = util.get_dd_images(cfg.get('sources', {}))
         if len(dd_images) > 1:
             raise ValueError("You may not use more than one disk image")
+        if prefetcher:
+            prefetcher.start()
 
         LOG.debug(workingd.env())
         env = os.environ.copy()
@@ -480,6 +497,8 @@ def cmd_install(args):
             create_log_tarfile(error_tarfile, cfg)
         raise e
     finally:
+        if prefetcher:
+            prefetcher.cleanup()
         log_target_path = instcfg.get('save_install_log', SAVE_INSTALL_LOG)
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
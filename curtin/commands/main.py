@@ -17,7 +17,8 @@ SUB_COMMAND_MODULES = [
     'apply_net', 'apt-config', 'block-attach-iscsi', 'block-detach-iscsi',
     'block-info', 'block-meta', 'block-wipe', 'clear-holders', 'curthooks',
     'collect-logs', 'extract', 'features',
-    'hook', 'install', 'mkfs', 'in-target', 'net-meta', 'pack', 'swap',
+    'hook', 'image-cache', 'install', 'mkfs', 'in-target', 'net-meta',
+    'pack', 'swap',
     'system-install', 'system-upgrade', 'unmount', 'version',
 ]
 
@@ -126,6 +127,7 @@ def main(argv=None):
 
     # Above here, only standard library modules can be assumed.
     from .. import config
+    from ..block import image
     from ..reporter import (events, update_configuration)
 
     parser = get_main_parser(stacktrace=stacktrace, verbosity=verbosity)
@@ -186,6 +188,7 @@ def main(argv=None):
 
     # set up the reportstack
     update_configuration(cfg.get('reporting', {}))
+    image.update_direct_io(cfg.get('direct_io'))
 
     stack_prefix = (os.environ.get("CURTIN_REPORTSTACK", "") +
                     "/cmd-%s" % args.subcmd)
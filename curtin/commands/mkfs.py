@@ -1,7 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from . import populate_one_subcmd
-from curtin.block.mkfs import mkfs as run_mkfs
+from curtin.block.mkfs import mkfs_batch
 from curtin.block.mkfs import valid_fstypes
 
 import sys
@@ -30,11 +30,12 @@ CMD_ARGUMENTS = (
 
 
 def mkfs(args):
-    for device in args.devices:
-        uuid = run_mkfs(device, args.fstype, strict=args.strict,
-                        uuid=args.uuid, label=args.label,
-                        force=args.force)
-
+    options = {'strict': args.strict, 'uuid': args.uuid, 'label': args.label,
+               'force': args.force}
+    # the devices are formatted at the same time
+    uuids = mkfs_batch((device, args.fstype, options)
+                       for device in args.devices)
+    for (device, uuid) in uuids.items():
         print("Created '%s' filesystem in '%s' with uuid '%s' and label '%s'" %
               (args.fstype, device, uuid, args.label))
 
@@ -0,0 +1,503 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""On-disk cache of install source images.
+
+Entries are addressed either by a sha256 declared for the source, or by
+the url together with the ETag/Last-Modified validators the server sends
+for it, so a changed image is never served from a stale entry.  Entries
+are published atomically by renaming a completed download into place and
+the least recently used ones are evicted to keep the cache below its
+configured size."""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from .log import LOG
+from . import config
+from . import streams
+from . import url_helper
+from . import util
+
+DEFAULT_CACHE_DIR = '/var/cache/curtin/images'
+DEFAULT_MAX_SIZE = '20G'
+META_SUFFIX = '.json'
+PARTIAL_DIR = 'partial'
+LOCK_FILE = '.lock'
+# upstream url schemes 'curtin image-cache serve' fetches
+SERVER_SCHEMES = ('http', 'https', 'ftp')
+
+
+def from_config(cfg, key='image_cache'):
+    """Return the ImageCache configured by key in cfg or None.
+
+    image_cache:
+      path: /var/cache/curtin/images
+      max_size: 20G
+    """
+    ccfg = cfg.get(key)
+    if not ccfg:
+        return None
+    if not isinstance(ccfg, dict):
+        ccfg = {}
+    if not config.value_as_boolean(ccfg.get('enabled', True)):
+        return None
+    max_size = ccfg.get('max_size', DEFAULT_MAX_SIZE)
+    if max_size is not None:
+        max_size = int(util.human2bytes(max_size))
+    return ImageCache(ccfg.get('path', DEFAULT_CACHE_DIR), max_size=max_size)
+
+
+def server_url(server, url):
+    """Return the url of url on the image cache server at server.
+
+    'curtin image-cache serve' maps a path of /<scheme>/<host>/<path> to
+    the upstream <scheme>://<host>/<path>.  Urls of other schemes are
+    returned as they are."""
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in SERVER_SCHEMES:
+        return url
+    return '%s/%s/%s' % (server.rstrip('/'), scheme, rest)
+
+
+def server_source(source, server):
+    """Return a copy of source reading its urls through server."""
+    source = dict(source)
+    for key in ('uri', 'bmap'):
+        if source.get(key):
+            source[key] = server_url(server, source[key])
+    return source
+
+
+def content_key(sha256):
+    """Return the cache key for content with the given sha256."""
+    return 'sha256-' + sha256.lower()
+
+
+def url_key(url, headers):
+    """Return the cache key for url as described by response headers.
+
+    None is returned if the headers carry no validator, such a response
+    cannot be told apart from a later, different one."""
+    etag = headers.get('etag')
+    modified = headers.get('last-modified')
+    if not (etag or modified):
+        return None
+    digest = hashlib.sha256()
+    for item in (url, etag or '', modified or ''):
+        digest.update(item.encode('utf-8') + b'\n')
+    return 'url-' + digest.hexdigest()
+
+
+def content_length(size):
+    """Return the object size from a Content-Length value, or None if it
+    is not known."""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return None
+    return size if size >= 0 else None
+
+
+class CacheEntryReader(object):
+    """Read a published cache entry, like url_helper.UrlReader."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.size = os.fstat(self.fp.fileno()).st_size
+
+    def read(self, buflen):
+        return self.fp.read(buflen)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class CacheFillReader(object):
+    """Read from reader while copying the data into a new cache entry.
+
+    The entry is published when the close follows a complete read of
+    reader, a partial read leaves the cache untouched.  lock, the download
+    lock of key if given, is released by the close."""
+
+    def __init__(self, cache, reader, key, meta, lock=None):
+        self.cache = cache
+        self.reader = reader
+        self.key = key
+        self.meta = meta
+        self.size = reader.size
+        self.info = reader.info
+        self.path = None
+        self._lock = lock
+        self._complete = False
+        self._digest = hashlib.sha256() if meta.get('sha256') else None
+        fd, self._partial = tempfile.mkstemp(
+            prefix=key + '.', dir=os.path.join(cache.path, PARTIAL_DIR))
+        self._wfp = os.fdopen(fd, 'wb')
+
+    def read(self, buflen):
+        buf = self.reader.read(buflen)
+        if buf:
+            self._wfp.write(buf)
+            if self._digest:
+                self._digest.update(buf)
+        else:
+            self._complete = True
+        return buf
+
+    def close(self):
+        if self._wfp is None:
+            return
+        try:
+            self._close()
+        finally:
+            if self._lock:
+                self.cache._release_download_lock(self.key, self._lock)
+                self._lock = None
+
+    def _close(self):
+        try:
+            self.reader.close()
+        finally:
+            self._wfp.close()
+            self._wfp = None
+        if not self._complete:
+            util.del_file(self._partial)
+            return
+        if self._digest and self._digest.hexdigest() != self.meta['sha256']:
+            util.del_file(self._partial)
+            raise streams.ChecksumError(self.meta['url'], 'sha256',
+                                        self.meta['sha256'],
+                                        self._digest.hexdigest())
+        self.path = self.cache.publish(self.key, self._partial, self.meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if etype is not None:
+            self._complete = False
+        self.close()
+
+
+class ImageCache(object):
+    """Size capped, least recently used cache of downloaded images."""
+
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        util.ensure_dir(os.path.join(self.path, PARTIAL_DIR))
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def lookup(self, key):
+        """Return the path to the published entry key or None.
+
+        A hit marks the entry as most recently used."""
+        path = self.entry_path(key)
+        try:
+            meta = self.load_meta(key)
+            if meta is None or os.path.getsize(path) != meta['size']:
+                return None
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def _head(self, url):
+        try:
+            return url_helper.head(url)
+        except url_helper.UrlError as e:
+            LOG.debug("Unable to validate cache entry for %s: %s", url, e)
+            return None
+
+    def _key(self, url, sha256=None, headers=None):
+        if sha256:
+            return content_key(sha256)
+        if headers is None:
+            headers = self._head(url)
+            if headers is None:
+                return None
+        return url_key(url, headers)
+
+    def reserve(self, url, size, partial=None):
+        """Return whether an object of size bytes can be cached, evicting
+        least recently used entries to free space for it.
+
+        Bytes already downloaded to partial need no more space.  An object
+        of unknown size (None) is checked by publish once downloaded."""
+        if size is None:
+            return True
+        if self.max_size is not None and size > self.max_size:
+            LOG.warn("Not caching %s: %s exceeds cache size %s", url,
+                     util.bytes2human(size), util.bytes2human(self.max_size))
+            return False
+        needed = size
+        if partial and os.path.exists(partial):
+            needed -= min(os.path.getsize(partial), size)
+        with self._locked():
+            used = sum(esize for (_mtime, esize, _key) in self.entries())
+            (_total, free) = util.get_fs_use_info(self.path)
+            limit = used - max(needed - free, 0)
+            if self.max_size is not None:
+                limit = min(limit, self.max_size - size)
+            if limit < used:
+                self.evict(limit)
+                (_total, free) = util.get_fs_use_info(self.path)
+        if needed > free:
+            LOG.warn("Not caching %s: %s exceeds free space %s of %s", url,
+                     util.bytes2human(size), util.bytes2human(free),
+                     self.path)
+            return False
+        return True
+
+    def find(self, url, sha256=None, wait=True):
+        """Return the path to a fresh entry for url or None.
+
+        A download of url into the cache in progress elsewhere, such as a
+        prefetch, is waited for unless wait is False."""
+        key = self._key(url, sha256=sha256)
+        if key is None:
+            return None
+        path = self.lookup(key)
+        if path is None and wait and os.path.exists(self._lock_path(key)):
+            LOG.info("Waiting for download of %s in progress", url)
+            with self._download_lock(key):
+                path = self.lookup(key)
+        return path
+
+    def open(self, url, sha256=None):
+        """Return a reader of url, served from the cache when possible.
+
+        On a miss the data is read from url and, when it can be keyed,
+        copied into the cache as it is read."""
+        if sha256:
+            sha256 = sha256.lower()
+        path = self.find(url, sha256=sha256)
+        if path:
+            LOG.info("Using cached %s for %s", path, url)
+            return CacheEntryReader(path)
+        return self.fill(url, sha256=sha256)
+
+    def fill(self, url, sha256=None):
+        """Return a reader of url from upstream, copying the data into the
+        cache as it is read.
+
+        url is read without being cached if it cannot be keyed, does not
+        fit in the cache or is being downloaded into the cache
+        elsewhere."""
+        if sha256:
+            sha256 = sha256.lower()
+        reader = url_helper.ResumableReader(url)
+        if sha256:
+            key = content_key(sha256)
+        else:
+            key = url_key(url, reader.info)
+        if key is None:
+            LOG.debug("Not caching %s, response has no validators", url)
+            return reader
+        if not self.reserve(url, content_length(reader.size)):
+            return reader
+        lock = self._try_download_lock(key)
+        if lock is None:
+            LOG.debug("Not caching %s, it is being downloaded elsewhere",
+                      url)
+            return reader
+        meta = {'url': url, 'sha256': sha256,
+                'etag': reader.info.get('etag'),
+                'last_modified': reader.info.get('last-modified')}
+        try:
+            return CacheFillReader(self, reader, key, meta, lock=lock)
+        except Exception:
+            self._release_download_lock(key, lock)
+            raise
+
+    def fetch(self, url, sha256=None):
+        """Return the path to a cache entry holding url, or None.
+
+        url is downloaded into the cache with url_helper.download on a
+        miss, resuming an earlier, failed download.  None is returned if it
+        cannot be cached, including when its size is known not to fit,
+        leaving the caller to read url itself."""
+        if sha256:
+            sha256 = sha256.lower()
+        headers = None
+        if not sha256:
+            headers = self._head(url)
+            if headers is None:
+                return None
+        key = self._key(url, sha256=sha256, headers=headers)
+        if key is None:
+            LOG.debug("Not caching %s, response has no validators", url)
+            return None
+        path = self.lookup(key)
+        if path:
+            LOG.info("Using cached %s for %s", path, url)
+            return path
+
+        # the partial download is kept after a failure, so that fetching
+        # url again resumes it
+        partial = os.path.join(self.path, PARTIAL_DIR, key)
+        with self._download_lock(key):
+            # another fetch may have completed while we waited
+            path = self.lookup(key)
+            if path:
+                return path
+            if headers is None:
+                # only the size is needed, the key is the sha256
+                headers = self._head(url) or {}
+            size = content_length(headers.get('content-length'))
+            if not self.reserve(url, size, partial=partial):
+                return None
+            checksum = ('sha256', sha256) if sha256 else None
+            _path, info = url_helper.download(url, partial, resume=True,
+                                              checksum=checksum)
+            if not sha256:
+                # the object may have changed since it was validated
+                key = url_key(url, info) or key
+            meta = {'url': url, 'sha256': sha256, 'etag': info.get('etag'),
+                    'last_modified': info.get('last-modified')}
+            return self.publish(key, partial, meta)
+
+    def publish(self, key, partial, meta):
+        """Atomically move the completed download partial to entry key.
+
+        partial is synced to disk before it is renamed into place.
+
+        Least recently used entries are evicted to make room for it.
+        Returns the path of the new entry or None if it does not fit."""
+        size = os.path.getsize(partial)
+        if self.max_size is not None and size > self.max_size:
+            LOG.warn("Not caching %s: %s exceeds cache size %s", meta['url'],
+                     util.bytes2human(size), util.bytes2human(self.max_size))
+            util.del_file(partial)
+            return None
+        meta = dict(meta, size=size)
+        path = self.entry_path(key)
+        with open(partial, 'rb') as fp:
+            os.fsync(fp.fileno())
+        with self._locked():
+            if self.max_size is not None:
+                self.evict(self.max_size - size, keep=(key,))
+            util.write_file(path + META_SUFFIX + '.tmp', json.dumps(meta))
+            os.rename(path + META_SUFFIX + '.tmp', path + META_SUFFIX)
+            os.rename(partial, path)
+        LOG.debug("Cached %s as %s", meta['url'], path)
+        return path
+
+    def entries(self):
+        """Return (mtime, size, key) of each entry, least recently used
+        first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(META_SUFFIX):
+                continue
+            key = name[:-len(META_SUFFIX)]
+            try:
+                st = os.stat(self.entry_path(key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+        return sorted(entries)
+
+    def evict(self, limit, keep=()):
+        """Remove least recently used entries until at most limit bytes
+        are used."""
+        entries = self.entries()
+        total = sum(size for (_mtime, size, _key) in entries)
+        for (_mtime, size, key) in entries:
+            if total <= limit:
+                break
+            if key in keep:
+                continue
+            LOG.debug("Evicting %s from image cache", key)
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        path = self.entry_path(key)
+        util.del_file(path + META_SUFFIX)
+        util.del_file(path)
+
+    def load_meta(self, key):
+        """Return the metadata of entry key or None."""
+        try:
+            with open(self.entry_path(key) + META_SUFFIX, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError as e:
+            LOG.warn("Ignoring corrupt image cache entry %s: %s", key, e)
+        return None
+
+    def _lock_path(self, key):
+        return os.path.join(self.path, PARTIAL_DIR, key + '.lock')
+
+    @contextmanager
+    def _download_lock(self, key):
+        # one download of key at a time, across processes
+        lockfile = self._lock_path(key)
+        with open(lockfile, 'a') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self.lookup(key):
+                    util.del_file(lockfile)
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def _try_download_lock(self, key):
+        """Take the download lock of key without waiting for it.
+
+        Returns the locked file, to be passed to _release_download_lock, or
+        None if key is being downloaded elsewhere."""
+        fp = open(self._lock_path(key), 'a')
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            fp.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return fp
+
+    def _release_download_lock(self, key, fp):
+        # nothing is left to resume, whether the entry was published or not
+        try:
+            util.del_file(self._lock_path(key))
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        finally:
+            fp.close()
+
+    @contextmanager
+    def _locked(self):
+        # serialize with other threads and with other curtin processes
+        # sharing the cache directory
+        with self._lock:
+            with open(os.path.join(self.path, LOCK_FILE), 'a') as fp:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+# vi: ts=4 expandtab syntax=python
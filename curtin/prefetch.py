@@ -0,0 +1,161 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Download install sources while the target storage is prepared.
+
+The install command starts a Prefetcher before its first stage.  It
+fetches the sources the extract stage would download into an image cache
+(the configured image_cache, or a staging cache passed to extract as
+prefetch_cache) on a background thread.  extract reads the sources from
+that cache, waiting for a download still in flight rather than starting
+another one."""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from .log import LOG
+from . import config
+from . import image_cache
+from . import url_helper
+from . import util
+
+DEFAULT_MAX_SIZE = '8G'
+# only sources downloaded by extract are prefetched
+PREFETCH_SCHEMES = ('http://', 'https://', 'ftp://')
+STAGING_PREFIX = 'curtin-prefetch-'
+# seconds cleanup() waits for a download in flight before leaving a
+# temporary staging cache in place
+CLEANUP_TIMEOUT = 60
+
+
+def prefetch_sources(sources):
+    """Return the sources, in install order, worth prefetching."""
+    if isinstance(sources, dict):
+        sources = [sources[k] for k in sorted(sources.keys())]
+    return [s for s in sources
+            if not s['type'].startswith('dd-') and
+            s['uri'].startswith(PREFETCH_SCHEMES)]
+
+
+def from_config(cfg):
+    """Return a Prefetcher for the sources in cfg or None.
+
+    prefetch:
+      enabled: true
+      path: /tmp/curtin-prefetch
+      max_size: 8G
+
+    Sources are prefetched into the image_cache if one is configured, and
+    otherwise into a cache at path, which is kept, or by default into a new
+    temporary directory, which cleanup() removes again.  At most max_size
+    bytes are prefetched, never more than the free space of the cache
+    filesystem."""
+    pcfg = cfg.get('prefetch')
+    if not pcfg:
+        return None
+    if not isinstance(pcfg, dict):
+        pcfg = {}
+    if not config.value_as_boolean(pcfg.get('enabled', True)):
+        return None
+    sources = prefetch_sources(cfg.get('sources', {}))
+    if not sources:
+        return None
+
+    budget = int(util.human2bytes(pcfg.get('max_size', DEFAULT_MAX_SIZE)))
+    cache = image_cache.from_config(cfg)
+    staging = None
+    if cache is None:
+        path = pcfg.get('path')
+        if path:
+            util.ensure_dir(path)
+        else:
+            path = staging = tempfile.mkdtemp(prefix=STAGING_PREFIX)
+        cache = image_cache.ImageCache(path, max_size=budget)
+    elif cache.max_size is not None:
+        budget = min(budget, cache.max_size)
+    return Prefetcher(cache, sources, budget, staging=staging)
+
+
+class Prefetcher(object):
+    """Fetch sources into cache on a background thread.
+
+    Sources are fetched one at a time, each with url_helper.download's
+    concurrent range requests.  Those known to exceed what is left of
+    budget, or of the free space of the cache, are skipped.  Failures are
+    logged only: extract downloads whatever was not prefetched."""
+
+    def __init__(self, cache, sources, budget, staging=None):
+        self.cache = cache
+        self.sources = sources
+        self.budget = budget
+        self.staging = staging
+        self.fetched = []
+        self.used = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def cache_config(self):
+        """Return the prefetch_cache config for extract to use the cache."""
+        return {'path': self.cache.path, 'max_size': self.cache.max_size}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        for source in self.sources:
+            if self._stop.is_set():
+                return
+            url = source['uri']
+            try:
+                size = self._size(url)
+                if not self._fits(size):
+                    LOG.info("Not prefetching %s: %s exceeds prefetch "
+                             "budget", url, util.bytes2human(size))
+                    continue
+                LOG.info("Prefetching %s", url)
+                path = self.cache.fetch(url, sha256=source.get('sha256'))
+            except Exception as e:
+                if not self._stop.is_set():
+                    LOG.warn("Prefetch of %s failed, extract will download "
+                             "it: %s", url, e)
+                continue
+            if path:
+                self.used += os.path.getsize(path)
+                self.fetched.append(path)
+
+    def _size(self, url):
+        try:
+            return int(url_helper.head(url).get('content-length'))
+        except (TypeError, ValueError, url_helper.UrlError):
+            # the cache refuses entries larger than its size
+            return 0
+
+    def _fits(self, size):
+        if self.used + size > self.budget:
+            return False
+        (_total, free) = util.get_fs_use_info(self.cache.path)
+        return size <= free
+
+    def wait(self, timeout=None):
+        """Wait for the prefetch to finish, returning True if it did."""
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def cleanup(self):
+        """Stop prefetching and remove a temporary staging cache once the
+        download in flight, if any, has finished."""
+        self._stop.set()
+        if not self.staging:
+            return
+        if not self.wait(CLEANUP_TIMEOUT):
+            LOG.warn("Prefetch still running, leaving staging cache %s",
+                     self.staging)
+            return
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+# vi: ts=4 expandtab syntax=python
@@ -15,6 +15,7 @@ from . import instantiated_handler_registry
 FINISH_EVENT_TYPE = 'finish'
 START_EVENT_TYPE = 'start'
 RESULT_EVENT_TYPE = 'result'
+PROGRESS_EVENT_TYPE = 'progress'
 
 DEFAULT_EVENT_ORIGIN = 'curtin'
 
@@ -128,6 +129,18 @@ def report_start_event(event_name, event_description, level=None):
     return report_event(event)
 
 
+def report_progress_event(event_name, event_description, level=None):
+    """Report a "progress" event.
+
+    Progress events are sent while a long running operation, such as
+    writing an image, is in flight.  See :py:func:`.report_start_event`
+    for parameter details.
+    """
+    event = ReportingEvent(PROGRESS_EVENT_TYPE, event_name, event_description,
+                           level=level)
+    return report_event(event)
+
+
 class ReportEventStack(object):
     """Context Manager for using :py:func:`report_event`
 
@@ -0,0 +1,758 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Threaded byte stream plumbing used when writing install sources.
+
+Sources are read, decompressed and written by separate threads connected
+with bounded queues, so that download, decompression and disk writes all
+overlap without spawning external processes.
+"""
+
+import binascii
+import bz2
+import collections
+import hashlib
+import multiprocessing
+import os
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue  # pylint: disable=import-error
+
+try:
+    import lzma
+except ImportError:
+    # python2 without backports.lzma
+    lzma = None
+
+try:
+    from concurrent import futures
+except ImportError:
+    # python2 without the futures backport
+    futures = None
+
+from .log import LOG
+from . import util
+
+# optional, provided by python3-zstandard and python3-lz4.  Without them
+# zstd and lz4 streams are decompressed by the command line tools.
+zstandard = util.try_import_module('zstandard')
+lz4_frame = util.try_import_module('lz4.frame')
+lz4_block = util.try_import_module('lz4.block')
+
+DEFAULT_BUFLEN = 256 * 1024
+DEFAULT_QUEUE_DEPTH = 16
+PROGRESS_INTERVAL = 10
+
+# zstd frames and lz4 blocks up to this size are decompressed in parallel,
+# larger ones are streamed through a single decompressor.
+MAX_PARALLEL_UNIT = 32 * 1024 * 1024
+
+_EOF = object()
+
+# magic bytes at the start of a compressed stream, checked in order.
+COMPRESSION_MAGIC = (
+    ('gz', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zst', b'\x28\xb5\x2f\xfd'),
+    ('lz4', b'\x04\x22\x4d\x18'),
+)
+
+# digests a source may declare for its content, preferred first
+CHECKSUM_TYPES = ('sha512', 'sha256')
+
+ZSTD_MAGIC = 0xFD2FB528
+LZ4_MAGIC = 0x184D2204
+# both formats share the range of skippable frame magic numbers
+SKIPPABLE_MAGIC_MASK = 0xFFFFFFF0
+SKIPPABLE_MAGIC = 0x184D2A50
+LZ4_BLOCK_MAX_SIZES = {4: 64 * 1024, 5: 256 * 1024, 6: 1024 * 1024,
+                       7: 4 * 1024 * 1024}
+
+# used when the python module for a compression is not available.
+DECOMPRESS_COMMANDS = {
+    'zst': (['pzstd', '-dc', '-p', '{workers}'], ['zstd', '-dcq']),
+    'lz4': (['lz4', '-dcq'],),
+}
+
+# random data is the keystream of this cipher under a random key, generated
+# by openssl many times faster than python can read /dev/urandom.
+RANDOM_COMMAND = ['openssl', 'enc', '-aes-256-ctr', '-K', '{key}',
+                  '-iv', '{iv}']
+
+
+def _gz_decompressor():
+    # wbits offset of 16 makes zlib expect and skip the gzip header
+    return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+def _xz_decompressor():
+    if lzma is None:
+        raise ValueError("xz decompression requires the lzma module")
+    return lzma.LZMADecompressor()
+
+
+def _zst_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    return lz4_frame.LZ4FrameDecompressor()
+
+
+DECOMPRESSORS = {
+    'gz': _gz_decompressor,
+    'bz2': bz2.BZ2Decompressor,
+    'xz': _xz_decompressor,
+}
+if zstandard:
+    DECOMPRESSORS['zst'] = _zst_decompressor
+if lz4_frame:
+    DECOMPRESSORS['lz4'] = _lz4_decompressor
+
+
+def decompress_workers():
+    """Return the number of cpus this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def detect_compression(header):
+    """Return the compression type of a stream starting with header.
+
+    Returns None for data that does not start with a known magic."""
+    for ctype, magic in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return ctype
+    return None
+
+
+def read_chunks(fileobj, buflen=DEFAULT_BUFLEN):
+    """Generate chunks of at most buflen bytes read from fileobj."""
+    while True:
+        buf = fileobj.read(buflen)
+        if not buf:
+            return
+        yield buf
+
+
+def decompress_chunks(chunks, ctype, workers=None):
+    """Decompress an iterable of chunks of ctype compressed data.
+
+    Concatenated streams (as written by pigz, pbzip2 or pixz) are
+    decompressed as a single stream.  zstd frames and independent lz4
+    blocks are decompressed on 'workers' threads, which defaults to the
+    number of available cpus."""
+    if ctype is None:
+        return iter(chunks)
+
+    if workers is None:
+        workers = decompress_workers()
+
+    if workers > 1 and futures and ctype in PARALLEL_DECOMPRESSORS:
+        units, decode = PARALLEL_DECOMPRESSORS[ctype]
+        if decode is not None:
+            return _parallel_decompress(
+                units(ChunkBuffer(chunks)), decode, ctype, workers)
+
+    if ctype in DECOMPRESSORS:
+        return _serial_decompress(chunks, DECOMPRESSORS[ctype])
+
+    if ctype in DECOMPRESS_COMMANDS:
+        for cmd in DECOMPRESS_COMMANDS[ctype]:
+            if util.which(cmd[0]):
+                cmd = [tok.format(workers=workers) for tok in cmd]
+                return command_chunks(cmd, chunks)
+        raise ValueError(
+            "%s decompression requires one of the commands: %s" %
+            (ctype, [cmd[0] for cmd in DECOMPRESS_COMMANDS[ctype]]))
+
+    raise ValueError("unsupported compression type: %s" % ctype)
+
+
+def _serial_decompress(chunks, factory):
+    decomp = factory()
+    for chunk in chunks:
+        while chunk:
+            out = decomp.decompress(chunk)
+            if out:
+                yield out
+            if decomp.eof:
+                chunk = decomp.unused_data
+                decomp = factory()
+            else:
+                chunk = b''
+
+    flush = getattr(decomp, 'flush', None)
+    if flush:
+        out = flush()
+        if out:
+            yield out
+
+
+def _parallel_decompress(units, decode, ctype, workers):
+    # 'units' yields ('unit', data) for independently decompressible data
+    # and ('stream', chunks) for data which must go through a streaming
+    # decompressor, in order, after everything before it.
+    pending = collections.deque()
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for kind, data in units:
+            if kind == 'unit':
+                pending.append(pool.submit(decode, data))
+                if len(pending) < 2 * workers:
+                    continue
+                yield pending.popleft().result()
+                continue
+            while pending:
+                yield pending.popleft().result()
+            for out in _serial_decompress(data, DECOMPRESSORS[ctype]):
+                yield out
+        while pending:
+            yield pending.popleft().result()
+
+
+def command_chunks(cmd, chunks, buflen=DEFAULT_BUFLEN):
+    """Generate the output of cmd with chunks written to its stdin."""
+    LOG.debug("Filtering stream through: %s", cmd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    feeder = threading.Thread(target=feed, name="stream-command-feed")
+    feeder.daemon = True
+    feeder.start()
+    try:
+        while True:
+            buf = proc.stdout.read(buflen)
+            if not buf:
+                break
+            yield buf
+    finally:
+        proc.stdout.close()
+        ret = proc.wait()
+        feeder.join()
+    if errors:
+        raise errors[0]
+    if ret != 0:
+        raise util.ProcessExecutionError(cmd=cmd, exit_code=ret)
+
+
+def random_chunks(buflen=DEFAULT_BUFLEN):
+    """Generate an endless stream of chunks of buflen random bytes.
+
+    The chunks are the output of RANDOM_COMMAND encrypting /dev/zero with
+    a key and iv read from /dev/urandom.  Without openssl, /dev/urandom
+    is read instead."""
+    if not util.which(RANDOM_COMMAND[0]):
+        LOG.debug("%s not found, reading random data from /dev/urandom",
+                  RANDOM_COMMAND[0])
+        with open('/dev/urandom', 'rb') as fp:
+            while True:
+                yield fp.read(buflen)
+
+    params = {'key': binascii.hexlify(os.urandom(32)).decode(),
+              'iv': binascii.hexlify(os.urandom(16)).decode()}
+    cmd = [arg.format(**params) for arg in RANDOM_COMMAND]
+    with open('/dev/zero', 'rb') as zero:
+        proc = subprocess.Popen(cmd, stdin=zero, stdout=subprocess.PIPE)
+    try:
+        while True:
+            buf = proc.stdout.read(buflen)
+            if len(buf) != buflen:
+                break
+            yield buf
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        ret = proc.wait()
+    # the key is left out of the error
+    raise util.ProcessExecutionError(cmd=RANDOM_COMMAND, exit_code=ret)
+
+
+class ChunkBuffer(object):
+    """Read exact numbers of bytes from an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def _fill(self, size):
+        parts = [self._buf]
+        have = len(self._buf)
+        while have < size:
+            chunk = next(self._chunks, b'')
+            if not chunk:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        self._buf = b''.join(parts)
+
+    def at_eof(self):
+        self._fill(1)
+        return not self._buf
+
+    def read(self, size):
+        """Return exactly size bytes, raising EOFError if truncated."""
+        if len(self._buf) < size:
+            self._fill(size)
+        if len(self._buf) < size:
+            raise EOFError("stream truncated: wanted %d bytes, got %d" %
+                           (size, len(self._buf)))
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def read_le(self, size):
+        """Return a little endian unsigned int of size bytes."""
+        return _le_int(self.read(size))
+
+
+def _le_int(data):
+    return sum(byte << (8 * i) for i, byte in enumerate(bytearray(data)))
+
+
+def _skip_frame(source):
+    # skippable frames carry metadata only: 4 byte length then the payload
+    source.read(struct.unpack('<I', source.read(4))[0])
+
+
+def _stream_frame(parts, max_unit):
+    """Collect the parts of a frame into a unit, or a stream if too big.
+
+    parts is an iterator of the frame's bytes, in order."""
+    data = []
+    size = 0
+    for part in parts:
+        data.append(part)
+        size += len(part)
+        if size > max_unit:
+            def stream():
+                for buffered in data:
+                    yield buffered
+                for part in parts:
+                    yield part
+            return ('stream', stream())
+    return ('unit', b''.join(data))
+
+
+def _zstd_frame_parts(source, magic):
+    # https://tools.ietf.org/html/rfc8878#section-3.1.1
+    yield magic
+    fhd = source.read(1)
+    yield fhd
+    fhd = bytearray(fhd)[0]
+    fcs_flag = fhd >> 6
+    single_segment = (fhd >> 5) & 1
+    checksum = (fhd >> 2) & 1
+    dict_id_size = (0, 1, 2, 4)[fhd & 3]
+    fcs_size = ((1 if single_segment else 0), 2, 4, 8)[fcs_flag]
+    header_size = (0 if single_segment else 1) + dict_id_size + fcs_size
+    if header_size:
+        yield source.read(header_size)
+
+    while True:
+        block_header = source.read(3)
+        yield block_header
+        bhdr = _le_int(block_header)
+        last = bhdr & 1
+        block_type = (bhdr >> 1) & 3
+        if block_type == 3:
+            raise ValueError("corrupt zstd stream: reserved block type")
+        # RLE blocks store the single repeated byte only
+        yield source.read(1 if block_type == 1 else bhdr >> 3)
+        if last:
+            break
+
+    if checksum:
+        yield source.read(4)
+
+
+def zstd_units(source, max_unit=MAX_PARALLEL_UNIT):
+    """Split a zstd stream read from ChunkBuffer source into frames."""
+    while not source.at_eof():
+        header = source.read(4)
+        magic = _le_int(header)
+        if magic & SKIPPABLE_MAGIC_MASK == SKIPPABLE_MAGIC:
+            _skip_frame(source)
+        elif magic == ZSTD_MAGIC:
+            yield _stream_frame(_zstd_frame_parts(source, header), max_unit)
+        else:
+            raise ValueError("corrupt zstd stream: bad frame magic %#x" %
+                             magic)
+
+
+def _zstd_decode(frame):
+    return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+
+
+def _lz4_frame_parts(source, magic, flg, bd):
+    # https://github.com/lz4/lz4/blob/dev/doc/lz4_Frame_format.md
+    yield magic + flg + bd
+    flg = bytearray(flg)[0]
+    block_checksum = (flg >> 4) & 1
+    content_size = (flg >> 3) & 1
+    content_checksum = (flg >> 2) & 1
+    dict_id = flg & 1
+    yield source.read(8 * content_size + 4 * dict_id + 1)
+    while True:
+        size_field = source.read(4)
+        yield size_field
+        size = _le_int(size_field) & 0x7FFFFFFF
+        if size == 0:
+            break
+        yield source.read(size + 4 * block_checksum)
+    if content_checksum:
+        yield source.read(4)
+
+
+def lz4_units(source):
+    """Split an lz4 stream read from ChunkBuffer source into units.
+
+    Frames with independent blocks (the lz4 default) are split into
+    blocks, other frames are decompressed as a stream.  Block and content
+    checksums are not verified for frames decompressed in parallel."""
+    while not source.at_eof():
+        header = source.read(4)
+        magic = _le_int(header)
+        if magic & SKIPPABLE_MAGIC_MASK == SKIPPABLE_MAGIC:
+            _skip_frame(source)
+            continue
+        if magic != LZ4_MAGIC:
+            raise ValueError("corrupt lz4 stream: bad frame magic %#x" %
+                             magic)
+        flg = source.read(1)
+        bd = source.read(1)
+        parts = _lz4_frame_parts(source, header, flg, bd)
+        flg = bytearray(flg)[0]
+        if (flg >> 6) != 1:
+            raise ValueError("unsupported lz4 frame version")
+        independent = (flg >> 5) & 1
+        if not independent:
+            yield ('stream', parts)
+            continue
+
+        block_max = LZ4_BLOCK_MAX_SIZES.get((bytearray(bd)[0] >> 4) & 7)
+        if block_max is None:
+            raise ValueError("corrupt lz4 stream: bad block max size")
+        block_checksum = (flg >> 4) & 1
+        next(parts)     # magic, flg and bd
+        next(parts)     # optional content size, dict id and header checksum
+        for size_field in parts:
+            size = _le_int(size_field)
+            if size == 0:
+                break
+            block = next(parts)
+            if block_checksum:
+                block = block[:-4]
+            yield ('unit', (block, block_max, size & 0x80000000))
+        # drain the optional content checksum
+        for _ in parts:
+            pass
+
+
+def _lz4_decode(unit):
+    (block, block_max, uncompressed) = unit
+    if uncompressed:
+        return block
+    return lz4_block.decompress(block, uncompressed_size=block_max)
+
+
+PARALLEL_DECOMPRESSORS = {
+    'zst': (zstd_units, _zstd_decode if zstandard else None),
+    'lz4': (lz4_units, _lz4_decode if lz4_block and lz4_frame else None),
+}
+
+
+class ProgressMeter(object):
+    """Count bytes passing through a stream and report the throughput.
+
+    A progress event is sent to the reporter at most every 'interval'
+    seconds and once more when finish() is called."""
+
+    def __init__(self, name, description, total=None,
+                 interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.description = description
+        # content-length headers give the total as a string, -1 if unknown
+        self.total = int(total) if total and int(total) > 0 else None
+        self.interval = interval
+        self.count = 0
+        self.start = time.time()
+        self._last = self.start
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0
+        return self.count / elapsed
+
+    def update(self, nbytes):
+        with self._lock:
+            self.count += nbytes
+            now = time.time()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+        self.report()
+
+    def __call__(self, chunks):
+        """Wrap an iterable of chunks, counting each one."""
+        for chunk in chunks:
+            self.update(len(chunk))
+            yield chunk
+
+    def summary(self):
+        msg = "%s: %s" % (self.description, util.bytes2human(self.count))
+        if self.total:
+            msg += " of %s" % util.bytes2human(self.total)
+        return msg + " (%s/s)" % util.bytes2human(int(self.rate))
+
+    def report(self):
+        if not self.name:
+            return
+        from .reporter import events
+        events.report_progress_event(self.name, self.summary())
+
+    def finish(self):
+        LOG.debug("%s in %.2fs", self.summary(), time.time() - self.start)
+        self.report()
+
+
+class ChecksumError(ValueError):
+    """Data did not match the checksum declared for it."""
+
+    def __init__(self, name, checksum_type, expected, actual):
+        self.name = name
+        self.checksum_type = checksum_type
+        self.expected = expected
+        self.actual = actual
+        super(ChecksumError, self).__init__(
+            "%s of %s is %s, expected %s" %
+            (checksum_type, name, actual, expected))
+
+
+def source_checksum(source):
+    """Return the (type, hexdigest) checksum declared by source or None."""
+    for ctype in CHECKSUM_TYPES:
+        if source.get(ctype):
+            return (ctype, source[ctype].strip().lower())
+    return None
+
+
+def verify_file(path, checksum, name=None, buflen=DEFAULT_BUFLEN):
+    """Raise ChecksumError if the content of path does not match checksum.
+    """
+    (ctype, expected) = checksum
+    digest = hashlib.new(ctype)
+    with open(path, 'rb') as fp:
+        for chunk in read_chunks(fp, buflen):
+            digest.update(chunk)
+    if digest.hexdigest() != expected:
+        raise ChecksumError(name or path, ctype, expected, digest.hexdigest())
+
+
+class ChecksumReader(object):
+    """Read fileobj, computing the checksum of the data as it passes.
+
+    checksum is a (type, hexdigest) tuple.  The read reaching the end of
+    fileobj raises ChecksumError if the data did not match it, so readers
+    fail before acting on the end of a corrupt stream.  Other attributes
+    (size, info) are those of fileobj."""
+
+    def __init__(self, fileobj, checksum, name=None):
+        self.fileobj = fileobj
+        (self.checksum_type, self.expected) = checksum
+        self.name = name
+        self.verified = False
+        self._digest = hashlib.new(self.checksum_type)
+
+    def __getattr__(self, attr):
+        return getattr(self.fileobj, attr)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._digest.update(data)
+        if not data or size is None or size < 0:
+            self.verify()
+        return data
+
+    def verify(self):
+        if self.verified:
+            return
+        actual = self._digest.hexdigest()
+        if actual != self.expected:
+            raise ChecksumError(self.name, self.checksum_type, self.expected,
+                                actual)
+        self.verified = True
+        LOG.debug("%s of %s verified", self.checksum_type, self.name)
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class QueueReader(object):
+    """File-like reader of chunks produced on a separate thread.
+
+    'producer' is called on the thread and must return an iterable of
+    bytes; at most 'depth' chunks are buffered ahead of the reader.
+    Exceptions raised by the producer are re-raised from read()."""
+
+    def __init__(self, producer, depth=DEFAULT_QUEUE_DEPTH, name=None):
+        self._queue = queue.Queue(depth)
+        self._buf = b''
+        self._eof = False
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, args=(producer,), name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, producer):
+        chunks = iter(producer())
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except BaseException as e:
+            self._error = e
+        finally:
+            # run any cleanup in a generator producer before signalling EOF
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self._put(_EOF)
+
+    def _next_chunk(self):
+        if self._eof:
+            return b''
+        item = self._queue.get()
+        if item is _EOF:
+            self._eof = True
+            if self._error is not None:
+                raise self._error
+            return b''
+        return item
+
+    def __iter__(self):
+        if self._buf:
+            buf, self._buf = self._buf, b''
+            yield buf
+        while True:
+            chunk = self._next_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+    def peek(self, size):
+        """Return up to size bytes without consuming them."""
+        data = self.read(size)
+        self._buf = data + self._buf
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(self)
+
+        bufs = [self._buf]
+        have = len(self._buf)
+        while have < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            bufs.append(chunk)
+            have += len(chunk)
+        data = b''.join(bufs)
+        self._buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+def random_reader(buflen=DEFAULT_BUFLEN, depth=DEFAULT_QUEUE_DEPTH):
+    """Return a QueueReader of random data, see random_chunks.
+
+    The data is generated on its own thread, keeping up to depth chunks
+    of buflen bytes ahead of the reader."""
+    return QueueReader(lambda: random_chunks(buflen), depth=depth,
+                       name="stream-random")
+
+
+def decompressed_reader(fileobj, ctype='auto', buflen=DEFAULT_BUFLEN,
+                        depth=DEFAULT_QUEUE_DEPTH, meter=None, workers=None):
+    """Return a QueueReader of the decompressed content of fileobj.
+
+    Reading from fileobj and decompression each run on their own thread.
+    If ctype is 'auto', the compression is detected from the stream.
+    If meter is given, the raw bytes read from fileobj are counted by it.
+    workers is passed to decompress_chunks.
+    """
+    chunks = read_chunks(fileobj, buflen)
+    if meter is not None:
+        chunks = meter(chunks)
+    raw = QueueReader(lambda: chunks, depth=depth, name="stream-read")
+
+    if ctype == 'auto':
+        ctype = detect_compression(raw.peek(16))
+        LOG.debug("detected compression of stream: %s", ctype)
+
+    def producer():
+        try:
+            for chunk in decompress_chunks(raw, ctype, workers=workers):
+                yield chunk
+        finally:
+            raw.close()
+
+    return QueueReader(producer, depth=depth, name="stream-decompress")
+
+# vi: ts=4 expandtab syntax=python
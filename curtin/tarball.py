@@ -0,0 +1,100 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""In-process extraction of (compressed) tar streams."""
+
+import errno
+import os
+import tarfile
+
+from .log import LOG
+from . import streams
+from . import util
+
+# prefix of pax header keywords carrying extended attributes, as written
+# by 'tar --xattrs' (GNU tar and star).
+PAX_XATTR_PREFIX = 'SCHILY.xattr.'
+
+
+def member_xattrs(tarinfo):
+    """Return a dictionary of the extended attributes of tarinfo."""
+    xattrs = {}
+    for key, value in tarinfo.pax_headers.items():
+        if not key.startswith(PAX_XATTR_PREFIX):
+            continue
+        if not isinstance(value, bytes):
+            # tarfile decodes pax values, binary ones with surrogateescape
+            value = value.encode('utf-8', 'surrogateescape')
+        xattrs[key[len(PAX_XATTR_PREFIX):]] = value
+    return xattrs
+
+
+def set_xattrs(path, xattrs):
+    """Set extended attributes on path, without following symlinks."""
+    if not hasattr(os, 'setxattr'):
+        if xattrs:
+            LOG.warn("Unable to set xattrs on %s: not supported", path)
+        return
+    for name, value in sorted(xattrs.items()):
+        try:
+            os.setxattr(path, name, value, follow_symlinks=False)
+        except OSError as e:
+            # like tar, do not fail extraction on unsupported attributes
+            if e.errno not in (errno.ENOTSUP, errno.EPERM, errno.EOPNOTSUPP):
+                raise
+            LOG.debug("Failed to set xattr %s on %s: %s", name, path, e)
+
+
+class TargetTarFile(tarfile.TarFile):
+    """TarFile that extracts like 'tar --xattrs --numeric-owner -Sxp'.
+
+    Ownership is always restored from the numeric uid/gid and extended
+    attributes are applied after the owner is set, as chown clears file
+    capabilities."""
+
+    def chown(self, tarinfo, targetpath, numeric_owner=True):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            try:
+                if tarinfo.issym() and hasattr(os, 'lchown'):
+                    os.lchown(targetpath, tarinfo.uid, tarinfo.gid)
+                else:
+                    os.chown(targetpath, tarinfo.uid, tarinfo.gid)
+            except OSError as e:
+                raise tarfile.ExtractError(
+                    "could not change owner of %s: %s" % (targetpath, e))
+        set_xattrs(targetpath, member_xattrs(tarinfo))
+
+
+def extract_fileobj(fileobj, target):
+    """Extract the uncompressed tar stream fileobj into target.
+
+    fileobj is read sequentially, it need not be seekable."""
+    kwargs = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        # keep setuid bits, absolute symlinks and devices of root images
+        kwargs['filter'] = 'fully_trusted'
+
+    tfile = TargetTarFile.open(fileobj=fileobj, mode='r|')
+    try:
+        tfile.extractall(target, **kwargs)
+    finally:
+        tfile.close()
+
+
+def extract_stream(fileobj, target, ctype='auto', meter=None):
+    """Extract the possibly compressed tar stream fileobj into target.
+
+    Reading fileobj and decompression run on their own threads, so the
+    data is fetched, decompressed and written to target concurrently.
+    If meter is a streams.ProgressMeter, it is updated with the number of
+    bytes read from fileobj.
+
+    fileobj is read to its end, past the end of archive marker, so that a
+    streams.ChecksumReader sees all of the data."""
+    util.ensure_dir(target)
+    with streams.decompressed_reader(fileobj, ctype=ctype,
+                                     meter=meter) as reader:
+        extract_fileobj(reader, target)
+        for _chunk in reader:
+            pass
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,275 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Parallel copy of a directory tree, like 'rsync -aXHAS -x'.
+
+The tree is walked in order, creating directories, symlinks and special
+files, while regular files are copied by a pool of threads.  File data is
+cloned (reflink) where the filesystems allow it and otherwise copied with
+copy_file_range, one data segment at a time so holes are preserved.
+Ownership, permissions, extended attributes (which hold the POSIX ACLs)
+and timestamps are kept and hardlinks are recreated."""
+
+import errno
+import fcntl
+import os
+import stat
+
+try:
+    from concurrent import futures
+except ImportError:
+    # python2 without the futures backport
+    futures = None
+
+from .log import LOG
+from . import streams
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_BUFLEN = 1024 * 1024
+# largest single copy_file_range request
+COPY_CHUNK = 64 * 1024 * 1024
+
+# errors meaning a clone or copy_file_range is not possible between the
+# files, the data is then copied by other means
+_NO_CLONE = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+             errno.ENOSYS, errno.EBADF, errno.ENOTSUP)
+
+
+def copy_workers():
+    """Return the number of threads copying files."""
+    return min(32, 4 * streams.decompress_workers())
+
+
+def supported():
+    """Return True if the tree copier can run in this python."""
+    return futures is not None and hasattr(os, 'scandir')
+
+
+def _clone(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError) as e:
+        if e.errno not in _NO_CLONE:
+            raise
+        return False
+    return True
+
+
+def _data_segments(fd, size):
+    """Generate (offset, length) of the data (non-hole) regions of fd."""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield (0, size)
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole remains
+                return
+            if e.errno == errno.EINVAL and offset == 0:
+                # no SEEK_DATA support in this filesystem
+                yield (0, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield (start, end - start)
+        offset = end
+
+
+class TreeCopier(object):
+    """Copy the contents of directory source into directory target."""
+
+    def __init__(self, source, target, workers=None, meter=None,
+                 one_file_system=True):
+        self.source = os.path.abspath(source)
+        self.target = os.path.abspath(target)
+        self.workers = workers or copy_workers()
+        self.meter = meter
+        self.one_file_system = one_file_system
+        self.same_owner = hasattr(os, 'geteuid') and os.geteuid() == 0
+        self.files = 0
+        self.cloned = 0
+        self._copy_file_range = hasattr(os, 'copy_file_range')
+        # (st_dev, st_ino) of files with several links -> first target path
+        self._links = {}
+        self._pending_links = []
+        self._dirs = []
+
+    def copy(self):
+        root = os.lstat(self.source)
+        if not os.path.isdir(self.target):
+            os.makedirs(self.target)
+        self._dirs.append((self.target, root))
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = []
+            try:
+                self._walk(self.source, self.target, root.st_dev, pool,
+                           pending)
+                for future in pending:
+                    if future.result():
+                        self.cloned += 1
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        self.files = len(pending)
+        for (src_path, dst_path) in self._pending_links:
+            self._replace(dst_path)
+            os.link(src_path, dst_path)
+        # set directory metadata last, children change the mtime
+        for (path, st) in reversed(self._dirs):
+            self._set_metadata(path, st, xattr_src=None)
+        LOG.debug("Copied %d files from %s to %s, %d cloned", self.files,
+                  self.source, self.target, self.cloned)
+
+    def _walk(self, src_dir, dst_dir, root_dev, pool, pending):
+        for entry in os.scandir(src_dir):
+            src = entry.path
+            dst = os.path.join(dst_dir, entry.name)
+            st = entry.stat(follow_symlinks=False)
+            mode = st.st_mode
+            if stat.S_ISDIR(mode):
+                if not os.path.isdir(dst) or os.path.islink(dst):
+                    self._replace(dst)
+                    os.mkdir(dst, 0o700)
+                self._dirs.append((dst, st))
+                self._copy_xattrs(src, dst)
+                if self.one_file_system and st.st_dev != root_dev:
+                    # like 'rsync -x', keep the mount point but not its
+                    # contents
+                    continue
+                self._walk(src, dst, root_dev, pool, pending)
+                continue
+
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in self._links:
+                    self._pending_links.append((self._links[key], dst))
+                    continue
+                self._links[key] = dst
+
+            if stat.S_ISREG(mode):
+                pending.append(pool.submit(self._copy_file, src, dst, st))
+            elif stat.S_ISLNK(mode):
+                self._replace(dst)
+                os.symlink(os.readlink(src), dst)
+                self._set_metadata(dst, st, xattr_src=src)
+            else:
+                # devices, fifos and sockets
+                self._replace(dst)
+                os.mknod(dst, mode, st.st_rdev)
+                self._set_metadata(dst, st, xattr_src=src)
+
+    def _replace(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _copy_file(self, src, dst, st):
+        """Copy regular file src to dst, returning True if it was cloned."""
+        self._replace(dst)
+        cloned = False
+        src_fd = os.open(src, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            try:
+                if st.st_size and _clone(src_fd, dst_fd):
+                    cloned = True
+                    self._count(st.st_size)
+                else:
+                    self._copy_data(src_fd, dst_fd, st.st_size)
+                self._set_metadata(dst_fd, st, xattr_src=src_fd)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return cloned
+
+    def _copy_data(self, src_fd, dst_fd, size):
+        for (offset, length) in _data_segments(src_fd, size):
+            end = offset + length
+            while offset < end:
+                count = self._copy_range(src_fd, dst_fd, offset,
+                                         min(end - offset, COPY_CHUNK))
+                if count == 0:
+                    # the file shrunk while being copied
+                    break
+                offset += count
+                self._count(count)
+        # holes at the end of the file
+        os.ftruncate(dst_fd, size)
+
+    def _copy_range(self, src_fd, dst_fd, offset, length):
+        if self._copy_file_range:
+            try:
+                return os.copy_file_range(src_fd, dst_fd, length,
+                                          offset, offset)
+            except OSError as e:
+                if e.errno not in _NO_CLONE:
+                    raise
+                LOG.debug("copy_file_range unavailable, copying with "
+                          "read/write: %s", e)
+                self._copy_file_range = False
+        buf = os.pread(src_fd, min(length, COPY_BUFLEN), offset)
+        view = memoryview(buf)
+        pos = offset
+        while view:
+            written = os.pwrite(dst_fd, view, pos)
+            view = view[written:]
+            pos += written
+        return len(buf)
+
+    def _count(self, nbytes):
+        if self.meter:
+            self.meter.update(nbytes)
+
+    def _copy_xattrs(self, src, dst):
+        follow = not isinstance(src, int) and not os.path.islink(src)
+        kwargs = {} if isinstance(src, int) else {'follow_symlinks': follow}
+        try:
+            names = os.listxattr(src, **kwargs)
+        except OSError as e:
+            if e.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                return
+            raise
+        for name in names:
+            value = os.getxattr(src, name, **kwargs)
+            try:
+                os.setxattr(dst, name, value, **kwargs)
+            except OSError as e:
+                # like rsync, do not fail on unsupported attributes
+                if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP,
+                                   errno.EPERM):
+                    raise
+                LOG.debug("Failed to set xattr %s on %s: %s", name, dst, e)
+
+    def _set_metadata(self, dst, st, xattr_src):
+        # dst and xattr_src are open fds for regular files, paths otherwise.
+        # owner first, chown clears setuid bits and file capabilities.
+        is_link = stat.S_ISLNK(st.st_mode)
+        kwargs = {}
+        if not isinstance(dst, int):
+            kwargs['follow_symlinks'] = False
+        if self.same_owner:
+            os.chown(dst, st.st_uid, st.st_gid, **kwargs)
+        if xattr_src is not None:
+            self._copy_xattrs(xattr_src, dst)
+        if not is_link:
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), **kwargs)
+
+
+def copy_tree(source, target, workers=None, meter=None):
+    """Copy the contents of directory source into target, see TreeCopier.
+    """
+    TreeCopier(source, target, workers=workers, meter=meter).copy()
+
+# vi: ts=4 expandtab syntax=python
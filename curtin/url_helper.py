@@ -1,10 +1,13 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from email.utils import parsedate
+import hashlib
 import json
 import os
+import re
 import socket
 import sys
+import threading
 import time
 import uuid
 from functools import partial
@@ -23,12 +26,27 @@ except ImportError:
     import urllib2 as urllib_error
     from urlparse import urlparse  # pylint: disable=import-error
 
+try:
+    from concurrent import futures
+except ImportError:
+    # python2 without the futures backport
+    futures = None
+
 from .log import LOG
+from . import streams
 
 error = urllib_error
 
 DEFAULT_HEADERS = {'User-Agent': 'Curtin/' + version.version_string()}
 
+# download() fetches objects larger than one chunk as concurrent Range
+# requests of DOWNLOAD_CHUNK_SIZE bytes over DOWNLOAD_WORKERS connections.
+DOWNLOAD_BUFLEN = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+# seconds to sleep before each retry of a failed range
+DOWNLOAD_RETRIES = (1, 2, 4)
+
 
 class _ReRaisedException(Exception):
     exc = None
@@ -56,6 +74,7 @@ class UrlReader(object):
 
         self.info = self.fp.info()
         self.size = self.info.get('content-length', -1)
+        self.status = self.fp.getcode()
 
     def read(self, buflen):
         try:
@@ -82,39 +101,465 @@ class UrlReader(object):
         self.close()
 
 
-def download(url, path, reporthook=None, data=None):
+def head(url, headers=None):
+    """Return the response headers of a HEAD request for url."""
+    req = urllib_request.Request(url=url, headers=_get_headers(headers))
+    req.get_method = lambda: 'HEAD'
+    try:
+        fp = urllib_request.urlopen(req)
+    except urllib_error.HTTPError as exc:
+        raise UrlError(exc, code=exc.code, headers=exc.headers, url=url,
+                       reason=exc.reason)
+    except Exception as exc:
+        raise UrlError(exc, code=None, headers=None, url=url,
+                       reason="unknown")
+    try:
+        return fp.info()
+    finally:
+        fp.close()
+
+
+def content_range(headers):
+    """Return (first, last, total) of the Content-Range in headers or None.
+
+    total is None if the server did not report the object size."""
+    match = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)$',
+                     headers.get('content-range') or '')
+    if not match:
+        return None
+    first, last, total = match.groups()
+    return (int(first), int(last), None if total == '*' else int(total))
+
+
+def _pwrite(fd, buf, offset):
+    if not hasattr(os, 'pwrite'):
+        # python2
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, buf)
+        return
+    view = memoryview(buf)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _pread(fd, length, offset):
+    if not hasattr(os, 'pread'):
+        # python2
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+    return os.pread(fd, length, offset)
+
+
+class _DownloadProgress(object):
+    """Thread safe accounting of downloaded bytes for a reporthook."""
+
+    def __init__(self, reporthook, size):
+        self.reporthook = reporthook
+        self.size = size
+        self.blocknum = 0
+        self.fsize = 0
+        self._lock = threading.Lock()
+        if reporthook:
+            reporthook(0, DOWNLOAD_BUFLEN, size)
+
+    def __call__(self, count):
+        with self._lock:
+            self.blocknum += 1
+            self.fsize += count
+            if self.reporthook:
+                self.reporthook(self.blocknum, DOWNLOAD_BUFLEN, self.size)
+
+
+class ResumableReader(object):
+    """Read url like UrlReader, reconnecting after a failure.
+
+    A failed request or read is resumed at the current offset with a
+    Range request made conditional on the object being unchanged
+    (If-Range).  Failures in a row are retried after sleeping for each
+    entry in retries (default DOWNLOAD_RETRIES) in turn.  reader may be
+    an open UrlReader for url to start from."""
+
+    def __init__(self, url, headers=None, retries=None, reader=None):
+        self.url = url
+        self.headers = headers
+        self.retries = DOWNLOAD_RETRIES if retries is None else retries
+        self.offset = 0
+        self.reader = reader
+        self._attempt = 0
+        while self.reader is None:
+            try:
+                self.reader = UrlReader(url, headers=headers)
+            except UrlError as e:
+                self._retry_or_raise(e)
+        self.info = self.reader.info
+        self.size = self.reader.size
+        self.status = self.reader.status
+        self.validator = self.info.get('etag') or self.info.get(
+            'last-modified')
+        try:
+            self.total = int(self.size)
+        except (TypeError, ValueError):
+            self.total = -1
+
+    def _retry_or_raise(self, error):
+        if self._attempt >= len(self.retries):
+            raise error
+        naptime = self.retries[self._attempt]
+        LOG.warn("Retrying download of %s from byte %d in %ds: %s",
+                 self.url, self.offset, naptime, error)
+        time.sleep(naptime)
+        self._attempt += 1
+
+    def _reopen(self):
+        headers = dict(self.headers or {})
+        headers['Range'] = 'bytes=%d-' % self.offset
+        if self.validator:
+            headers['If-Range'] = self.validator
+        reader = UrlReader(self.url, headers=headers)
+        crange = content_range(reader.info)
+        if reader.status != 206 or crange is None or crange[0] != self.offset:
+            reader.close()
+            raise UrlError(
+                ValueError("unable to resume at byte %d, got %s %s" %
+                           (self.offset, reader.status, crange)),
+                url=self.url)
+        return reader
+
+    def read(self, buflen):
+        while True:
+            try:
+                if self.reader is None:
+                    self.reader = self._reopen()
+                buf = self.reader.read(buflen)
+                if not buf and 0 <= self.offset < self.total:
+                    raise UrlError(
+                        IOError("connection closed at byte %d of %d" %
+                                (self.offset, self.total)), url=self.url)
+                if buf:
+                    self._attempt = 0
+                self.offset += len(buf)
+                return buf
+            except UrlError as e:
+                if self.reader:
+                    self.reader.close()
+                    self.reader = None
+                self._retry_or_raise(e)
+
+    def close(self):
+        if self.reader:
+            try:
+                self.reader.close()
+            finally:
+                self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class _DownloadState(object):
+    """The chunks of a ranged download completed so far.
+
+    The state is saved next to the download, so that a later download of
+    the same, unchanged object to the same path only fetches the rest."""
+
+    SUFFIX = '.state'
+
+    def __init__(self, path, url, total, chunk_size, validator):
+        self.path = path + self.SUFFIX
+        self.key = {'url': url, 'size': total, 'chunk_size': chunk_size,
+                    'validator': validator}
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the completed chunks, returning True if there were any."""
+        try:
+            with open(self.path, 'r') as fp:
+                saved = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        if not self.key['validator'] or saved.get('key') != self.key:
+            return False
+        self.done = set(saved.get('done', []))
+        return bool(self.done)
+
+    def add(self, start, fd):
+        with self._lock:
+            # the data must be on disk before it is recorded as such
+            os.fsync(fd)
+            self.done.add(start)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump({'key': self.key, 'done': sorted(self.done)}, fp)
+            os.rename(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class _RangeDigest(object):
+    """Thread safe checksum of the ranges of a download written to fd.
+
+    Data written at the offset hashed so far is hashed as it arrives.
+    Data written ahead of it is read back from fd once everything before
+    it is in, while later ranges are still being fetched, so only chunks
+    completed before a resume are read back in full."""
+
+    def __init__(self, fd, checksum, name):
+        self.fd = fd
+        (self.checksum_type, self.expected) = checksum
+        self.name = name
+        self.offset = 0
+        # chunk start: end of the data written to the chunk so far, for
+        # chunks ahead of offset
+        self._ahead = {}
+        self._digest = hashlib.new(self.checksum_type)
+        self._lock = threading.Lock()
+
+    def add(self, start, offset, buf):
+        """Account for buf written at offset of the chunk at start."""
+        with self._lock:
+            if offset != self.offset:
+                self._ahead[start] = offset + len(buf)
+                return
+            self._digest.update(buf)
+            self.offset += len(buf)
+            self._catch_up()
+
+    def add_done(self, start, end):
+        """Account for a chunk written before the download started."""
+        with self._lock:
+            self._ahead[start] = end
+            self._catch_up()
+
+    def _catch_up(self):
+        while self.offset in self._ahead:
+            end = self._ahead.pop(self.offset)
+            while self.offset < end:
+                buf = _pread(self.fd, min(DOWNLOAD_BUFLEN, end - self.offset),
+                             self.offset)
+                if not buf:
+                    raise IOError("short read at byte %d of %s" %
+                                  (self.offset, self.name))
+                self._digest.update(buf)
+                self.offset += len(buf)
+
+    def verify(self):
+        actual = self._digest.hexdigest()
+        if actual != self.expected:
+            raise streams.ChecksumError(self.name, self.checksum_type,
+                                        self.expected, actual)
+        LOG.debug("%s of %s verified", self.checksum_type, self.name)
+
+
+def _fetch_range(url, fd, first, end, progress, reader=None, cancel=None,
+                 retries=None, validator=None, digest=None):
+    """Write bytes first to end (exclusive) of url to the same offset of fd.
+
+    reader may be a response already positioned at first.  A failed
+    request is retried from the last byte written, sleeping for each
+    entry in retries (default DOWNLOAD_RETRIES) in turn.  Requests are
+    conditional on validator (If-Range) if given.  The data written is
+    added to digest if given.  Returns False if cancelled before the range
+    was complete."""
+    if retries is None:
+        retries = DOWNLOAD_RETRIES
+    offset = first
+    attempt = 0
+    while True:
+        try:
+            if reader is None:
+                headers = {'Range': 'bytes=%d-%d' % (offset, end - 1)}
+                if validator:
+                    headers['If-Range'] = validator
+                reader = UrlReader(url, headers=headers)
+                crange = content_range(reader.info)
+                if (reader.status != 206 or crange is None or
+                        crange[0] != offset):
+                    reader.close()
+                    raise UrlError(
+                        ValueError("requested range %d-%d, got %s" %
+                                   (offset, end - 1, crange)), url=url)
+            with reader:
+                while offset < end:
+                    if cancel and cancel.is_set():
+                        return False
+                    buf = reader.read(min(DOWNLOAD_BUFLEN, end - offset))
+                    if not buf:
+                        raise UrlError(
+                            IOError("connection closed at byte %d of range "
+                                    "%d-%d" % (offset, first, end - 1)),
+                            url=url)
+                    _pwrite(fd, buf, offset)
+                    if digest:
+                        digest.add(first, offset, buf)
+                    offset += len(buf)
+                    progress(len(buf))
+            return True
+        except UrlError as e:
+            reader = None
+            if attempt >= len(retries) or (cancel and cancel.is_set()):
+                raise
+            LOG.warn("Retrying download of %s from byte %d in %ds: %s",
+                     url, offset, retries[attempt], e)
+            time.sleep(retries[attempt])
+            attempt += 1
+
+
+def _ranged_download(url, first, fd, total, chunk_size, workers, progress,
+                     validator=None, state=None, digest=None):
+    # 'first' is the response to a Range request for the first chunk, read
+    # here while the remaining chunks are fetched by a pool of workers.
+    # chunks recorded as done in 'state' are skipped.
+    cancel = threading.Event()
+    done = state.done if state else set()
+    if digest:
+        for start in sorted(done):
+            digest.add_done(start, min(start + chunk_size, total))
+
+    def fetch(start, reader=None):
+        if _fetch_range(url, fd, start, min(start + chunk_size, total),
+                        progress, reader=reader, cancel=cancel,
+                        validator=validator, digest=digest) and state:
+            state.add(start, fd)
+
+    with futures.ThreadPoolExecutor(max_workers=max(workers - 1, 1)) as pool:
+        pending = [pool.submit(fetch, start)
+                   for start in range(chunk_size, total, chunk_size)
+                   if start not in done]
+        try:
+            if 0 in done:
+                first.close()
+            else:
+                fetch(0, reader=first)
+            for future in pending:
+                future.result()
+        except BaseException:
+            cancel.set()
+            raise
+
+
+def download(url, path, reporthook=None, data=None, workers=None,
+             chunk_size=DOWNLOAD_CHUNK_SIZE, resume=False, checksum=None):
     """Download url to path.
 
+    Objects larger than chunk_size are fetched as chunk_size Range
+    requests on up to workers concurrent connections, each written at
+    its offset in path and retried on failure.  Servers which do not
+    support ranges are read in a single stream, which is resumed with a
+    Range request after a failure where possible.
+
+    With resume, completed chunks are recorded in path.state until the
+    download is complete and a download of the same, unchanged url to path
+    after a failure only fetches the missing chunks.
+
+    If checksum, a (type, hexdigest) tuple, is given the data is verified
+    against it as it is written.  On a mismatch path is removed and
+    streams.ChecksumError is raised.
+
     reporthook is compatible with py3 urllib.request.urlretrieve.
     urlretrieve does not exist in py2."""
 
-    buflen = 8192
-    wfp = open(path, "wb")
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
+    if futures is None:
+        workers = 1
 
+    headers = None
+    if data is None and workers > 1:
+        # ask for the first chunk; a 206 reply tells us ranges work and
+        # the size of the object
+        headers = {'Range': 'bytes=0-%d' % (chunk_size - 1)}
+
+    start = time.time()
     try:
-        buf = None
-        blocknum = 0
-        fsize = 0
-        start = time.time()
-        with UrlReader(url) as rfp:
-            if reporthook:
-                reporthook(blocknum, buflen, rfp.size)
-
-            while True:
-                buf = rfp.read(buflen)
-                if not buf:
-                    break
-                blocknum += 1
-                if reporthook:
-                    reporthook(blocknum, buflen, rfp.size)
-                wfp.write(buf)
-                fsize += len(buf)
-        timedelta = time.time() - start
-        LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
-                  fsize, url, path, timedelta, fsize / timedelta / 1024 / 1024)
-        return path, rfp.info
-    finally:
-        wfp.close()
+        rfp, progress = _download(url, path, reporthook, data, workers,
+                                  chunk_size, resume, headers, checksum)
+    except streams.ChecksumError:
+        # resuming would only fetch the same bad data again
+        for fname in (path, path + _DownloadState.SUFFIX):
+            if os.path.exists(fname):
+                os.unlink(fname)
+        raise
+
+    timedelta = max(time.time() - start, 0.001)
+    LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
+              progress.fsize, url, path, timedelta,
+              progress.fsize / timedelta / 1024 / 1024)
+    return path, rfp.info
+
+
+def _download(url, path, reporthook, data, workers, chunk_size, resume,
+              headers, checksum):
+    # read as well as written, to checksum ranges written out of order
+    mode = "r+b" if resume and os.path.exists(path) else "w+b"
+    with open(path, mode) as wfp:
+        try:
+            rfp = UrlReader(url, headers=headers, data=data)
+        except UrlError as e:
+            if e.code != 416:
+                raise
+            # range not satisfiable, the object is empty
+            rfp = UrlReader(url, data=data)
+
+        crange = content_range(rfp.info) if headers else None
+        if (rfp.status == 206 and crange and crange[0] == 0 and
+                crange[2] is not None):
+            total = crange[2]
+            validator = rfp.info.get('etag') or rfp.info.get('last-modified')
+            state = None
+            if resume:
+                state = _DownloadState(path, url, total, chunk_size,
+                                       validator)
+            if state and state.load():
+                LOG.info("Resuming download of %s to %s, %d chunks done",
+                         url, path, len(state.done))
+            else:
+                wfp.truncate(0)
+            LOG.debug("Downloading %s bytes from %s in %d byte ranges",
+                      total, url, chunk_size)
+            progress = _DownloadProgress(reporthook, total)
+            wfp.truncate(total)
+            digest = None
+            if checksum:
+                digest = _RangeDigest(wfp.fileno(), checksum, url)
+            _ranged_download(url, rfp, wfp.fileno(), total, chunk_size,
+                             workers, progress, validator=validator,
+                             state=state, digest=digest)
+            if digest:
+                digest.verify()
+            if state:
+                state.remove()
+        else:
+            if rfp.status == 206:
+                # a range of an object of unknown size, or not the one
+                # asked for: ranges cannot be used, ask for the whole object
+                LOG.debug("Unusable range reply for %s (%s), downloading "
+                          "it in a single stream", url, crange)
+                rfp.close()
+                rfp = UrlReader(url, data=data)
+            if data is None:
+                rfp = ResumableReader(url, reader=rfp)
+            if checksum:
+                rfp = streams.ChecksumReader(rfp, checksum, name=url)
+            progress = _DownloadProgress(reporthook, rfp.size)
+            wfp.truncate(0)
+            with rfp:
+                while True:
+                    buf = rfp.read(DOWNLOAD_BUFLEN)
+                    if not buf:
+                        break
+                    wfp.write(buf)
+                    progress(len(buf))
+    return rfp, progress
 
 
 def get_maas_version(endpoint):
@@ -1123,8 +1123,9 @@ def sanitize_source(source):
     if type(source) is dict:
         # already sanitized?
         return source
-    supported = ['tgz', 'dd-tgz', 'dd-tbz', 'dd-txz', 'dd-tar', 'dd-bz2',
-                 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage']
+    supported = ['tgz', 'tzst', 'tlz4', 'dd-tgz', 'dd-tbz', 'dd-txz',
+                 'dd-tar', 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst', 'dd-lz4',
+                 'dd-raw', 'fsimage']
     deftype = 'tgz'
     for i in supported:
         prefix = i + ":"
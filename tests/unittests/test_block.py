@@ -1,15 +1,19 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import errno
 import functools
 import os
 import mock
 import sys
+import threading
+import time
 
 from collections import OrderedDict
 
 from .helpers import CiTestCase, simple_mocked_open
 from curtin import util
 from curtin import block
+from curtin.block import image
 
 
 class TestBlock(CiTestCase):
@@ -268,6 +272,20 @@ class TestWipeFile(CiTestCase):
         found = util.load_file(trgfile)
         self.assertEqual(data, found)
 
+    @mock.patch('curtin.block.is_block_device')
+    def test_block_device_direct(self, m_is_block):
+        """Block devices are wiped with O_DIRECT writes."""
+        m_is_block.return_value = True
+        flen = 3 * 1024 * 1024 + 100
+        myfile = self.tmp_path("direct")
+        util.write_file(myfile, flen * b'\1', omode="wb")
+        with mock.patch('curtin.block.image.open_direct',
+                        wraps=image.open_direct) as m_open:
+            block.wipe_file(myfile, buflen=1024 * 1024)
+        m_open.assert_called_with(myfile)
+        self.assertEqual(flen * b'\0',
+                         util.load_file(myfile, decode=False))
+
     def test_exclusive_open_raise_missing(self):
         myfile = self.tmp_path("no-such-file")
 
@@ -369,22 +387,228 @@ class TestWipeVolume(CiTestCase):
     def test_wipe_zero(self, mock_wipe_file):
         with simple_mocked_open():
             block.wipe_volume(self.dev, exclusive=True, mode='zero')
-            mock_wipe_file.assert_called_with(self.dev, exclusive=True)
+            mock_wipe_file.assert_called_with(self.dev, exclusive=True,
+                                              progress=None)
 
+    @mock.patch('curtin.block.streams.random_reader')
     @mock.patch('curtin.block.wipe_file')
-    def test_wipe_random(self, mock_wipe_file):
-        with simple_mocked_open() as mock_open:
-            block.wipe_volume(self.dev, mode='random')
-            mock_open.assert_called_with('/dev/urandom', 'rb')
-            mock_wipe_file.assert_called_with(
-                self.dev, exclusive=True,
-                reader=mock_open.return_value.__enter__().read)
+    def test_wipe_random(self, mock_wipe_file, mock_reader):
+        block.wipe_volume(self.dev, mode='random')
+        mock_wipe_file.assert_called_with(
+            self.dev, exclusive=True, progress=None,
+            reader=mock_reader.return_value.__enter__().read)
+
+    @mock.patch('curtin.block.wipe_ioctl')
+    def test_wipe_zeroout_discard(self, mock_wipe_ioctl):
+        block.wipe_volume(self.dev, mode='zeroout')
+        mock_wipe_ioctl.assert_called_with(self.dev, exclusive=True,
+                                           progress=None)
+        block.wipe_volume(self.dev, mode='discard', exclusive=False)
+        mock_wipe_ioctl.assert_called_with(self.dev, discard=True,
+                                           exclusive=False, progress=None)
 
     def test_bad_input(self):
         with self.assertRaises(ValueError):
             block.wipe_volume(self.dev, mode='invalidmode')
 
 
+class TestWipeIoctl(CiTestCase):
+
+    def setUp(self):
+        super(TestWipeIoctl, self).setUp()
+        self.path = self.tmp_path('disk', self.tmp_dir())
+        util.write_file(self.path, b'\xff' * 4096, omode='wb')
+        self.add_patch('curtin.block.is_block_device', 'm_is_block')
+        self.add_patch('curtin.block.image.zero_range', 'm_zero_range')
+        self.add_patch('curtin.block.image.discard_range', 'm_discard_range')
+        self.add_patch('curtin.block.quick_zero', 'm_quick_zero')
+        self.add_patch('curtin.block.wipe_file', 'm_wipe_file')
+        self.m_is_block.return_value = True
+        self.m_zero_range.__name__ = 'zero_range'
+        self.m_discard_range.__name__ = 'discard_range'
+
+    def _unsupported(self, *args):
+        raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
+
+    @mock.patch('curtin.block.WIPE_IOCTL_SIZE', 1024)
+    def test_zeroout(self):
+        block.wipe_ioctl(self.path)
+        self.assertEqual([(0, 1024), (1024, 1024), (2048, 1024),
+                          (3072, 1024)],
+                         [c[0][1:] for c in self.m_zero_range.call_args_list])
+        self.assertEqual(0, self.m_discard_range.call_count)
+        self.assertEqual(0, self.m_wipe_file.call_count)
+
+    def test_discard_zeroes_superblocks(self):
+        block.wipe_ioctl(self.path, discard=True, exclusive=False)
+        self.assertEqual((0, 4096), self.m_discard_range.call_args[0][1:])
+        self.assertEqual(0, self.m_zero_range.call_count)
+        self.m_quick_zero.assert_called_with(self.path, partitions=True,
+                                             exclusive=False)
+
+    def test_discard_unsupported_zeroout(self):
+        self.m_discard_range.side_effect = self._unsupported
+        block.wipe_ioctl(self.path, discard=True)
+        self.assertEqual((0, 4096), self.m_zero_range.call_args[0][1:])
+        self.assertEqual(0, self.m_quick_zero.call_count)
+
+    def test_unsupported_writes_zeros(self):
+        self.m_zero_range.side_effect = self._unsupported
+        block.wipe_ioctl(self.path)
+        self.m_wipe_file.assert_called_with(self.path, exclusive=True,
+                                            progress=None)
+
+    def test_file_writes_zeros(self):
+        self.m_is_block.return_value = False
+        block.wipe_ioctl(self.path, discard=True)
+        self.assertEqual(0, self.m_zero_range.call_count)
+        self.assertEqual(0, self.m_discard_range.call_count)
+        self.m_wipe_file.assert_called_with(self.path, exclusive=True,
+                                            progress=None)
+
+    def test_errors_raised(self):
+        self.m_zero_range.side_effect = IOError(errno.EIO, 'I/O error')
+        with self.assertRaises(IOError):
+            block.wipe_ioctl(self.path)
+
+
+class TestWipeVolumes(CiTestCase):
+
+    def setUp(self):
+        super(TestWipeVolumes, self).setUp()
+        self.tmpd = self.tmp_dir()
+        self.add_patch('curtin.block.events.report_event', 'm_report')
+        self.add_patch('curtin.block.invalidate_inventory', 'm_invalidate')
+
+    def _wipe_jobs(self, disks):
+        """wipe_volume of paths on disks recording the ones wiping at once"""
+        lock = threading.Lock()
+        running = set()
+        overlaps = []
+
+        def wipe_volume(path, mode, exclusive, progress):
+            with lock:
+                running.add(path)
+                overlaps.append(set(running))
+            time.sleep(0.05)
+            with lock:
+                running.discard(path)
+
+        self.add_patch('curtin.block.wipe_volume', 'm_wipe_volume',
+                       side_effect=wipe_volume)
+        self.add_patch('curtin.block.volume_disks', 'm_volume_disks',
+                       side_effect=lambda path: disks[path])
+        return overlaps
+
+    def test_independent_disks_wiped_together(self):
+        overlaps = self._wipe_jobs({'/dev/sda': {'sda'}, '/dev/sdb': {'sdb'},
+                                    '/dev/sdc': {'sdc'}})
+        results = block.wipe_volumes([('/dev/sda', 'zero'),
+                                      ('/dev/sdb', 'zero'),
+                                      ('/dev/sdc', 'zero')])
+        self.assertEqual(['/dev/sda', '/dev/sdb', '/dev/sdc'], list(results))
+        self.assertIn({'/dev/sda', '/dev/sdb', '/dev/sdc'}, overlaps)
+
+    def test_shared_disks_wiped_serially(self):
+        overlaps = self._wipe_jobs({'/dev/sda1': {'sda'},
+                                    '/dev/sda2': {'sda'},
+                                    '/dev/md0': {'sda', 'sdb'},
+                                    '/dev/sdb1': {'sdb'}})
+        block.wipe_volumes([('/dev/sda1', 'zero'), ('/dev/sda2', 'zero'),
+                            ('/dev/md0', 'zero'), ('/dev/sdb1', 'zero')])
+        self.assertEqual(4, len(overlaps))
+        for running in overlaps:
+            self.assertIn(running, ({'/dev/sda1'}, {'/dev/sda2'},
+                                    {'/dev/md0'}, {'/dev/sdb1'},
+                                    {'/dev/sda1', '/dev/sdb1'},
+                                    {'/dev/sda2', '/dev/sdb1'}))
+
+    def test_workers_limit(self):
+        overlaps = self._wipe_jobs({'/dev/sda': {'sda'}, '/dev/sdb': {'sdb'}})
+        block.wipe_volumes([('/dev/sda', 'zero'), ('/dev/sdb', 'zero')],
+                           workers=1)
+        self.assertEqual([{'/dev/sda'}, {'/dev/sdb'}], overlaps)
+
+    def test_error_stops_wipes(self):
+        self._wipe_jobs({'/dev/sda': {'sda'}, '/dev/sda1': {'sda'}})
+        self.m_wipe_volume.side_effect = IOError(errno.EIO, 'I/O error')
+        with self.assertRaises(IOError):
+            block.wipe_volumes([('/dev/sda', 'zero'), ('/dev/sda1', 'zero')])
+        self.assertEqual(1, self.m_wipe_volume.call_count)
+        finish = self.m_report.call_args[0][0]
+        self.assertEqual(('wipe-volumes', 'FAIL'),
+                         (finish.name, finish.result))
+
+    @mock.patch('curtin.block.WIPE_PROGRESS_INTERVAL', 0)
+    def test_files_wiped_with_progress_and_summary(self):
+        paths = [self.tmp_path(name, self.tmpd) for name in ('a', 'b')]
+        for path in paths:
+            util.write_file(path, b'\xff' * 3000, omode='wb')
+        with mock.patch('curtin.block.wipe_file',
+                        side_effect=functools.partial(block.wipe_file,
+                                                      buflen=1000)):
+            results = block.wipe_volumes([(path, 'zero') for path in paths])
+        for path in paths:
+            self.assertEqual(b'\0' * 3000, util.load_file(path, decode=False))
+            self.assertEqual(3000, results[path][0])
+
+        reported = [c[0][0] for c in self.m_report.call_args_list]
+        progress = [e.description for e in reported
+                    if e.event_type == 'progress' and
+                    e.name == 'wipe-volumes/a']
+        self.assertEqual(3, len(progress))
+        self.assertTrue(progress[0].startswith(
+            'wiping %s: 33%%, 0.0 MB in' % paths[0]))
+        self.assertTrue(progress[2].startswith(
+            'wiping %s: 100%%, 0.0 MB in' % paths[0]))
+        finish = reported[-1]
+        self.assertEqual(('wipe-volumes', 'finish', 'SUCCESS'),
+                         (finish.name, finish.event_type, finish.result))
+        self.assertTrue(finish.description.startswith(
+            'wiped 2 volumes: 0.0 MB in '))
+        self.assertIn('MB/s', finish.description)
+
+
+class TestRunDiskJobs(CiTestCase):
+
+    def setUp(self):
+        super(TestRunDiskJobs, self).setUp()
+        disks = {'/dev/sda1': {'sda'}, '/dev/sda2': {'sda'},
+                 '/dev/sda3': {'sda'}, '/dev/md0': {'sda', 'sdb'}}
+        self.add_patch('curtin.block.volume_disks', 'm_volume_disks',
+                       side_effect=lambda path: disks[path])
+
+    def test_per_disk(self):
+        """At most per_disk jobs write to a disk at once."""
+        lock = threading.Lock()
+        running = set()
+        overlaps = []
+
+        def func(path, value):
+            with lock:
+                running.add(path)
+                overlaps.append(set(running))
+            time.sleep(0.05)
+            with lock:
+                running.discard(path)
+            return value
+
+        results = block.run_disk_jobs(
+            [('/dev/sda1', 1), ('/dev/sda2', 2), ('/dev/sda3', 3),
+             ('/dev/md0', 4)], func, per_disk=2)
+        self.assertEqual([('/dev/sda1', 1), ('/dev/sda2', 2),
+                          ('/dev/sda3', 3), ('/dev/md0', 4)],
+                         list(results.items()))
+        self.assertIn({'/dev/sda1', '/dev/sda2'}, overlaps)
+        self.assertTrue(all(len(running) <= 2 for running in overlaps))
+
+    def test_error_raised(self):
+        func = mock.Mock(side_effect=[OSError('failed'), None])
+        with self.assertRaises(OSError):
+            block.run_disk_jobs([('/dev/sda1',), ('/dev/sda2',)], func)
+        self.assertEqual([mock.call('/dev/sda1')], func.call_args_list)
+
+
 class TestBlockKnames(CiTestCase):
     """Tests for some of the kname functions in block"""
     def test_determine_partition_kname(self):
@@ -538,6 +762,149 @@ class TestNonAscii(CiTestCase):
         block.blkid()
 
 
+class TestUnusedBlockdevs(CiTestCase):
+
+    def setUp(self):
+        super(TestUnusedBlockdevs, self).setUp()
+        self.sysfs = self.tmp_dir()
+        # sda: sda1 <- md0 (mounted), sda2; sdb: unused; sdc: dm-0 mounted
+        for path in ('sda/sda1/partition', 'sda/sda2/partition',
+                     'sda1/holders/md0', 'sdb/size', 'sdc/holders/dm-0',
+                     'md0/size', 'dm-0/size'):
+            util.write_file(os.path.join(self.sysfs, path), '')
+        self.add_patch('curtin.block._lsblock', 'm_lsblock')
+
+        def dev(kname, dtype, mountpoint=''):
+            return {'KNAME': kname, 'TYPE': dtype, 'MOUNTPOINT': mountpoint,
+                    'device_path': '/dev/' + kname}
+        self.m_lsblock.return_value = {
+            'sda': dev('sda', 'disk'), 'sda1': dev('sda1', 'part'),
+            'sda2': dev('sda2', 'part'), 'md0': dev('md0', 'raid1', '/'),
+            'sdb': dev('sdb', 'disk'), 'sdc': dev('sdc', 'disk'),
+            'dm-0': dev('dm-0', 'lvm', '/home')}
+
+    def test_holder_tree(self):
+        """Partitions and holders are found recursively."""
+        self.assertEqual(['sda1', 'md0', 'sda2'],
+                         block._holder_tree('sda', base=self.sysfs))
+        self.assertEqual([], block._holder_tree('nonexistent',
+                                                base=self.sysfs))
+
+    def test_unused(self):
+        """Devices with nothing mounted in their tree are unused."""
+        holder_tree = functools.partial(block._holder_tree, base=self.sysfs)
+        with mock.patch('curtin.block._holder_tree', holder_tree):
+            unused = block.get_unused_blockdev_info()
+        self.assertEqual(['sdb'], sorted(unused))
+        self.assertEqual(1, self.m_lsblock.call_count)
+
+
+def _lsblk_pairs(*devs):
+    return '\n'.join(
+        'KNAME="%s" LOG-SEC="512" PHY-SEC="%s" FSTYPE="%s" TYPE="%s"' % d
+        for d in devs)
+
+
+class TestBlockInventory(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockInventory, self).setUp()
+        self.add_patch('curtin.block.util.subp', 'm_subp')
+        self.add_patch('curtin.block.os.path.exists', 'm_exists')
+        self.m_exists.return_value = False
+        self.lsblk = _lsblk_pairs(('sda', '4096', '', 'disk'),
+                                  ('sda1', '4096', 'ext4', 'part'),
+                                  ('sdb', '512', 'zfs_member', 'disk'))
+        self.blkid = ('/dev/sda: PTUUID="pt-sda" PTTYPE="gpt"\n'
+                      '/dev/sda1: UUID="fs-sda1" TYPE="ext4" '
+                      'PARTUUID="part-sda1"\n'
+                      '/dev/sdb: LABEL="rpool" UUID="zfs-sdb" '
+                      'TYPE="zfs_member"')
+        self.m_subp.side_effect = self._subp
+
+    def _subp(self, cmd, capture=False):
+        if cmd[0] == 'lsblk':
+            return (self.lsblk, '')
+        return (self.blkid, '')
+
+    def calls(self, command):
+        return [c[0][0] for c in self.m_subp.call_args_list
+                if c[0][0][0] == command]
+
+    def test_queries_answered_from_one_probe(self):
+        """lsblk and blkid run once for all queries."""
+        with block.block_inventory():
+            self.assertEqual((512, 4096),
+                             block.get_blockdev_sector_size('/dev/sda1'))
+            self.assertEqual((512, 512),
+                             block.get_blockdev_sector_size('/dev/sdb'))
+            self.assertEqual('fs-sda1', block.get_volume_uuid('/dev/sda1'))
+            self.assertEqual('pt-sda', block.get_volume_uuid('/dev/sda'))
+            self.assertTrue(block.is_zfs_member('/dev/sdb'))
+            self.assertFalse(block.is_zfs_member('/dev/sda1'))
+            self.assertEqual({'/dev/sdb': {'LABEL': 'rpool',
+                                           'UUID': 'zfs-sdb',
+                                           'TYPE': 'zfs_member'}},
+                             block.blkid(devs=['/dev/sdb']))
+        self.assertEqual(1, len(self.calls('lsblk')))
+        self.assertEqual(1, len(self.calls('blkid')))
+
+    def test_invalidate(self):
+        """Invalidated devices and their partitions are probed again."""
+        with block.block_inventory():
+            block.get_volume_uuid('/dev/sda1')
+            self.m_exists.side_effect = lambda path: path == '/dev/sda'
+            block.invalidate_inventory('/dev/sda')
+            self.lsblk = _lsblk_pairs(('sda', '4096', '', 'disk'),
+                                      ('sda1', '4096', 'xfs', 'part'))
+            self.blkid = ('/dev/sda: PTUUID="pt-sda" PTTYPE="gpt"\n'
+                          '/dev/sda1: UUID="new-sda1" TYPE="xfs"')
+            self.assertEqual('new-sda1', block.get_volume_uuid('/dev/sda1'))
+            self.assertTrue(block.is_zfs_member('/dev/sdb'))
+        self.assertEqual(['/dev/sda'], self.calls('lsblk')[1][-1:])
+        self.assertEqual(['/dev/sda', '/dev/sda1'],
+                         self.calls('blkid')[1][-2:])
+
+    def test_invalidate_keeps_disks_sharing_a_prefix(self):
+        """Invalidating sda leaves sdaa, and nvme0n1 leaves nvme0n10."""
+        self.lsblk = _lsblk_pairs(('sda', '512', '', 'disk'),
+                                  ('sda1', '512', 'ext4', 'part'),
+                                  ('sdaa', '512', '', 'disk'),
+                                  ('sdaa1', '512', 'ext4', 'part'),
+                                  ('nvme0n1', '512', '', 'disk'),
+                                  ('nvme0n1p1', '512', 'ext4', 'part'),
+                                  ('nvme0n10', '512', 'ext4', 'disk'))
+        self.blkid = ('/dev/sda1: UUID="fs-sda1" TYPE="ext4"\n'
+                      '/dev/sdaa1: UUID="fs-sdaa1" TYPE="ext4"\n'
+                      '/dev/nvme0n1p1: UUID="fs-nvme0n1p1" TYPE="ext4"\n'
+                      '/dev/nvme0n10: UUID="fs-nvme0n10" TYPE="ext4"')
+        with block.block_inventory() as inventory:
+            inventory.devices()
+            block.invalidate_inventory('/dev/sda', '/dev/nvme0n1')
+            self.assertEqual(['nvme0n10', 'sdaa', 'sdaa1'],
+                             sorted(inventory.devices()))
+            self.assertEqual('fs-sdaa1', block.get_volume_uuid('/dev/sdaa1'))
+            self.assertEqual('fs-nvme0n10',
+                             block.get_volume_uuid('/dev/nvme0n10'))
+        self.assertEqual(1, len(self.calls('lsblk')))
+
+    def test_kname_or_partition(self):
+        for (kname, disk, expected) in (
+                ('sda', 'sda', True), ('sda12', 'sda', True),
+                ('sdaa', 'sda', False), ('sdaa1', 'sda', False),
+                ('nvme0n1p2', 'nvme0n1', True),
+                ('nvme0n10', 'nvme0n1', False),
+                ('loop10', 'loop1', False), ('md0p1', 'md0', True)):
+            self.assertEqual(expected,
+                             block._kname_or_partition(kname, disk), kname)
+
+    def test_no_inventory(self):
+        """Outside block_inventory() every query probes."""
+        block.get_volume_uuid('/dev/sda1')
+        block.get_volume_uuid('/dev/sda1')
+        self.assertEqual(2, len(self.calls('blkid')))
+
+
 class TestSlaveKnames(CiTestCase):
 
     def setUp(self):
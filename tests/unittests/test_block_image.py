@@ -0,0 +1,309 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import hashlib
+import mock
+import os
+import struct
+
+from curtin.block import image
+from curtin import util
+from .helpers import CiTestCase
+
+BS = image.ZERO_BLOCK_SIZE
+ZERO = b'\0' * BS
+
+
+class TestImageWriter(CiTestCase):
+
+    def setUp(self):
+        super(TestImageWriter, self).setUp()
+        self.target = self.tmp_path('disk.img', self.tmp_dir())
+        # data, 3 zero blocks, data, 2 zero blocks, a short zero tail
+        self.content = (b'a' * BS + ZERO * 3 + b'b' * (BS // 2) +
+                        b'\0' * (BS // 2) + ZERO * 2 + b'\0' * 100)
+
+    def write(self, writer, content, size):
+        for pos in range(0, len(content), size):
+            writer.write(content[pos:pos + size])
+
+    def test_file_has_holes(self):
+        """Zero blocks are seeked over in regular files."""
+        with image.ImageWriter(self.target) as writer:
+            self.write(writer, self.content, 1024 * 1024)
+        self.assertEqual(self.content,
+                         util.load_file(self.target, decode=False))
+        self.assertEqual(2 * BS + 100, writer.written)
+        self.assertEqual(5 * BS, writer.zeroed)
+
+    def test_unaligned_chunks(self):
+        """Chunks need not be aligned to the block size."""
+        with image.ImageWriter(self.target) as writer:
+            self.write(writer, self.content, 1000)
+        self.assertEqual(self.content,
+                         util.load_file(self.target, decode=False))
+        self.assertEqual(5 * BS, writer.zeroed)
+
+    def test_trailing_zeros(self):
+        """Zeros at the end of the image extend the file."""
+        with image.ImageWriter(self.target) as writer:
+            writer.write(b'a' * BS + ZERO * 4)
+        self.assertEqual(5 * BS, os.path.getsize(self.target))
+
+    def test_existing_file_truncated(self):
+        """Regular files are truncated, so skipped blocks read as zeros."""
+        util.write_file(self.target, b'x' * len(self.content), omode='wb')
+        with image.ImageWriter(self.target) as writer:
+            writer.write(self.content)
+        self.assertEqual(self.content,
+                         util.load_file(self.target, decode=False))
+
+    def test_block_device_zero_runs(self):
+        """Runs of zero blocks on block devices are zeroed by ioctl."""
+        m_zero = mock.Mock()
+        util.write_file(self.target, b'x' * len(self.content), omode='wb')
+        with image.ImageWriter(self.target) as writer:
+            writer.is_block = True
+            writer._zero_func = m_zero
+            writer.write(self.content)
+        self.assertEqual([mock.call(mock.ANY, BS, 3 * BS),
+                          mock.call(mock.ANY, 4 * BS + BS // 2 + BS // 2,
+                                    2 * BS)],
+                         m_zero.call_args_list)
+
+    def test_block_device_zeroout_unsupported(self):
+        """Zeros are written if the device does not support zeroing."""
+        m_zero = mock.Mock(side_effect=IOError(errno.EOPNOTSUPP, 'nope'))
+        with image.ImageWriter(self.target) as writer:
+            writer.is_block = True
+            writer._zero_func = m_zero
+            writer.write(self.content)
+        self.assertEqual(1, m_zero.call_count)
+        self.assertEqual(self.content,
+                         util.load_file(self.target, decode=False))
+        self.assertEqual(0, writer.zeroed)
+
+    def test_block_device_zeros_written_in_pieces(self):
+        """Long runs of zeros are written in bounded pieces."""
+        m_zero = mock.Mock(side_effect=IOError(errno.EOPNOTSUPP, 'nope'))
+        content = b'a' * BS + ZERO * 5
+        with mock.patch('curtin.block.image.MAX_WRITE_SIZE', 2 * BS):
+            with image.ImageWriter(self.target) as writer:
+                writer.is_block = True
+                writer._zero_func = m_zero
+                with mock.patch.object(writer, '_write',
+                                       wraps=writer._write) as m_write:
+                    writer.write(content)
+                    writer.close()
+        self.assertEqual([BS, 2 * BS, 2 * BS, BS],
+                         [len(c[0][0]) for c in m_write.call_args_list])
+        self.assertEqual(content, util.load_file(self.target, decode=False))
+
+    def test_block_device_zeroout_error(self):
+        """Other zeroing errors are raised."""
+        m_zero = mock.Mock(side_effect=IOError(errno.EIO, 'io error'))
+        with self.assertRaises(IOError):
+            with image.ImageWriter(self.target) as writer:
+                writer.is_block = True
+                writer._zero_func = m_zero
+                writer.write(self.content)
+                writer.close()
+
+    @mock.patch('curtin.block.image.os.fsync')
+    def test_single_fsync(self, m_fsync):
+        """The image is synced once, when closed."""
+        with image.ImageWriter(self.target) as writer:
+            self.write(writer, self.content, 1000)
+            self.assertEqual(0, m_fsync.call_count)
+        self.assertEqual(1, m_fsync.call_count)
+
+
+class TestDirectWriter(CiTestCase):
+
+    def setUp(self):
+        super(TestDirectWriter, self).setUp()
+        self.target = self.tmp_path('disk.img', self.tmp_dir())
+        util.write_file(self.target, b'x' * (64 * 1024), omode='wb')
+        self.addCleanup(image.update_direct_io, None)
+
+    def open(self, **kwargs):
+        try:
+            return image.DirectWriter(self.target, **kwargs)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            self.skipTest("no O_DIRECT support in %s" % self.target)
+
+    def test_writes(self):
+        """Aligned and unaligned writes land at their offsets."""
+        content = bytearray(b'x' * (64 * 1024))
+        with self.open(queue_depth=2, buffer_size=4096) as writer:
+            for (offset, data) in ((0, b'a' * 20000), (20000, b'b' * 100),
+                                   (30000, b'c' * 9000)):
+                writer.write(offset, data)
+                content[offset:offset + len(data)] = data
+        self.assertEqual(bytes(content),
+                         util.load_file(self.target, decode=False))
+
+    def test_write_error_raised(self):
+        """Errors of the writer threads are raised by close."""
+        writer = self.open()
+        err = OSError(errno.EIO, 'io error')
+        with mock.patch('curtin.block.image.os.pwrite', side_effect=err):
+            writer.write(0, b'a' * 8192)
+            with self.assertRaises(OSError):
+                writer.close()
+        self.assertIsNone(writer.fd)
+
+    def test_update_direct_io(self):
+        """The queue depth and buffer size are read from config."""
+        image.update_direct_io({'queue_depth': 8, 'buffer_size': '1M'})
+        with mock.patch('curtin.block.image.DirectWriter') as m_writer:
+            image.open_direct(self.target)
+        m_writer.assert_called_with(self.target, queue_depth=8,
+                                    buffer_size=1024 * 1024)
+
+    def test_disabled(self):
+        """open_direct returns None when O_DIRECT is disabled."""
+        image.update_direct_io({'enabled': 'false'})
+        self.assertIsNone(image.open_direct(self.target))
+
+    def test_unsupported(self):
+        """open_direct returns None if the device rejects O_DIRECT."""
+        err = OSError(errno.EINVAL, 'invalid')
+        with mock.patch('curtin.block.image.DirectWriter', side_effect=err):
+            self.assertIsNone(image.open_direct(self.target))
+
+
+class TestZeroRange(CiTestCase):
+
+    @mock.patch('curtin.block.image.fcntl.ioctl')
+    def test_zero_range(self, m_ioctl):
+        """zero_range issues BLKZEROOUT with a (start, length) range."""
+        image.zero_range(3, 4096, 8192)
+        m_ioctl.assert_called_with(3, image.BLKZEROOUT,
+                                   struct.pack('QQ', 4096, 8192))
+
+    @mock.patch('curtin.block.image.fcntl.ioctl')
+    def test_discard_range(self, m_ioctl):
+        """discard_range issues BLKDISCARD with a (start, length) range."""
+        image.discard_range(3, 0, 512)
+        m_ioctl.assert_called_with(3, image.BLKDISCARD,
+                                   struct.pack('QQ', 0, 512))
+
+
+def make_bmap(content, mapped, block_size=4096, version='2.0',
+              file_checksum=True):
+    """Return a bmap of content with the (first, last) block ranges mapped.
+    """
+    ctype = 'sha256' if version.startswith('2') else 'sha1'
+    attr = 'chksum' if version.startswith('2') else 'sha1'
+    ranges = []
+    for first, last in mapped:
+        data = content[first * block_size:(last + 1) * block_size]
+        text = '%d-%d' % (first, last) if last != first else '%d' % first
+        ranges.append('        <Range %s="%s"> %s </Range>' % (
+            attr, hashlib.new(ctype, data).hexdigest(), text))
+    file_field = 'BmapFileChecksum' if attr == 'chksum' else 'BmapFileSHA1'
+    zeros = '0' * hashlib.new(ctype).digest_size * 2
+    lines = ['<?xml version="1.0" ?>',
+             '<bmap version="%s">' % version,
+             '    <ImageSize> %d </ImageSize>' % len(content),
+             '    <BlockSize> %d </BlockSize>' % block_size]
+    if ctype == 'sha256':
+        lines.append('    <ChecksumType> sha256 </ChecksumType>')
+    if file_checksum:
+        lines.append('    <%s> %s </%s>' % (file_field, zeros, file_field))
+    lines += ['    <BlockMap>'] + ranges + ['    </BlockMap>', '</bmap>', '']
+    bmap = '\n'.join(lines)
+    if file_checksum:
+        bmap = bmap.replace(zeros, hashlib.new(
+            ctype, bmap.encode('utf-8')).hexdigest())
+    return bmap
+
+
+class TestParseBmap(CiTestCase):
+
+    content = b''.join([bytes(bytearray([i])) * 4096 for i in range(1, 9)])
+
+    def test_parse_v2(self):
+        """parse_bmap reads version 2 bmaps with sha256 checksums."""
+        bmap = image.parse_bmap(make_bmap(self.content, [(0, 1), (4, 4)]))
+        self.assertEqual(len(self.content), bmap.image_size)
+        self.assertEqual(4096, bmap.block_size)
+        self.assertEqual('sha256', bmap.checksum_type)
+        self.assertEqual([(0, 8192), (16384, 20480)],
+                         [r[:2] for r in bmap.ranges])
+        self.assertEqual(3 * 4096, bmap.mapped_size)
+
+    def test_parse_v1(self):
+        """parse_bmap reads version 1 bmaps with sha1 checksums."""
+        bmap = image.parse_bmap(
+            make_bmap(self.content, [(2, 3)], version='1.4'))
+        self.assertEqual('sha1', bmap.checksum_type)
+        self.assertEqual(
+            hashlib.sha1(self.content[8192:16384]).hexdigest(),
+            bmap.ranges[0][2])
+
+    def test_last_range_clipped_to_image_size(self):
+        """The last range ends at the image size."""
+        content = self.content[:-100]
+        bmap = image.parse_bmap(make_bmap(content, [(7, 7)]))
+        self.assertEqual([(7 * 4096, len(content))],
+                         [r[:2] for r in bmap.ranges])
+
+    def test_bmap_checksum_mismatch(self):
+        """parse_bmap verifies the checksum of the bmap."""
+        bmap = make_bmap(self.content, [(0, 1)])
+        with self.assertRaises(ValueError):
+            image.parse_bmap(bmap.replace('<Range', '<Range foo="1"', 1))
+
+    def test_invalid_bmap(self):
+        """parse_bmap raises ValueError on invalid input."""
+        for bad in ('not xml', '<bmap version="3.0"/>',
+                    '<bmap version="2.0"><BlockSize>4096</BlockSize></bmap>'):
+            with self.assertRaises(ValueError):
+                image.parse_bmap(bad)
+
+
+class TestBmapWriter(CiTestCase):
+
+    content = b''.join([bytes(bytearray([i])) * 4096 for i in range(1, 9)])
+
+    def setUp(self):
+        super(TestBmapWriter, self).setUp()
+        self.target = self.tmp_path('disk.img', self.tmp_dir())
+
+    def write(self, bmap, content, size=1000):
+        with image.BmapWriter(self.target, image.parse_bmap(bmap)) as writer:
+            for pos in range(0, len(content), size):
+                writer.write(content[pos:pos + size])
+        return writer
+
+    def test_writes_mapped_ranges(self):
+        """Only the mapped ranges of the image are written."""
+        writer = self.write(make_bmap(self.content, [(1, 2), (6, 6)]),
+                            self.content)
+        expected = bytearray(len(self.content))
+        for first, last in [(1, 2), (6, 6)]:
+            start, end = first * 4096, (last + 1) * 4096
+            expected[start:end] = self.content[start:end]
+        self.assertEqual(bytes(expected),
+                         util.load_file(self.target, decode=False))
+        self.assertEqual(3 * 4096, writer.writer.written)
+        self.assertEqual(5 * 4096, writer.writer.skipped)
+
+    def test_checksum_mismatch(self):
+        """A range not matching its checksum raises ValueError."""
+        bmap = make_bmap(self.content, [(0, 0), (3, 4)])
+        corrupt = self.content[:4 * 4096] + b'x' + self.content[4 * 4096 + 1:]
+        with self.assertRaises(ValueError):
+            self.write(bmap, corrupt)
+
+    def test_short_image(self):
+        """An image ending before its last mapped range raises ValueError."""
+        bmap = make_bmap(self.content, [(0, 0), (7, 7)])
+        with self.assertRaises(ValueError):
+            self.write(bmap, self.content[:6 * 4096])
+
+# vi: ts=4 expandtab syntax=python
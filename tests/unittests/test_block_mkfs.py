@@ -4,6 +4,9 @@ from curtin.block import mkfs
 
 from .helpers import CiTestCase
 import mock
+import os
+import threading
+import time
 
 
 class TestBlockMkfs(CiTestCase):
@@ -164,4 +167,64 @@ class TestBlockMkfs(CiTestCase):
         uuid = mkfs.mkfs("/dev/null", "ext4")
         self.assertIsNotNone(uuid)
 
+
+class TestMkfsBatch(CiTestCase):
+
+    def setUp(self):
+        super(TestMkfsBatch, self).setUp()
+        self.add_patch('curtin.block.mkfs.mkfs', 'm_mkfs')
+        self.add_patch('curtin.block.volume_disks', 'm_disks')
+        # /dev/sdaN are on sda
+        self.m_disks.side_effect = lambda path: set(
+            [os.path.basename(path.rstrip('0123456789'))])
+
+    def test_uuids_in_job_order(self):
+        self.m_mkfs.side_effect = lambda path, fstype, **kw: 'uuid-' + path
+        jobs = [('/dev/sda1', 'ext4', {'label': 'root'}),
+                ('/dev/sdb1', 'xfs', {}),
+                ('/dev/sda2', 'swap', {})]
+        uuids = mkfs.mkfs_batch(jobs, workers=2)
+        self.assertEqual([('/dev/sda1', 'uuid-/dev/sda1'),
+                          ('/dev/sdb1', 'uuid-/dev/sdb1'),
+                          ('/dev/sda2', 'uuid-/dev/sda2')],
+                         list(uuids.items()))
+        self.m_mkfs.assert_any_call('/dev/sda1', 'ext4', label='root')
+
+    def test_disks_concurrent_partitions_not(self):
+        """Different disks are formatted at once, partitions of one disk one
+        after the other."""
+        lock = threading.Lock()
+        running = {}
+        most = {}
+        sdc_started = threading.Event()
+
+        def fake_mkfs(path, fstype, **kwargs):
+            disk = path.rstrip('0123456789')
+            with lock:
+                running[disk] = running.get(disk, 0) + 1
+                most[disk] = max(most.get(disk, 0), running[disk])
+            if disk == '/dev/sdc':
+                sdc_started.set()
+            else:
+                # sdc is formatted while the first sdb partition is
+                self.assertTrue(sdc_started.wait(10))
+            time.sleep(0.01)
+            with lock:
+                running[disk] -= 1
+
+        self.m_mkfs.side_effect = fake_mkfs
+        jobs = [('/dev/sdb%d' % i, 'ext4', {}) for i in range(1, 4)]
+        jobs.append(('/dev/sdc1', 'xfs', {}))
+        mkfs.mkfs_batch(jobs, workers=4)
+        self.assertEqual({'/dev/sdb': 1, '/dev/sdc': 1}, most)
+        self.assertEqual(4, self.m_mkfs.call_count)
+
+    def test_error_raised(self):
+        self.m_mkfs.side_effect = [ValueError('no mkfs.xfs'), 'uuid']
+        jobs = [('/dev/sda1', 'xfs', {}), ('/dev/sdb1', 'ext4', {})]
+        with self.assertRaisesRegexp(ValueError, 'no mkfs.xfs'):
+            mkfs.mkfs_batch(jobs, workers=1)
+        # no new mkfs after the failure
+        self.assertEqual(1, self.m_mkfs.call_count)
+
 # vi: ts=4 expandtab syntax=python
@@ -0,0 +1,210 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import struct
+import uuid
+import zlib
+
+from curtin.block import partition_table
+from curtin.block.partition_table import PartitionTable
+from curtin import util
+from .helpers import CiTestCase
+
+# 4GiB of 512 byte sectors
+SECTORS = 8388608
+
+
+def _image(table):
+    """Return a dict of sector -> data of the writes of table."""
+    sectors = {}
+    for (offset, data) in table.layout():
+        for i in range(0, len(data), table.sector_size):
+            sectors[(offset + i) // table.sector_size] = (
+                data[i:i + table.sector_size])
+    return sectors
+
+
+def _mbr_entries(sector):
+    return [partition_table.MBR_ENTRY.unpack(sector[446 + i * 16:462 + i * 16])
+            for i in range(4)]
+
+
+class TestMsdosTable(CiTestCase):
+
+    def test_primary_partitions(self):
+        table = PartitionTable('msdos', SECTORS, bootcode=b'\xeb' * 440,
+                               signature=b'abcd')
+        table.add(1, 2048, 1001471, bootable=True)
+        table.add(2, 1001472, 3098623, flag='swap')
+        image = _image(table)
+
+        mbr = image[0]
+        self.assertEqual(b'\xeb' * 440 + b'abcd', mbr[:444])
+        self.assertEqual(b'\x55\xaa', mbr[510:])
+        entries = _mbr_entries(mbr)
+        self.assertEqual([(0x80, 0x83, 2048, 999424),
+                          (0, 0x82, 1001472, 2097152)],
+                         [(e[0], e[2], e[4], e[5]) for e in entries[:2]])
+        self.assertEqual([(0, 0, 0, 0)] * 2,
+                         [(e[0], e[2], e[4], e[5]) for e in entries[2:]])
+        # stale gpt headers are cleared
+        self.assertEqual(b'\0' * 512, image[1])
+        self.assertEqual(b'\0' * 512, image[SECTORS - 1])
+
+    def test_logical_partitions(self):
+        table = PartitionTable('msdos', SECTORS)
+        table.add(1, 2048, 1001471)
+        table.add(2, 1001472, 5197823, flag='extended')
+        table.add(5, 1003520, 3100671)
+        table.add(6, 3102720, 5197823, flag='lvm')
+        image = _image(table)
+
+        entries = _mbr_entries(image[0])
+        self.assertEqual((0x05, 1001472, 4196352),
+                         (entries[1][2], entries[1][4], entries[1][5]))
+        # follow the chain of extended boot records
+        found = []
+        ebr = 1001472
+        while True:
+            entries = _mbr_entries(image[ebr])
+            found.append((ebr + entries[0][4],
+                          ebr + entries[0][4] + entries[0][5] - 1,
+                          entries[0][2]))
+            if not entries[1][2]:
+                break
+            self.assertEqual(0x05, entries[1][2])
+            ebr = 1001472 + entries[1][4]
+        self.assertEqual([(1003520, 3100671, 0x83),
+                          (3102720, 5197823, 0x8e)], found)
+
+    def test_invalid_partitions(self):
+        table = PartitionTable('msdos', SECTORS)
+        table.add(1, 2048, 1001471)
+        for (args, kwargs) in (((2, 4096, 8191), {}),
+                               ((2, 0, 1000), {}),
+                               ((2, 1001472, SECTORS), {}),
+                               ((5, 1003520, 2000000), {}),
+                               ((1, 2000000, 3000000), {})):
+            with self.assertRaises(ValueError):
+                table.add(*args, **kwargs)
+
+        table.add(2, 1001472, 5197823, flag='extended')
+        with self.assertRaises(ValueError):
+            # no room for the extended boot record
+            table.add(5, 1001472, 2000000)
+        with self.assertRaises(ValueError):
+            table.add(3, 5197824, 6000000, flag='extended')
+
+    def test_msdos_sector_limit(self):
+        table = PartitionTable('msdos', 1 << 33)
+        self.assertEqual((1 << 32) - 1, table.last_usable)
+        with self.assertRaises(ValueError):
+            table.add(1, 2048, 1 << 32)
+
+
+class TestGptTable(CiTestCase):
+
+    def _header(self, sector):
+        fields = list(partition_table.GPT_HEADER.unpack(sector[:92]))
+        crc = fields[3]
+        fields[3] = 0
+        self.assertEqual(zlib.crc32(partition_table.GPT_HEADER.pack(*fields))
+                         & 0xffffffff, crc)
+        return fields
+
+    def test_gpt(self):
+        table = PartitionTable('gpt', SECTORS)
+        part = table.add(1, 2048, 1001471, flag='boot', name='esp')
+        table.add(3, 1001472, table.last_usable)
+        image = _image(table)
+
+        # protective mbr
+        entries = _mbr_entries(image[0])
+        self.assertEqual((0xee, 1, SECTORS - 1),
+                         (entries[0][2], entries[0][4], entries[0][5]))
+
+        primary = self._header(image[1])
+        backup = self._header(image[SECTORS - 1])
+        self.assertEqual(b'EFI PART', primary[0])
+        self.assertEqual([1, SECTORS - 1, 34, SECTORS - 34], primary[5:9])
+        self.assertEqual([SECTORS - 1, 1, 34, SECTORS - 34], backup[5:9])
+        self.assertEqual(uuid.UUID(table.guid).bytes_le, primary[9])
+        self.assertEqual((2, SECTORS - 33), (primary[10], backup[10]))
+
+        for header in (primary, backup):
+            array = b''.join(image[header[10] + i] for i in range(32))
+            self.assertEqual(zlib.crc32(array) & 0xffffffff, header[13])
+            entries = [partition_table.GPT_ENTRY.unpack(array[i:i + 128])
+                       for i in range(0, 128 * 3, 128)]
+            self.assertEqual(
+                uuid.UUID(partition_table.GPT_TYPES['boot']),
+                uuid.UUID(bytes_le=entries[0][0]))
+            self.assertEqual(uuid.UUID(part.guid),
+                             uuid.UUID(bytes_le=entries[0][1]))
+            self.assertEqual((2048, 1001471), entries[0][2:4])
+            self.assertEqual(b'e\0s\0p\0', entries[0][5][:6])
+            # an unused entry
+            self.assertEqual(b'\0' * 128, array[128:256])
+            self.assertEqual(
+                uuid.UUID(partition_table.GPT_TYPES['linux']),
+                uuid.UUID(bytes_le=entries[2][0]))
+            self.assertEqual((1001472, SECTORS - 34), entries[2][2:4])
+
+    def test_gpt_4k_sectors(self):
+        table = PartitionTable('gpt', SECTORS // 8, sector_size=4096)
+        self.assertEqual((6, SECTORS // 8 - 6),
+                         (table.first_usable, table.last_usable))
+        table.add(1, 256, table.last_usable)
+        image = _image(table)
+        header = self._header(image[1])
+        self.assertEqual(SECTORS // 8 - 5, self._header(
+            image[SECTORS // 8 - 1])[10])
+        self.assertEqual(2, header[10])
+
+    def test_invalid_partitions(self):
+        table = PartitionTable('gpt', SECTORS)
+        table.add(1, 2048, 4095)
+        for args in ((2, 33, 2047), (2, 4095, 8191), (2, 4096, SECTORS - 1),
+                     (129, 4096, 8191), (1, 4096, 8191)):
+            with self.assertRaises(ValueError):
+                table.add(*args)
+
+    def test_invalid_label(self):
+        with self.assertRaises(ValueError):
+            PartitionTable('sun', SECTORS)
+
+
+class TestWriteTable(CiTestCase):
+
+    def test_write_table_to_image(self):
+        """Tables are written to sparse image files."""
+        disk = self.tmp_path('disk.img', self.tmp_dir())
+        with open(disk, 'wb') as fp:
+            fp.write(b'\xfa' * 440 + b'wxyz')
+            fp.truncate(64 << 20)
+
+        table = partition_table.new_table(disk, 'gpt')
+        self.assertEqual((131072, 512), (table.sectors, table.sector_size))
+        table.add(1, 2048, table.last_usable)
+        partition_table.write_table(disk, table)
+
+        data = util.load_file(disk, decode=False)
+        self.assertEqual(64 << 20, len(data))
+        self.assertEqual(b'\xfa' * 440 + b'wxyz', data[:444])
+        self.assertEqual(b'EFI PART', data[512:520])
+        self.assertEqual(b'EFI PART', data[-512:-504])
+        entry = partition_table.GPT_ENTRY.unpack(data[1024:1152])
+        self.assertEqual((2048, 131038), entry[2:4])
+
+        # an msdos table replaces the gpt
+        table = partition_table.new_table(disk, 'dos')
+        self.assertEqual(b'wxyz', table.signature)
+        table.add(1, 2048, 4095)
+        partition_table.write_table(disk, table)
+        data = util.load_file(disk, decode=False)
+        self.assertEqual(b'\0' * 512, data[512:1024])
+        self.assertEqual(b'\0' * 512, data[-512:])
+        self.assertEqual(
+            (0x83, 2048, 2048),
+            struct.unpack('<4xB3xII', data[446:462]))
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,105 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import io
+import mock
+
+from curtin import block
+from curtin import util
+from curtin.block import signatures
+from curtin.block.signatures import KiB, MiB
+from .helpers import CiTestCase
+
+# size of the test images, not a multiple of the zfs label size
+SIZE = 128 * MiB + 12 * KiB
+
+
+class TestFindSignatures(CiTestCase):
+
+    def setUp(self):
+        super(TestFindSignatures, self).setUp()
+        self.image = self.tmp_path('disk.img', self.tmp_dir())
+        with open(self.image, 'wb') as fp:
+            fp.truncate(SIZE)
+
+    def _write(self, offset, data):
+        with open(self.image, 'rb+') as fp:
+            fp.seek(offset)
+            fp.write(data)
+
+    def _find(self):
+        with open(self.image, 'rb') as fp:
+            return signatures.find_signatures(fp, SIZE)
+
+    def test_blank(self):
+        self.assertEqual([], self._find())
+
+    def test_signatures(self):
+        zfs_end = 128 * MiB
+        self._write(510, b'\x55\xaa')
+        self._write(512, b'EFI PART')
+        self._write(SIZE - 512, b'EFI PART')
+        self._write(SIZE - 8 * KiB, signatures.MD_MAGICS[0])
+        self._write(64 * KiB + 64, b'_BHRfS_M')
+        self._write(64 * MiB + 64, b'_BHRfS_M')
+        self._write(32 * KiB, b'SKUL\xba\xbe')
+        self._write(zfs_end - 512 * KiB + 140 * KiB, signatures.ZFS_MAGICS[1])
+        self.assertEqual(
+            [('dos', 0, 512),
+             ('gpt', 512, 20 * KiB),
+             ('luks', 32 * KiB, 4 * KiB),
+             ('btrfs', 64 * KiB, 4 * KiB),
+             ('btrfs', 64 * MiB, 4 * KiB),
+             ('zfs', zfs_end - 512 * KiB, 256 * KiB),
+             ('gpt', SIZE - 16 * KiB - 512, 16 * KiB + 512),
+             ('md', SIZE - 8 * KiB, 4 * KiB)],
+            self._find())
+
+    def test_md_090_and_lvm(self):
+        self._write(SIZE - 76 * KiB, signatures.MD_MAGICS[1])
+        self._write(1024, b'LABELONE')
+        self._write(4 * KiB + 4, b' LVM2 x[5A%r0N*>')
+        self.assertEqual(
+            [('lvm2', 1024, 512), ('lvm2', 4 * KiB, 512),
+             ('md 0.90', SIZE - 76 * KiB, 4 * KiB)],
+            self._find())
+
+    def test_small_volume(self):
+        """Locations past the end of a small volume are skipped."""
+        fp = io.BytesIO(b'XFSB' + b'\0' * 1020)
+        self.assertEqual([('xfs', 0, 512)],
+                         signatures.find_signatures(fp, 1024))
+
+
+class TestQuickZero(CiTestCase):
+
+    def test_quick_zero_wipes_signatures(self):
+        """quick_zero zeros the ends and the metadata found in between."""
+        image = self.tmp_path('disk.img', self.tmp_dir())
+        with open(image, 'wb') as fp:
+            fp.write(b'\xff' * 2 * MiB)
+            fp.seek(64 * MiB)
+            fp.write(b'\xff' * 64 + b'_BHRfS_M' + b'\xff' * 8 * KiB)
+            fp.seek(SIZE - 2 * MiB)
+            fp.write(b'\xff' * 2 * MiB)
+
+        block.quick_zero(image, partitions=False)
+
+        data = util.load_file(image, decode=False)
+        self.assertEqual(b'\0' * MiB + b'\xff' * MiB, data[:2 * MiB])
+        self.assertEqual(b'\0' * 4 * KiB + b'\xff' * 4 * KiB + b'\xff' * 72,
+                         data[64 * MiB:64 * MiB + 8 * KiB + 72])
+        self.assertEqual(b'\xff' * MiB + b'\0' * MiB, data[-2 * MiB:])
+
+    @mock.patch('curtin.block.LOG')
+    def test_quick_zero_logs_merged_ranges(self, m_log):
+        """The ends of a small volume are wiped, and logged, as one range."""
+        image = self.tmp_path('disk.img', self.tmp_dir())
+        size = 3 * MiB // 2
+        util.write_file(image, b'\xff' * size, omode='wb')
+        block.quick_zero(image, partitions=False)
+        self.assertEqual(b'\0' * size,
+                         util.load_file(image, decode=False))
+        m_log.debug.assert_called_with("wiping %s at byte ranges %s", image,
+                                       '0-%d' % (size - 1))
+
+# vi: ts=4 expandtab syntax=python
@@ -3,13 +3,42 @@
 from argparse import Namespace
 from collections import OrderedDict
 import copy
-from mock import patch, call
+import hashlib
+import io
+from mock import Mock, patch, call
 import os
+import threading
+from unittest import skipUnless
 
+try:
+    import lzma
+except ImportError:
+    # python2 without backports.lzma
+    lzma = None
+
+from curtin.block import image, partition_table
 from curtin.commands import block_meta
+from curtin import streams
 from curtin import util
 from .helpers import CiTestCase
 
+skipUnlessLzma = skipUnless(lzma, "python lzma missing")
+
+
+BMAP = '''<?xml version="1.0" ?>
+<bmap version="2.0">
+    <ImageSize> 16384 </ImageSize>
+    <BlockSize> 4096 </BlockSize>
+    <BlocksCount> 4 </BlocksCount>
+    <MappedBlocksCount> 2 </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BlockMap>
+        <Range> 0 </Range>
+        <Range> 2 </Range>
+    </BlockMap>
+</bmap>
+'''
+
 
 class TestBlockMetaSimple(CiTestCase):
     def setUp(self):
@@ -40,7 +69,9 @@ class TestBlockMetaSimple(CiTestCase):
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
 
-    def test_write_image_to_disk(self):
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disk(self, mock_reader, mock_pipe):
         source = {
             'type': 'dd-xz',
             'uri': 'http://myhost/curtin-unittest-dd.xz'
@@ -51,18 +82,20 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |xzcat| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
+        mock_reader.assert_called_with(source['uri'])
+        mock_pipe.assert_called_with(
+            mock_reader.return_value.__enter__.return_value, [devnode],
+            'xzcat', bmap=None)
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'settle'])])
         paths = ["curtin", "system-data/var/lib/snapd"]
         self.mock_block_get_root_device.assert_called_with([devname],
                                                            paths=paths)
 
-    def test_write_image_to_disk_ddtgz(self):
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disk_ddtgz(self, mock_reader, mock_pipe):
         source = {
             'type': 'dd-tgz',
             'uri': 'http://myhost/curtin-unittest-dd.tgz'
@@ -73,17 +106,203 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |'
-                'tar -xOzf -| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
-        self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
+        mock_pipe.assert_called_with(
+            mock_reader.return_value.__enter__.return_value, [devnode],
+            'tar -xOzf -', bmap=None)
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'settle'])])
-        paths = ["curtin", "system-data/var/lib/snapd"]
-        self.mock_block_get_root_device.assert_called_with([devname],
-                                                           paths=paths)
+
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disk_cached(self, mock_reader, mock_pipe):
+        source = {
+            'type': 'dd-raw',
+            'uri': 'http://myhost/curtin-unittest-dd.img',
+            'sha256': 'abc',
+        }
+        tmpd = self.tmp_dir()
+        cached = os.path.join(tmpd, 'sha256-abc')
+        util.write_file(cached, 'image')
+        devname = "fakedisk1p1"
+        devnode = "/dev/" + devname
+        self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+        cache = Mock()
+        cache.fetch.return_value = cached
+
+        block_meta.write_image_to_disk(source, devname, cache=cache)
+
+        cache.fetch.assert_called_with(source['uri'], sha256='abc')
+        self.assertEqual(0, mock_reader.call_count)
+        reader = mock_pipe.call_args[0][0]
+        self.assertEqual(cached, reader.name)
+        self.assertEqual(([devnode], None), mock_pipe.call_args[0][1:])
+
+    @patch('curtin.commands.block_meta.write_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disk_ddzst(self, mock_reader, mock_write_stream):
+        source = {
+            'type': 'dd-zst',
+            'uri': 'http://myhost/curtin-unittest-dd.zst'
+        }
+        devname = "fakedisk1p1"
+        devnode = "/dev/" + devname
+        self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+
+        block_meta.write_image_to_disk(source, devname)
+
+        mock_write_stream.assert_called_with(
+            mock_reader.return_value.__enter__.return_value, [devnode],
+            'zst', bmap=None)
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
+                                         call(['udevadm', 'settle'])])
+
+    @skipUnlessLzma
+    def test_write_stream_to_disk(self):
+        """write_stream_to_disk decompresses the stream onto the device."""
+        tmpd = self.tmp_dir()
+        devnode = os.path.join(tmpd, 'disk')
+        content = b'\x00' * 4096 + b'partition data' * 1000
+        reader = io.BytesIO(lzma.compress(content))
+        block_meta.write_stream_to_disk(reader, devnode, 'xz')
+        self.assertEqual(content, util.load_file(devnode, decode=False))
+
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper')
+    def test_write_image_to_disk_bmap(self, mock_url_helper, mock_pipe):
+        bmap = self.tmp_path('image.bmap', self.tmp_dir())
+        util.write_file(bmap, BMAP)
+        source = {
+            'type': 'dd-raw',
+            'uri': 'http://myhost/curtin-unittest-dd.img',
+            'bmap': 'file://' + bmap,
+        }
+        devname = "fakedisk1p1"
+        devnode = "/dev/" + devname
+        self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+
+        block_meta.write_image_to_disk(source, devname)
+
+        parsed = mock_pipe.call_args[1]['bmap']
+        self.assertEqual(2 * 4096, parsed.mapped_size)
+
+    @skipUnlessLzma
+    def test_pipe_stream_to_disk(self):
+        """pipe_stream_to_disk writes through the extractor with dd."""
+        tmpd = self.tmp_dir()
+        devnode = os.path.join(tmpd, 'disk')
+        content = b'\x00' * 4096 + b'partition data' * 1000
+        reader = io.BytesIO(lzma.compress(content))
+        block_meta.pipe_stream_to_disk(reader, devnode, 'xzcat')
+        self.assertEqual(content, util.load_file(devnode, decode=False))
+
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disks(self, mock_reader, mock_pipe):
+        """An image written to several disks is read once."""
+        source = {'type': 'dd-xz', 'uri': 'http://myhost/dd.xz'}
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+
+        block_meta.write_image_to_disk(source, ['sda', 'sdb'])
+
+        self.assertEqual(1, mock_reader.call_count)
+        mock_pipe.assert_called_with(
+            mock_reader.return_value.__enter__.return_value,
+            ['/dev/sda', '/dev/sdb'], 'xzcat', bmap=None)
+        self.mock_subp.assert_has_calls([call(['partprobe', '/dev/sda']),
+                                         call(['partprobe', '/dev/sdb'])])
+        self.mock_block_get_root_device.assert_called_with(
+            ['sda'], paths=["curtin", "system-data/var/lib/snapd"])
+
+    @skipUnlessLzma
+    def test_pipe_stream_to_disks(self):
+        """pipe_stream_to_disk writes the same image to every device."""
+        tmpd = self.tmp_dir()
+        devnodes = [os.path.join(tmpd, 'disk%d' % i) for i in range(3)]
+        content = b'\x00' * 4096 + b'partition data' * 100000
+        reader = io.BytesIO(lzma.compress(content))
+        block_meta.pipe_stream_to_disk(reader, devnodes, 'xzcat')
+        for devnode in devnodes:
+            self.assertEqual(content, util.load_file(devnode, decode=False))
+
+    def test_pipe_stream_to_disks_failure(self):
+        """A failing device does not stop the others but is reported."""
+        tmpd = self.tmp_dir()
+        devnodes = [os.path.join(tmpd, 'disk0'), '/dev/full']
+        content = b'partition data' * 100000
+        with self.assertRaises(image.ImageWriteError) as ctx:
+            block_meta.pipe_stream_to_disk(io.BytesIO(content), devnodes)
+        self.assertIsNone(ctx.exception.results[devnodes[0]])
+        self.assertIsNotNone(ctx.exception.results[devnodes[1]])
+        self.assertEqual(content, util.load_file(devnodes[0], decode=False))
+
+    @patch('curtin.commands.block_meta.events.report_finish_event')
+    @patch('curtin.commands.block_meta.pipe_stream_to_disk')
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_write_image_to_disks_reported(self, mock_reader, mock_pipe,
+                                           mock_report):
+        """The result of writing the image to each disk is reported."""
+        source = {'type': 'dd-raw', 'uri': 'http://myhost/dd.img'}
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+        mock_pipe.return_value = {'/dev/sda': None, '/dev/sdb': None}
+        block_meta.write_image_to_disk(source, ['sda', 'sdb'])
+        self.assertEqual(
+            [call('write-image/sda', 'wrote image to /dev/sda',
+                  result='SUCCESS', level='INFO'),
+             call('write-image/sdb', 'wrote image to /dev/sdb',
+                  result='SUCCESS', level='INFO')],
+            mock_report.call_args_list)
+
+        mock_report.reset_mock()
+        mock_pipe.side_effect = image.ImageWriteError(
+            {'/dev/sda': None, '/dev/sdb': IOError('no space')})
+        with self.assertRaises(image.ImageWriteError):
+            block_meta.write_image_to_disk(source, ['sda', 'sdb'])
+        self.assertEqual(
+            [call('write-image/sda', 'wrote image to /dev/sda',
+                  result='SUCCESS', level='INFO'),
+             call('write-image/sdb',
+                  'writing image to /dev/sdb failed: no space',
+                  result='FAIL', level='INFO')],
+            mock_report.call_args_list)
+
+    def test_write_chunks_to_disk_results(self):
+        """write_chunks_to_disk returns the result for each device."""
+        tmpd = self.tmp_dir()
+        for count in (1, 2):
+            devnodes = [os.path.join(tmpd, 'disk%d' % i)
+                        for i in range(count)]
+            self.assertEqual(
+                dict((devnode, None) for devnode in devnodes),
+                block_meta.write_chunks_to_disk([b'data'], devnodes))
+
+    @patch('curtin.commands.block_meta.url_helper.ResumableReader')
+    def test_open_image_checksum(self, mock_reader):
+        """Images of sources with a checksum are verified as read."""
+        source = {'type': 'dd-raw', 'uri': 'http://myhost/dd.img',
+                  'sha512': 'ABC'}
+        reader = block_meta.open_image(source)
+        self.assertIsInstance(reader, streams.ChecksumReader)
+        self.assertEqual(('sha512', 'abc'),
+                         (reader.checksum_type, reader.expected))
+        self.assertEqual(mock_reader.return_value, reader.fileobj)
+
+    @skipUnlessLzma
+    def test_pipe_stream_checksum_mismatch(self):
+        """A corrupt image fails the write before the device is synced."""
+        tmpd = self.tmp_dir()
+        devnode = os.path.join(tmpd, 'disk')
+        data = lzma.compress(b'partition data' * 1000)
+        good = ('sha256', hashlib.sha256(data).hexdigest())
+        block_meta.pipe_stream_to_disk(
+            streams.ChecksumReader(io.BytesIO(data), good), devnode, 'xzcat')
+        with patch('curtin.block.image.os.fsync') as m_fsync:
+            with self.assertRaises(streams.ChecksumError):
+                block_meta.pipe_stream_to_disk(
+                    streams.ChecksumReader(io.BytesIO(data), ('sha256', '0')),
+                    devnode, 'xzcat')
+        self.assertEqual(0, m_fsync.call_count)
 
     @patch('curtin.commands.block_meta.write_image_to_disk')
     def test_meta_simple_calls_write_img(self, mock_write_image):
@@ -108,10 +327,107 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.meta_simple(args)
 
-        mock_write_image.assert_called_with(sources.get('unittest'), devname)
+        mock_write_image.assert_called_with(sources.get('unittest'),
+                                            [devname], cache=None)
         self.mock_subp.assert_has_calls(
             [call(['mount', devname, self.target])])
 
+    @patch('curtin.commands.block_meta.write_image_to_disk')
+    def test_meta_simple_mirror_image(self, mock_write_image):
+        """mirror-image writes the dd image to all valid devices."""
+        sources = {'unittest': {'type': 'dd-xz', 'uri': 'http://host/dd.xz'}}
+        self.mock_config_load.return_value = {
+            'block-meta': {'devices': ['sdb', 'sda', 'sdc'],
+                           'mirror-image': True},
+            'sources': sources,
+        }
+        self.mock_load_env.return_value = {'target': self.target}
+        self.mock_block_is_valid_device.side_effect = (
+            lambda dev: dev != 'sdc')
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+        mock_write_image.return_value = '/dev/sda1'
+
+        args = Namespace(target=self.target, devices=None, mode=None,
+                         boot_fstype=None, fstype=None)
+        block_meta.meta_simple(args)
+
+        mock_write_image.assert_called_with(sources['unittest'],
+                                            ['sda', 'sdb'], cache=None)
+
+    @patch('curtin.commands.block_meta.block.lookup_disk')
+    @patch('curtin.commands.block_meta.block.wipe_volumes')
+    @patch('curtin.commands.block_meta.write_image_to_disk')
+    def test_meta_simple_wipes(self, mock_write_image, mock_wipe_volumes,
+                               mock_lookup_disk):
+        """Disks of the storage config with 'wipe' set are wiped."""
+        mock_lookup_disk.side_effect = lambda serial: '/dev/' + serial
+        self.mock_load_env.return_value = {'target': self.target}
+        self.mock_block_is_valid_device.return_value = True
+        self.mock_block_get_dev_name_entry.side_effect = (
+            lambda dev: (dev, '/dev/' + dev))
+        args = Namespace(target=self.target, devices=None, mode=None,
+                         boot_fstype=None, fstype=None)
+        for (wipe, expected) in ((None, 0), ('superblock', 1)):
+            self.mock_config_load.return_value = {
+                'block-meta': {'devices': ['sda']},
+                'sources': {'unittest': {'type': 'dd-xz',
+                                         'uri': 'http://host/dd.xz'}},
+                'storage': {'config': [
+                    {'id': 'sda', 'type': 'disk', 'serial': 'sda',
+                     'wipe': wipe}]},
+            }
+            mock_wipe_volumes.reset_mock()
+            block_meta.meta_simple(args)
+            self.assertEqual(expected, mock_wipe_volumes.call_count)
+        mock_wipe_volumes.assert_called_with([('/dev/sda', 'superblock')])
+
+    def _disk(self, size=4 << 30):
+        disk = self.tmp_path('disk', self.tmp_dir())
+        with open(disk, 'wb') as fp:
+            fp.truncate(size)
+        return disk
+
+    def test_simple_partition_table(self):
+        """simple_partition_table lays out the partition formats."""
+        disk = self._disk()
+        mb = 2048
+        end = 8388574
+        expected = {
+            ('mbr', False): [(1, mb, end, None)],
+            ('mbr', True): [(1, mb, 1050623, None), (2, 1050624, end, None)],
+            ('gpt', False): [(15, mb, 4095, 'bios_grub'),
+                             (1, 4096, end, None)],
+            ('gpt', True): [(15, mb, 4095, 'bios_grub'),
+                            (1, 4096, 1052671, None),
+                            (2, 1052672, end, None)],
+            ('uefi', False): [(15, mb, 1050623, 'boot'),
+                              (1, 1050624, end, None)],
+            ('prep', False): [(1, mb, 18431, 'prep'), (2, 18432, end, None)],
+        }
+        for ((ptfmt, boot), layout) in expected.items():
+            table = block_meta.simple_partition_table(disk, ptfmt, boot=boot)
+            self.assertEqual(
+                layout, [(p.number, p.start, p.end, p.flag)
+                         for p in table.partitions], (ptfmt, boot))
+
+    @patch('curtin.commands.block_meta.udevadm_settle')
+    def test_partition_simple(self, mock_settle):
+        """partition_simple writes the table and wipes the partitions."""
+        disk = self._disk(64 << 20)
+        util.write_file(disk, b'\xff' * (16 << 20), omode='r+b')
+
+        table = block_meta.partition_simple(disk, 'prep')
+
+        data = util.load_file(disk, decode=False)
+        self.assertEqual(b'\x55\xaa', data[510:512])
+        self.assertEqual(b'EFI PART', data[512:520])
+        # the PReP partition fully, the root partition's start
+        self.assertEqual(b'\0' * (9 << 20), data[1 << 20:10 << 20])
+        self.assertEqual(b'\xff', data[10 << 20:(10 << 20) + 1])
+        self.assertEqual(2, len(table.partitions))
+        mock_settle.assert_called_with()
+
 
 class TestBlockMeta(CiTestCase):
 
@@ -121,6 +437,7 @@ class TestBlockMeta(CiTestCase):
         basepath = 'curtin.commands.block_meta.'
         self.add_patch(basepath + 'get_path_to_storage_volume', 'mock_getpath')
         self.add_patch(basepath + 'make_dname', 'mock_make_dname')
+        self.add_patch(basepath + 'devsync', 'mock_devsync')
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
         self.add_patch('curtin.util.subp', 'mock_subp')
@@ -145,6 +462,14 @@ class TestBlockMeta(CiTestCase):
                        'mock_block_get_volume_uuid')
         self.add_patch('curtin.block.zero_file_at_offsets',
                        'mock_block_zero_file')
+        self.add_patch('curtin.block.partition_table.new_table',
+                       'mock_new_table')
+        self.add_patch('curtin.block.partition_table.write_table',
+                       'mock_write_table')
+        # a 4GiB disk
+        self.mock_new_table.side_effect = (
+            lambda path, label: partition_table.PartitionTable(label,
+                                                               8388608))
 
         self.target = "my_target"
         self.config = {
@@ -192,9 +517,6 @@ class TestBlockMeta(CiTestCase):
         disk = info.get('path')
         self.mock_getpath.return_value = disk
         self.mock_block_get_part_table_type.return_value = 'dos'
-        self.mock_subp.side_effect = iter([
-            (0, 0),  # parted mklabel
-        ])
         holders = ['md1']
         self.mock_get_holders.return_value = holders
 
@@ -204,6 +526,9 @@ class TestBlockMeta(CiTestCase):
         print("assert_clear: %s" % self.mock_assert_clear.call_args_list)
         self.mock_clear_holders.assert_called_with(disk)
         self.mock_assert_clear.assert_called_with(disk)
+        self.mock_new_table.assert_called_with(disk, 'msdos')
+        (path, table) = self.mock_write_table.call_args[0]
+        self.assertEqual((disk, []), (path, table.partitions))
 
     def test_partition_handler_wipes_at_partition_offset(self):
         """ Test wiping partition at offset prior to creating partition"""
@@ -224,9 +549,94 @@ class TestBlockMeta(CiTestCase):
         part_offset = 2048 * 512
         self.mock_block_zero_file.assert_called_with(disk_kname, [part_offset],
                                                      exclusive=False)
-        self.mock_subp.assert_called_with(['parted', disk_kname, '--script',
-                                           'mkpart', 'primary', '2048s',
-                                           '1001471s'], capture=True)
+        (path, table) = self.mock_write_table.call_args[0]
+        self.assertEqual(disk_kname, path)
+        self.assertEqual([(1, 2048, 1001471)], self._layout(table))
+        self.assertEqual(0, self.mock_subp.call_count)
+
+    def _layout(self, table):
+        return [(p.number, p.start, p.end) for p in table.partitions]
+
+    def _add_partitions(self, ptable, partitions):
+        self.storage_config['sda']['ptable'] = ptable
+        for (number, size, flag) in partitions:
+            part_id = 'sda-part%d' % number
+            self.storage_config[part_id] = {
+                'id': part_id, 'type': 'partition', 'device': 'sda',
+                'number': number, 'size': size, 'flag': flag}
+        self.mock_getpath.return_value = '/wark/xxx'
+        self.mock_block_path_to_kname.return_value = 'xxx'
+        self.mock_block_sys_block_path.return_value = '/sys/class/block/xxx'
+
+    def test_partition_handler_creates_disk_partitions_at_once(self):
+        """All partitions of a disk are written in one table."""
+        self._add_partitions('gpt', [(2, '1G', 'swap'), (3, '2G', None)])
+
+        for part_id in ('sda-part1', 'sda-part2', 'sda-part3'):
+            block_meta.partition_handler(self.storage_config[part_id],
+                                         self.storage_config)
+
+        self.assertEqual(1, self.mock_write_table.call_count)
+        table = self.mock_write_table.call_args[0][1]
+        self.assertEqual([(1, 2048, 1001471), (2, 1001472, 3098623),
+                          (3, 3098624, 7292927)], self._layout(table))
+        self.assertEqual(['boot', 'swap', None],
+                         [p.flag for p in table.partitions])
+        self.assertEqual(0, self.mock_subp.call_count)
+        self.assertEqual(1, self.mock_getpath.call_count)
+        self.assertEqual(3, self.mock_make_dname.call_count)
+        # the disk is synced once for all partitions
+        self.mock_devsync.assert_called_once_with(
+            self.mock_getpath.return_value)
+
+    def test_partition_handler_creates_logical_partitions(self):
+        """Logical partitions are placed inside the extended partition."""
+        self._add_partitions('msdos', [(2, '2G', 'extended'),
+                                       (5, '1G', 'logical')])
+
+        block_meta.partition_handler(self.storage_config['sda-part1'],
+                                     self.storage_config)
+
+        table = self.mock_write_table.call_args[0][1]
+        self.assertEqual([(1, 2048, 1001471), (2, 1001472, 5197823),
+                          (5, 1003520, 3100671)], self._layout(table))
+
+    @patch('curtin.commands.block_meta.plan_partitions')
+    def test_partition_handler_preserved_partitions_sgdisk(self, mock_plan):
+        """New partitions are added to a table with preserved ones by
+        sgdisk."""
+        self._add_partitions('gpt', [(2, '1G', 'swap')])
+        mock_plan.return_value = [
+            {'id': 'sda-part1', 'number': 1, 'flag': 'boot', 'offset': 2048,
+             'length': 999423, 'preserve': True, 'wipe': None},
+            {'id': 'sda-part2', 'number': 2, 'flag': 'swap',
+             'offset': 1001472, 'length': 2097151, 'preserve': False,
+             'wipe': None}]
+
+        block_meta.partition_handler(self.storage_config['sda-part1'],
+                                     self.storage_config)
+
+        self.mock_subp.assert_called_once_with(
+            ['sgdisk', '--new', '2:1001472:3098623', '--typecode=2:8200',
+             '/wark/xxx'], capture=True)
+        self.assertEqual(0, self.mock_write_table.call_count)
+
+    def test_partition_plan_preserved_partition_from_sysfs(self):
+        """Preserved partitions keep their place and are not created."""
+        self._add_partitions('gpt', [(2, '1G', None)])
+        self.storage_config['sda-part1']['preserve'] = True
+        sysfs = self.tmp_dir()
+        part1 = os.path.join(sysfs, 'xxx1')
+        os.makedirs(part1)
+        util.write_file(os.path.join(part1, 'start'), '4096')
+        util.write_file(os.path.join(part1, 'size'), '4096')
+
+        plan = block_meta.plan_partitions('sda', self.storage_config, 512,
+                                          sysfs, 'xxx')
+
+        self.assertEqual([(1, True), (2, False)],
+                         [(p['number'], p['preserve']) for p in plan])
+        self.assertEqual(8192, plan[1]['offset'])
 
     @patch('curtin.util.write_file')
     def test_mount_handler_defaults(self, mock_write_file):
@@ -347,6 +757,46 @@ class TestZpoolHandler(CiTestCase):
                                               altroot="mytarget")
 
 
+class TestFormatBatchHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestFormatBatchHandler, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'mkfs.mkfs_batch', 'm_mkfs_batch')
+        self.add_patch(basepath + 'udevadm_trigger', 'm_trigger')
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.m_getpath.side_effect = lambda volume, sconfig: '/dev/' + volume
+        self.storage_config = block_meta.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': [
+                {'id': 'sda1', 'type': 'partition'},
+                {'id': 'sdb1', 'type': 'partition'},
+                {'id': 'bcache0', 'type': 'bcache'},
+                {'id': 'sda1-fs', 'type': 'format', 'volume': 'sda1',
+                 'fstype': 'ext4', 'label': 'root'},
+                {'id': 'sdb1-fs', 'type': 'format', 'volume': 'sdb1',
+                 'fstype': 'xfs', 'preserve': True},
+                {'id': 'bcache0-fs', 'type': 'format', 'volume': 'bcache0',
+                 'fstype': 'ext4'},
+            ]}})
+
+    def test_one_batch(self):
+        """The file systems are made together, skipping preserved ones."""
+        infos = [self.storage_config[k]
+                 for k in ('sda1-fs', 'sdb1-fs', 'bcache0-fs')]
+        block_meta.format_batch_handler(infos, self.storage_config)
+        options = {'strict': False, 'force': True, 'uuid': None}
+        self.m_mkfs_batch.assert_called_once_with([
+            ('/dev/sda1', 'ext4', dict(options, label='root')),
+            ('/dev/bcache0', 'ext4', dict(options, label=None))])
+        self.m_trigger.assert_called_once_with(['/dev/bcache0'])
+
+    def test_all_preserved(self):
+        block_meta.format_handler(self.storage_config['sdb1-fs'],
+                                  self.storage_config)
+        self.assertEqual(0, self.m_mkfs_batch.call_count)
+        self.assertEqual(0, self.m_trigger.call_count)
+
+
 class TestZFSRootUpdates(CiTestCase):
     zfsroot_id = 'myrootfs'
     base = [
@@ -766,4 +1216,261 @@ class TestFstabData(CiTestCase):
         # dir should be created before call to subp failed.
         self.assertTrue(os.path.isdir(mp))
 
+
+class TestStorageHandlerOrder(CiTestCase):
+
+    def setUp(self):
+        super(TestStorageHandlerOrder, self).setUp()
+        config = []
+        for disk in ('sda', 'sdb'):
+            config.extend([
+                {'id': disk, 'type': 'disk', 'ptable': 'gpt'},
+                {'id': disk + '1', 'type': 'partition', 'device': disk},
+                {'id': disk + '2', 'type': 'partition', 'device': disk},
+                {'id': disk + '1-fs', 'type': 'format',
+                 'volume': disk + '1'},
+            ])
+        config.extend([
+            {'id': 'vg0', 'type': 'lvm_volgroup', 'name': 'vg0',
+             'devices': ['sda2', 'sdb2']},
+            {'id': 'lv0', 'type': 'lvm_partition', 'volgroup': 'vg0',
+             'name': 'lv0'},
+            {'id': 'sda1-mnt', 'type': 'mount', 'device': 'sda1-fs',
+             'path': '/'},
+            {'id': 'sdb1-mnt', 'type': 'mount', 'device': 'sdb1-fs',
+             'path': '/srv'},
+        ])
+        self.storage_config = block_meta.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': config}})
+
+    def test_storage_dependencies(self):
+        deps = block_meta.storage_dependencies(self.storage_config)
+        self.assertEqual(set(), deps['sda'])
+        self.assertEqual(set(['sda']), deps['sda1'])
+        # partitions of a disk are handled in order
+        self.assertEqual(set(['sda', 'sda1']), deps['sda2'])
+        self.assertEqual(set(['sdb1']), deps['sdb1-fs'])
+        self.assertEqual(set(['sda2', 'sdb2']), deps['vg0'])
+        self.assertEqual(set(['vg0']), deps['lv0'])
+        # as are mounts
+        self.assertEqual(set(['sdb1-fs', 'sda1-mnt']), deps['sdb1-mnt'])
+
+    def test_serial_in_config_order(self):
+        handled = []
+        block_meta.run_storage_handlers(self.storage_config, handled.append)
+        self.assertEqual(list(self.storage_config.keys()), handled)
+
+    def test_independent_entries_concurrent(self):
+        """Entries of different disks are handled at the same time."""
+        started = threading.Event()
+        overlapped = []
+        handled = []
+        deps = block_meta.storage_dependencies(self.storage_config)
+
+        def handle(item_id):
+            self.assertTrue(deps[item_id].issubset(handled), item_id)
+            if item_id == 'sda1-fs':
+                overlapped.append(started.wait(10))
+            elif item_id == 'sdb1-fs':
+                started.set()
+            handled.append(item_id)
+
+        block_meta.run_storage_handlers(self.storage_config, handle,
+                                        workers=4)
+        self.assertEqual([True], overlapped)
+        self.assertEqual(sorted(self.storage_config.keys()), sorted(handled))
+
+    def test_error_stops_dependents(self):
+        handled = []
+
+        def handle(item_id):
+            if item_id == 'sda1':
+                raise RuntimeError('partitioning failed')
+            handled.append(item_id)
+
+        with self.assertRaisesRegexp(RuntimeError, 'partitioning failed'):
+            block_meta.run_storage_handlers(self.storage_config, handle,
+                                            workers=4)
+        for item_id in ('sda2', 'sda1-fs', 'vg0', 'lv0', 'sda1-mnt'):
+            self.assertNotIn(item_id, handled)
+
+    @patch('curtin.commands.block_meta.events.report_finish_event')
+    @patch('curtin.commands.block_meta.events.report_start_event')
+    @patch('curtin.commands.block_meta.clear_holders.assert_clear')
+    @patch('curtin.commands.block_meta.clear_holders.clear_holders')
+    @patch('curtin.commands.block_meta.clear_holders.'
+           'start_clear_holders_deps')
+    @patch('curtin.commands.block_meta.util.load_command_environment')
+    @patch('curtin.commands.block_meta.config.load_command_config')
+    def _meta_custom_events(self, workers, m_load_config, m_load_env,
+                            m_deps, m_clear_holders, m_assert_clear,
+                            m_start, m_finish):
+        m_load_env.return_value = {'report_stack_prefix': 'block-meta'}
+        storage = {'version': 1, 'config': list(self.storage_config.values())}
+        if workers:
+            storage['workers'] = workers
+        m_load_config.return_value = {'storage': storage}
+        handlers = dict((name, Mock()) for name in (
+            'disk_handler', 'partition_handler', 'format_handler',
+            'mount_handler', 'lvm_volgroup_handler', 'lvm_partition_handler'))
+        with patch.multiple('curtin.commands.block_meta', **handlers):
+            block_meta.meta_custom(Namespace(umount=False))
+        return ([c[0][0] for c in m_start.call_args_list],
+                [c[0][0] for c in m_finish.call_args_list])
+
+    def test_meta_custom_serial_events(self):
+        """Entries handled one at a time report under the stack prefix."""
+        (started, finished) = self._meta_custom_events(None)
+        self.assertEqual(['block-meta'] * (len(self.storage_config) + 1),
+                         started)
+        self.assertEqual(started, finished)
+
+    def test_meta_custom_concurrent_events(self):
+        """Entries handled at the same time report under their own names."""
+        (started, finished) = self._meta_custom_events(4)
+        names = ['block-meta/' + item_id for item_id in self.storage_config]
+        self.assertEqual(['block-meta', 'block-meta'], started[:2])
+        self.assertEqual(sorted(names), sorted(started[2:]))
+        self.assertEqual(sorted(names), sorted(finished[1:-1]))
+        self.assertEqual(['block-meta', 'block-meta'],
+                         [finished[0], finished[-1]])
+
+    def test_batches(self):
+        """Entries of a batched type that are ready together are handled
+        in one call."""
+        for disk in ('sda', 'sdb'):
+            self.storage_config[disk + '2-fs'] = {
+                'id': disk + '2-fs', 'type': 'format', 'volume': disk + '2'}
+        handled = []
+        block_meta.run_storage_handlers(
+            self.storage_config, handled.append,
+            batches={'format': handled.append})
+        self.assertEqual(['sda', 'sda1', 'sda2', ['sda1-fs', 'sda2-fs'],
+                          'sdb', 'sdb1', 'sdb2', ['sdb1-fs', 'sdb2-fs'],
+                          'vg0', 'lv0', 'sda1-mnt', 'sdb1-mnt'], handled)
+
+    def test_dependency_cycle(self):
+        self.storage_config['sda']['device'] = 'sda1'
+        with self.assertRaises(ValueError):
+            block_meta.run_storage_handlers(self.storage_config, Mock())
+
+
+class TestVolumePaths(CiTestCase):
+
+    def setUp(self):
+        super(TestVolumePaths, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'devsync', 'm_devsync')
+        self.add_patch(basepath + 'block.lookup_disk', 'm_lookup_disk')
+        self.add_patch(basepath + 'glob.glob', 'm_glob')
+        self.add_patch(basepath + 'block.kname_to_path', 'm_kname_to_path')
+        self.m_kname_to_path.side_effect = lambda kname: '/dev/' + kname
+        self.m_lookup_disk.return_value = '/dev/sda'
+        self.m_glob.return_value = ['/sys/block/bcache0/slaves/sda2']
+        self.storage_config = block_meta.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': [
+                {'id': 'sda', 'type': 'disk', 'serial': 'disk-a'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                 'number': 1},
+                {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                 'number': 2},
+                {'id': 'bcache0', 'type': 'bcache', 'backing_device': 'sda2'},
+                {'id': 'md0', 'type': 'raid', 'name': 'md0'},
+            ]}})
+
+    def _paths(self, *volumes):
+        return [block_meta.get_path_to_storage_volume(v, self.storage_config)
+                for v in volumes]
+
+    def test_uncached(self):
+        """Without volume_paths() every lookup resolves and syncs."""
+        self.assertEqual(['/dev/sda1', '/dev/sda1'],
+                         self._paths('sda1', 'sda1'))
+        self.assertEqual(2, self.m_lookup_disk.call_count)
+        self.assertEqual([call('/dev/sda')] * 4,
+                         self.m_devsync.call_args_list)
+
+    def test_lookups_cached(self):
+        with block_meta.volume_paths():
+            self.assertEqual(
+                ['/dev/sda1', '/dev/sda2', '/dev/bcache0', '/dev/sda1',
+                 '/dev/bcache0', '/dev/md0'],
+                self._paths('sda1', 'sda2', 'bcache0', 'sda1', 'bcache0',
+                            'md0'))
+        self.assertEqual(1, self.m_lookup_disk.call_count)
+        self.assertEqual(1, self.m_glob.call_count)
+        # the partitions share the sync of their disk
+        self.assertEqual([call('/dev/sda'), call('/dev/bcache0'),
+                          call('/dev/md0')], self.m_devsync.call_args_list)
+        # the cache only applies within the context
+        self._paths('md0')
+        self.assertEqual(call('/dev/md0'), self.m_devsync.call_args)
+        self.assertEqual(4, self.m_devsync.call_count)
+
+    def test_synced(self):
+        """Devices recorded as synced are not synced by lookups."""
+        with block_meta.volume_paths() as paths:
+            paths.synced('/dev/sda')
+            self._paths('sda', 'sda1', 'sda2')
+        self.assertEqual(0, self.m_devsync.call_count)
+
+    def test_failed_lookups_not_cached(self):
+        self.m_devsync.side_effect = [OSError('no device'), None]
+        with block_meta.volume_paths():
+            with self.assertRaises(OSError):
+                self._paths('md0')
+            self.assertEqual(['/dev/md0', '/dev/md0'],
+                             self._paths('md0', 'md0'))
+        self.assertEqual(2, self.m_devsync.call_count)
+
+    def test_invalidate(self):
+        """Invalidated entries and those resolved through them are resolved
+        and synced again."""
+        with block_meta.volume_paths():
+            self._paths('sda1', 'bcache0', 'md0')
+            block_meta.invalidate_volume_paths('sda2')
+            self.m_devsync.reset_mock()
+            self._paths('sda1', 'md0', 'bcache0')
+            # the disk stays synced when one of its partitions changes
+            self.assertEqual([call('/dev/bcache0')],
+                             self.m_devsync.call_args_list)
+            self.assertEqual(2, self.m_glob.call_count)
+
+            block_meta.invalidate_volume_paths('sda')
+            self.m_devsync.reset_mock()
+            self._paths('md0', 'sda1', 'sda2')
+            self.assertEqual([call('/dev/sda')],
+                             self.m_devsync.call_args_list)
+            self.assertEqual(2, self.m_lookup_disk.call_count)
+
+    @patch('curtin.commands.block_meta.partition_handler', Mock())
+    @patch('curtin.commands.block_meta.run_storage_handlers')
+    @patch('curtin.commands.block_meta.clear_holders.assert_clear')
+    @patch('curtin.commands.block_meta.clear_holders.clear_holders')
+    @patch('curtin.commands.block_meta.clear_holders.'
+           'start_clear_holders_deps')
+    @patch('curtin.commands.block_meta.util.load_command_environment')
+    @patch('curtin.commands.block_meta.config.load_command_config')
+    def test_meta_custom_invalidates_handled_entries(
+            self, m_load_config, m_load_env, m_deps, m_clear_holders,
+            m_assert_clear, m_run):
+        m_load_env.return_value = {}
+        m_load_config.return_value = {'storage': {
+            'version': 1, 'config': list(self.storage_config.values())}}
+        looked_up = []
+
+        def run_storage_handlers(storage_config, handle, workers, batches):
+            self.assertIsNotNone(block_meta._volume_paths)
+            self._paths('sda1', 'sda2')
+            handle('sda2')
+            looked_up.append(self._paths('sda1', 'sda2'))
+
+        m_run.side_effect = run_storage_handlers
+        block_meta.meta_custom(Namespace(umount=False))
+        self.assertEqual([['/dev/sda1', '/dev/sda2']], looked_up)
+        # sda2 was handled, which leaves the disk synced
+        self.assertEqual(1, self.m_devsync.call_count)
+        self.assertEqual(1, self.m_lookup_disk.call_count)
+        self.assertIsNone(block_meta._volume_paths)
+
 # vi: ts=4 expandtab syntax=python
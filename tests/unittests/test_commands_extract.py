@@ -1,15 +1,21 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+import mock
 import os
+import tarfile
 
 from .helpers import CiTestCase
 
+from curtin import streams
+from curtin import url_helper
 from curtin import util
-from curtin.commands.extract import extract_root_fsimage_url
+from curtin.commands import extract
+from curtin.commands.extract import (extract_root_fsimage_url,
+                                     extract_root_tgz_url)
 
 
 class TestExtractRootFsImageUrl(CiTestCase):
     """Test extract_root_fsimage_url."""
-    def _fake_download(self, url, path):
+    def _fake_download(self, url, path, resume=False, checksum=None):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -21,6 +27,9 @@ class TestExtractRootFsImageUrl(CiTestCase):
                        "m_download", side_effect=self._fake_download)
         self.add_patch("curtin.commands.extract._extract_root_fsimage",
                        "m__extract_root_fsimage")
+        self.tmpdir = self.tmp_dir()
+        self.add_patch("curtin.commands.extract.tempfile.gettempdir",
+                       "m_gettempdir", return_value=self.tmpdir)
 
     def test_relative_file_url(self):
         """extract_root_fsimage_url supports relative file:// urls."""
@@ -58,6 +67,72 @@ class TestExtractRootFsImageUrl(CiTestCase):
         self.assertEqual(1, len(self.downloads))
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_http_url_download_failure_kept(self):
+        """A failed http download is kept to be resumed."""
+        target = self.tmp_path("target_d", self.tmp_dir())
+        myurl = "http://bogus.example.com/my-failed.img"
+
+        def failed_download(url, path, resume=False, checksum=None):
+            self._fake_download(url, path)
+            raise url_helper.UrlError("failed")
+
+        self.m_download.side_effect = failed_download
+        with self.assertRaises(url_helper.UrlError):
+            extract_root_fsimage_url(myurl, target)
+        self.m_download.assert_called_with(myurl, mock.ANY, resume=True,
+                                           checksum=None)
+        self.assertEqual(1, len(self.downloads))
+        self.assertTrue(os.path.exists(self.downloads[0]))
+        self.assertEqual(0, self.m__extract_root_fsimage.call_count)
+
+        # the second attempt resumes into the same file and removes it
+        self.m_download.side_effect = self._fake_download
+        extract_root_fsimage_url(myurl, target)
+        self.assertEqual([self.downloads[0]] * 2, self.downloads)
+        self.assertFalse(os.path.exists(self.downloads[0]))
+
+    def test_http_url_download_dir(self):
+        """http downloads go to a directory private to the user."""
+        myurl = "http://bogus.example.com/my.img"
+        extract_root_fsimage_url(myurl, self.tmp_path("target_d"))
+        download_dir = os.path.join(self.tmpdir,
+                                    "curtin-fsimage-%d" % os.getuid())
+        self.assertEqual(download_dir, os.path.dirname(self.downloads[0]))
+        self.assertEqual(0o700, os.stat(download_dir).st_mode & 0o777)
+        self.m_download.assert_called_with(myurl, mock.ANY, resume=True,
+                                           checksum=None)
+
+    def test_http_url_download_dir_not_private(self):
+        """Downloads are not resumed from a directory others can write."""
+        myurl = "http://bogus.example.com/my.img"
+        download_dir = os.path.join(self.tmpdir,
+                                    "curtin-fsimage-%d" % os.getuid())
+        os.symlink(self.tmp_dir(), download_dir)
+        extract_root_fsimage_url(myurl, self.tmp_path("target_d"))
+        self.m_download.assert_called_with(myurl, mock.ANY, resume=False,
+                                           checksum=None)
+        self.assertNotEqual(download_dir, os.path.dirname(self.downloads[0]))
+        self.assertFalse(os.path.exists(os.path.dirname(self.downloads[0])))
+
+        os.unlink(download_dir)
+        os.mkdir(download_dir, 0o777)
+        os.chmod(download_dir, 0o777)
+        extract_root_fsimage_url(myurl, self.tmp_path("target_d"))
+        self.m_download.assert_called_with(myurl, mock.ANY, resume=False,
+                                           checksum=None)
+
+    def test_http_url_cached(self):
+        """extract_root_fsimage_url mounts the cache entry of http urls."""
+        target = self.tmp_path("target_d", self.tmp_dir())
+        myurl = "http://bogus.example.com/my.img"
+        cache = mock.Mock()
+        cache.fetch.return_value = "/var/cache/curtin/images/url-abc"
+        extract_root_fsimage_url(myurl, target, cache=cache, sha256="abc")
+        cache.fetch.assert_called_with(myurl, sha256="abc")
+        self.m__extract_root_fsimage.assert_called_with(
+            "/var/cache/curtin/images/url-abc", target, reportstack=None)
+        self.assertEqual(0, self.m_download.call_count)
+
     def test_file_path_not_url(self):
         """extract_root_fsimage_url supports normal file path without file:."""
         tmpd = self.tmp_dir()
@@ -69,4 +144,91 @@ class TestExtractRootFsImageUrl(CiTestCase):
         self.assertEqual(0, self.m_download.call_count)
 
 
+class TestExtractRootFsImage(CiTestCase):
+    """Test _extract_root_fsimage."""
+
+    def setUp(self):
+        super(TestExtractRootFsImage, self).setUp()
+        self.add_patch("curtin.commands.extract.util.subp", "m_subp")
+        self.add_patch("curtin.commands.extract.util.which", "m_which",
+                       return_value="/usr/bin/unsquashfs")
+        self.add_patch("curtin.commands.extract.copy_to_target",
+                       "m_copy_to_target")
+        self.tmpd = self.tmp_dir()
+        self.target = self.tmp_path("target_d", self.tmpd)
+        self.image = self.tmp_path("root.img", self.tmpd)
+
+    def test_squashfs_unpacked(self):
+        """squashfs images are unpacked by unsquashfs, not mounted."""
+        util.write_file(self.image, b'hsqs' + b'\0' * 92, omode='wb')
+        extract._extract_root_fsimage(self.image, self.target)
+        self.m_subp.assert_called_once_with(
+            ['unsquashfs', '-f', '-no-progress', '-processors', mock.ANY,
+             '-d', self.target, self.image], capture=True)
+        self.assertEqual(0, self.m_copy_to_target.call_count)
+
+    def test_squashfs_without_unsquashfs_mounted(self):
+        """squashfs images are mounted if unsquashfs is not installed."""
+        self.m_which.return_value = None
+        util.write_file(self.image, b'hsqs' + b'\0' * 92, omode='wb')
+        extract._extract_root_fsimage(self.image, self.target)
+        self.assertEqual('mount', self.m_subp.call_args_list[0][0][0][0])
+        self.assertEqual(1, self.m_copy_to_target.call_count)
+
+    def test_other_fs_mounted(self):
+        """Other filesystem images are mounted and copied."""
+        util.write_file(self.image, b'\0' * 4096, omode='wb')
+        extract._extract_root_fsimage(self.image, self.target)
+        self.assertEqual(['mount', '-o', 'loop,ro', self.image, mock.ANY],
+                         self.m_subp.call_args_list[0][0][0])
+        self.m_copy_to_target.assert_called_with(mock.ANY, self.target,
+                                                 reportstack=None)
+
+
+class TestExtractRootTgzUrl(CiTestCase):
+    """Test extract_root_tgz_url."""
+
+    def setUp(self):
+        super(TestExtractRootTgzUrl, self).setUp()
+        self.tmpd = self.tmp_dir()
+        self.target = self.tmp_path("target_d", self.tmpd)
+        content = self.tmp_path("hello.txt", self.tmpd)
+        util.write_file(content, "hello world\n")
+        self.tgz = self.tmp_path("root.tar.gz", self.tmpd)
+        with tarfile.open(self.tgz, "w:gz") as tfile:
+            tfile.add(content, arcname="hello.txt")
+
+    def test_file_url(self):
+        """extract_root_tgz_url extracts file:// urls in process."""
+        with mock.patch('curtin.commands.extract.util.subp') as m_subp:
+            extract_root_tgz_url("file://" + self.tgz, self.target)
+        self.assertEqual(0, m_subp.call_count)
+        self.assertEqual(
+            "hello world\n",
+            util.load_file(os.path.join(self.target, "hello.txt")))
+
+    def test_checksum_mismatch(self):
+        """A tarball not matching the source checksum fails extraction."""
+        with self.assertRaises(streams.ChecksumError):
+            extract_root_tgz_url("file://" + self.tgz, self.target,
+                                 checksum=('sha512', '0' * 128))
+
+    @mock.patch('curtin.reporter.events.report_progress_event')
+    @mock.patch('curtin.commands.extract.url_helper.UrlReader')
+    def test_http_url(self, m_reader, m_report):
+        """extract_root_tgz_url streams http urls through UrlReader."""
+        with open(self.tgz, "rb") as fp:
+            data = fp.read()
+        m_reader.return_value.read.side_effect = [data, b'']
+        m_reader.return_value.size = str(len(data))
+        reportstack = mock.Mock(fullname='cmd-extract')
+        extract_root_tgz_url("http://bogus.example.com/root.tar.gz",
+                             self.target, reportstack=reportstack)
+        m_reader.assert_called_with("http://bogus.example.com/root.tar.gz")
+        self.assertEqual(
+            "hello world\n",
+            util.load_file(os.path.join(self.target, "hello.txt")))
+        m_report.assert_called_with('cmd-extract', mock.ANY)
+
+
 # vi: ts=4 expandtab syntax=python
@@ -0,0 +1,173 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import socket
+import threading
+import time
+
+from curtin.commands import image_cache as image_cache_cmd
+from curtin import image_cache
+from curtin import url_helper
+from .helpers import CiTestCase
+from .test_url_helper import RangeServerTestCase
+
+
+class TestUpstreamUrl(CiTestCase):
+
+    def test_upstream_url(self):
+        """upstream_url maps /<scheme>/<host>/<path> to a url."""
+        self.assertEqual(
+            'http://host:8080/a/b.img?x=1',
+            image_cache_cmd.upstream_url('/http/host:8080/a/b.img?x=1',
+                                         ['host']))
+
+    def test_server_url_roundtrip(self):
+        """server_url and upstream_url are inverses."""
+        url = 'https://cloud-images.example.com/root.tar.xz'
+        served = image_cache.server_url('http://cache:8480/', url)
+        self.assertEqual(
+            'http://cache:8480/https/cloud-images.example.com/root.tar.xz',
+            served)
+        self.assertEqual(url, image_cache_cmd.upstream_url(
+            served[len('http://cache:8480'):],
+            ['cloud-images.example.com']))
+        self.assertEqual('file:///a/b',
+                         image_cache.server_url('http://cache', 'file:///a/b'))
+
+    def test_invalid_paths(self):
+        """Paths of other schemes or disallowed hosts raise ValueError."""
+        for path in ('/', '/file/etc/passwd', '/http'):
+            with self.assertRaises(ValueError):
+                image_cache_cmd.upstream_url(path, ['good'])
+        for allowed in (['good'], [], None):
+            with self.assertRaises(ValueError):
+                image_cache_cmd.upstream_url('/http/evil/a', allowed)
+        self.assertEqual('http://good:80/a', image_cache_cmd.upstream_url(
+            '/http/good:80/a', ['good']))
+
+
+class TestParseRange(CiTestCase):
+
+    def test_parse_range(self):
+        """parse_range handles bounded, open and suffix ranges."""
+        self.assertEqual((0, 9), image_cache_cmd.parse_range('bytes=0-9', 100))
+        self.assertEqual((90, 99),
+                         image_cache_cmd.parse_range('bytes=90-', 100))
+        self.assertEqual((90, 99),
+                         image_cache_cmd.parse_range('bytes=90-200', 100))
+        self.assertEqual((80, 99),
+                         image_cache_cmd.parse_range('bytes=-20', 100))
+
+    def test_whole_object(self):
+        """Missing, multiple or inverted ranges mean the whole object."""
+        for header in (None, 'bytes=0-1,5-6', 'bytes=9-2', 'items=0-1'):
+            self.assertIsNone(image_cache_cmd.parse_range(header, 100))
+
+    def test_unsatisfiable(self):
+        """Ranges past the end of the object raise ValueError."""
+        for header in ('bytes=100-', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                image_cache_cmd.parse_range(header, 100)
+
+
+class TestImageCacheServer(RangeServerTestCase):
+
+    def setUp(self):
+        super(TestImageCacheServer, self).setUp()
+        self.cache = image_cache.ImageCache(
+            self.tmp_path('cache', self.tmp_dir()), max_size=1024 * 1024)
+        self.cache_server = image_cache_cmd.ImageCacheServer(
+            ('127.0.0.1', 0), self.cache, allowed_hosts=['127.0.0.1'])
+        thread = threading.Thread(target=self.cache_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.cache_server.server_close)
+        self.addCleanup(self.cache_server.shutdown)
+        self.served = image_cache.server_url(
+            'http://127.0.0.1:%d' % self.cache_server.server_port, self.url)
+
+    def load_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def wait_for_entries(self, count):
+        # the entry is published once the server has sent all of it
+        for _ in range(100):
+            if len(self.cache.entries()) == count:
+                break
+            time.sleep(0.05)
+        self.assertEqual(count, len(self.cache.entries()))
+
+    def test_fill_then_serve_from_cache(self):
+        """The first request fills the cache, later ones do not go
+        upstream."""
+        self.assertEqual(self.content, url_helper.geturl(self.served))
+        self.wait_for_entries(1)
+        upstream_gets = len(self.server.requests)
+        self.assertEqual(self.content, url_helper.geturl(self.served))
+        self.assertEqual(upstream_gets, len(self.server.requests))
+
+    def test_ranged_download(self):
+        """Clients download from the server in concurrent ranges."""
+        url_helper.download(self.served, self.target, workers=3,
+                            chunk_size=1000)
+        self.assertEqual(self.content, self.load_target())
+        self.wait_for_entries(1)
+        reader = url_helper.UrlReader(self.served,
+                                      headers={'Range': 'bytes=7-13'})
+        with reader:
+            self.assertEqual(206, reader.status)
+            self.assertEqual(self.content[7:14], reader.read(100))
+        self.assertEqual('"1"', reader.info.get('etag'))
+
+    def test_uncacheable_passed_through(self):
+        """Images too large for the cache are streamed from upstream."""
+        self.cache.max_size = 100
+        self.assertEqual(self.content, url_helper.geturl(self.served))
+        self.assertEqual([], self.cache.entries())
+
+    def test_download_in_progress_passed_through(self):
+        """Requests for an image being cached elsewhere are streamed from
+        upstream."""
+        key = image_cache.url_key(self.url, {'etag': '"1"'})
+        lock = self.cache._try_download_lock(key)
+        try:
+            self.assertEqual(self.content, url_helper.geturl(self.served))
+            self.assertEqual([], self.cache.entries())
+        finally:
+            self.cache._release_download_lock(key, lock)
+        self.assertEqual(self.content, url_helper.geturl(self.served))
+        self.wait_for_entries(1)
+
+    def test_upstream_error_after_headers(self):
+        """An upstream failure after the headers were sent closes the
+        connection rather than sending an error status."""
+        reader = mock.MagicMock(info={'Content-Length': '100'})
+        reader.__enter__.return_value = reader
+        reader.read.side_effect = [b'x' * 10,
+                                   url_helper.UrlError(IOError('gone'))]
+        conn = socket.create_connection(
+            ('127.0.0.1', self.cache_server.server_port))
+        self.addCleanup(conn.close)
+        with mock.patch.object(self.cache, 'fill', return_value=reader):
+            conn.sendall(('GET %s HTTP/1.0\r\n\r\n' %
+                          self.served.split(':%d' % self.cache_server.
+                                            server_port)[1]).encode())
+            response = b''
+            while True:
+                buf = conn.recv(4096)
+                if not buf:
+                    break
+                response += buf
+        (head, _sep, data) = response.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(b'x' * 10, data)
+
+    def test_bad_path(self):
+        """Requests not naming an upstream url are answered with 404."""
+        with self.assertRaises(url_helper.UrlError) as ctx:
+            url_helper.geturl('http://127.0.0.1:%d/file/etc/passwd' %
+                              self.cache_server.server_port)
+        self.assertEqual(404, ctx.exception.code)
+
+# vi: ts=4 expandtab syntax=python
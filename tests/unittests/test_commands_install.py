@@ -190,6 +190,42 @@ class TestCmdInstall(CiTestCase):
             [mock.call(self.logfile, target_dir, '/root/curtin-install.log')],
             self.m_copy_log.call_args_list)
 
+    def _prefetch_cfg(self, cfg):
+        """Return the config cmd_install hands to its stages."""
+        cfg.update({'install': {'log_file': self.logfile,
+                                'unmount': 'disabled'},
+                    'prefetch': {'max_size': '1G'}})
+        myargs = FakeArgs(config=cfg,
+                          source=['http://localhost/root.tar.gz'],
+                          reportstack=FakeReportStack())
+        self.add_patch(
+            'curtin.commands.install.copy_install_log', 'm_copy_log')
+        self.add_patch('curtin.commands.collect_logs.create_log_tarfile',
+                       'm_tar')
+        self.add_patch('curtin.commands.install.prefetch.from_config',
+                       'm_prefetch')
+        self.m_prefetch.return_value.cache_config.return_value = {
+            'path': '/tmp/staging', 'max_size': 1000}
+        self.add_patch('curtin.commands.install.WorkingDir', 'm_workingd',
+                       side_effect=ValueError('stop'))
+        with self.assertRaises(ValueError):
+            install.cmd_install(myargs)
+        return self.m_workingd.call_args[0][0]
+
+    def test_prefetch_staging_cache(self):
+        """The prefetch staging cache is passed to extract only."""
+        cfg = self._prefetch_cfg({})
+        self.assertEqual({'path': '/tmp/staging', 'max_size': 1000},
+                         cfg['prefetch_cache'])
+        self.assertNotIn('image_cache', cfg)
+
+    def test_prefetch_into_image_cache(self):
+        """Sources prefetched into the image_cache are read from it."""
+        image_cache = {'path': self.tmp_dir()}
+        cfg = self._prefetch_cfg({'image_cache': image_cache})
+        self.assertNotIn('prefetch_cache', cfg)
+        self.assertEqual(image_cache, cfg['image_cache'])
+
 
 class TestWorkingDir(CiTestCase):
     def test_target_dir_may_exist(self):
@@ -0,0 +1,226 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import hashlib
+import mock
+import os
+import threading
+import time
+
+from curtin import image_cache
+from curtin import util
+from .helpers import CiTestCase
+
+
+class TestFromConfig(CiTestCase):
+
+    def test_not_configured(self):
+        """from_config returns None without image_cache config."""
+        self.assertIsNone(image_cache.from_config({}))
+
+    def test_disabled(self):
+        """from_config honors enabled: false."""
+        cfg = {'image_cache': {'enabled': False, 'path': self.tmp_dir()}}
+        self.assertIsNone(image_cache.from_config(cfg))
+
+    def test_path_and_max_size(self):
+        """from_config reads path and a human readable max_size."""
+        tmpd = self.tmp_dir()
+        cache = image_cache.from_config(
+            {'image_cache': {'path': tmpd, 'max_size': '2M'}})
+        self.assertEqual(tmpd, cache.path)
+        self.assertEqual(2 * 1024 * 1024, cache.max_size)
+
+    def test_key(self):
+        """from_config reads the cache configured by key."""
+        tmpd = self.tmp_dir()
+        cfg = {'prefetch_cache': {'path': tmpd, 'max_size': 1000}}
+        self.assertIsNone(image_cache.from_config(cfg))
+        cache = image_cache.from_config(cfg, key='prefetch_cache')
+        self.assertEqual(tmpd, cache.path)
+        self.assertEqual(1000, cache.max_size)
+
+
+class TestUrlKey(CiTestCase):
+
+    def test_no_validators(self):
+        """url_key returns None if headers have no ETag or Last-Modified."""
+        self.assertIsNone(image_cache.url_key('http://a/b', {}))
+
+    def test_validators_change_key(self):
+        """url_key differs when the url or a validator changes."""
+        key = image_cache.url_key('http://a/b', {'etag': '"1"'})
+        self.assertTrue(key.startswith('url-'))
+        self.assertEqual(key, image_cache.url_key('http://a/b',
+                                                  {'etag': '"1"'}))
+        self.assertNotEqual(key, image_cache.url_key('http://a/b',
+                                                     {'etag': '"2"'}))
+        self.assertNotEqual(key, image_cache.url_key('http://a/c',
+                                                     {'etag': '"1"'}))
+
+
+class TestServerSource(CiTestCase):
+
+    def test_server_source(self):
+        """server_source reads uri and bmap through the server."""
+        source = {'type': 'dd-raw', 'uri': 'http://host/disk.img',
+                  'bmap': 'file:///srv/disk.bmap'}
+        served = image_cache.server_source(source, 'http://cache:8480')
+        self.assertEqual('http://cache:8480/http/host/disk.img',
+                         served['uri'])
+        self.assertEqual('file:///srv/disk.bmap', served['bmap'])
+        self.assertEqual('http://host/disk.img', source['uri'])
+
+
+class TestImageCache(CiTestCase):
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        self.tmpd = self.tmp_dir()
+        self.cache = image_cache.ImageCache(
+            self.tmp_path('cache', self.tmpd), max_size=1000)
+
+    def _image(self, name, content):
+        path = self.tmp_path(name, self.tmpd)
+        util.write_file(path, content, omode='wb')
+        return 'file://' + path
+
+    def _read(self, url, sha256=None):
+        with self.cache.open(url, sha256=sha256) as reader:
+            data = b''
+            while True:
+                buf = reader.read(7)
+                if not buf:
+                    break
+                data += buf
+        return data, reader
+
+    def test_miss_then_hit(self):
+        """A complete read publishes an entry used by the next open."""
+        url = self._image('img', b'image data')
+        data, reader = self._read(url)
+        self.assertEqual(b'image data', data)
+        self.assertIsInstance(reader, image_cache.CacheFillReader)
+        self.assertTrue(os.path.exists(reader.path))
+
+        data, reader = self._read(url)
+        self.assertEqual(b'image data', data)
+        self.assertIsInstance(reader, image_cache.CacheEntryReader)
+        self.assertEqual([], os.listdir(
+            os.path.join(self.cache.path, image_cache.PARTIAL_DIR)))
+
+    def test_modified_source_is_a_miss(self):
+        """Changing Last-Modified of the source invalidates the entry."""
+        url = self._image('img', b'old data')
+        self._read(url)
+        path = url[len('file://'):]
+        util.write_file(path, b'new data', omode='wb')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        data, reader = self._read(url)
+        self.assertEqual(b'new data', data)
+        self.assertIsInstance(reader, image_cache.CacheFillReader)
+
+    def test_partial_read_not_published(self):
+        """Closing before the end of the data leaves the cache empty."""
+        url = self._image('img', b'image data')
+        with self.cache.open(url) as reader:
+            reader.read(3)
+        self.assertIsNone(reader.path)
+        self.assertEqual([], self.cache.entries())
+        self.assertEqual([], os.listdir(
+            os.path.join(self.cache.path, image_cache.PARTIAL_DIR)))
+
+    def test_declared_sha256(self):
+        """Entries of sources with a sha256 are found without the url."""
+        content = b'image data'
+        sha256 = hashlib.sha256(content).hexdigest()
+        url = self._image('img', content)
+        path = self.cache.fetch(url, sha256=sha256)
+        self.assertEqual(image_cache.content_key(sha256),
+                         os.path.basename(path))
+        with mock.patch('curtin.image_cache.url_helper') as m_url:
+            self.assertEqual(path, self.cache.fetch('http://other/img',
+                                                    sha256=sha256.upper()))
+        self.assertEqual([], m_url.method_calls)
+
+    def test_find_waits_for_download(self):
+        """find waits for a download of the url in progress elsewhere."""
+        url = self._image('img', b'image data')
+        key = self.cache._key(url)
+        started = threading.Event()
+
+        def download():
+            with self.cache._download_lock(key):
+                started.set()
+                time.sleep(0.2)
+                partial = os.path.join(self.cache.path,
+                                       image_cache.PARTIAL_DIR, key)
+                util.write_file(partial, b'image data', omode='wb')
+                self.cache.publish(key, partial, {'url': url})
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        started.wait()
+        path = self.cache.find(url)
+        thread.join()
+        self.assertEqual(self.cache.entry_path(key), path)
+
+    def test_declared_sha256_mismatch(self):
+        """Data not matching the declared sha256 is not published."""
+        url = self._image('img', b'image data')
+        with self.assertRaises(ValueError):
+            self.cache.fetch(url, sha256='0' * 64)
+        self.assertEqual([], self.cache.entries())
+
+    def test_no_validators_not_cached(self):
+        """Responses without validators are passed through uncached."""
+        reader = mock.MagicMock(info={}, size=10)
+        with mock.patch('curtin.image_cache.url_helper') as m_url:
+            m_url.head.return_value = {}
+            m_url.ResumableReader.return_value = reader
+            self.assertEqual(reader, self.cache.open('http://a/img'))
+            self.assertIsNone(self.cache.fetch('http://a/img'))
+        self.assertEqual(0, reader.read.call_count)
+        self.assertEqual([], os.listdir(
+            os.path.join(self.cache.path, image_cache.PARTIAL_DIR)))
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted to stay under max_size."""
+        urls = [self._image('img%d' % i, b'%d' % i * 400) for i in range(3)]
+        paths = [self.cache.fetch(url) for url in urls[:2]]
+        os.utime(paths[0], (1, 1))
+        os.utime(paths[1], (2, 2))
+        # a hit makes the first entry most recently used
+        self.assertEqual(paths[0], self.cache.fetch(urls[0]))
+        paths.append(self.cache.fetch(urls[2]))
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertEqual(800, sum(e[1] for e in self.cache.entries()))
+
+    def test_too_large_not_cached(self):
+        """Images larger than max_size are not downloaded into the cache."""
+        url = self._image('img', b'x' * 1001)
+        with mock.patch('curtin.image_cache.url_helper.download') as m_dl:
+            self.assertIsNone(self.cache.fetch(url))
+            self.assertIsInstance(self.cache.open(url),
+                                  image_cache.url_helper.ResumableReader)
+        self.assertEqual(0, m_dl.call_count)
+        self.assertEqual([], self.cache.entries())
+
+    def test_free_space(self):
+        """Entries are evicted to free space for an image, which is not
+        cached if it still does not fit."""
+        urls = [self._image('img%d' % i, b'%d' % i * 400) for i in range(3)]
+        paths = [self.cache.fetch(url) for url in urls[:2]]
+        os.utime(paths[0], (1, 1))
+        with mock.patch('curtin.image_cache.util.get_fs_use_info') as m_fs:
+            m_fs.side_effect = [(10000, 100), (10000, 500)]
+            self.assertTrue(os.path.exists(self.cache.fetch(urls[2])))
+            self.assertFalse(os.path.exists(paths[0]))
+            self.assertTrue(os.path.exists(paths[1]))
+
+            m_fs.side_effect = [(10000, 0), (10000, 0)]
+            self.assertIsNone(
+                self.cache.fetch(self._image('img3', b'x' * 300)))
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,139 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import mock
+import os
+
+from curtin import image_cache
+from curtin import prefetch
+from curtin import util
+from .helpers import CiTestCase
+
+
+def _source(uri, stype='tgz'):
+    return {'type': stype, 'uri': uri}
+
+
+class TestFromConfig(CiTestCase):
+
+    sources = {'10_root': _source('http://host/root.tar.gz'),
+               '20_dd': _source('http://host/disk.img', stype='dd-raw'),
+               '30_cp': _source('cp:///')}
+
+    def test_not_configured(self):
+        """from_config returns None without prefetch config."""
+        self.assertIsNone(prefetch.from_config({'sources': self.sources}))
+
+    def test_disabled(self):
+        """from_config honors enabled: false."""
+        cfg = {'sources': self.sources, 'prefetch': {'enabled': False}}
+        self.assertIsNone(prefetch.from_config(cfg))
+
+    def test_nothing_to_prefetch(self):
+        """Only sources downloaded by extract are prefetched."""
+        cfg = {'sources': {'20_dd': self.sources['20_dd']},
+               'prefetch': {}}
+        self.assertIsNone(prefetch.from_config(cfg))
+
+    def test_staging_cache(self):
+        """Without an image_cache, sources are staged at path, which is
+        kept."""
+        staging = self.tmp_path('staging', self.tmp_dir())
+        cfg = {'sources': self.sources,
+               'prefetch': {'path': staging, 'max_size': '1G'}}
+        prefetcher = prefetch.from_config(cfg)
+        self.assertEqual([self.sources['10_root']], prefetcher.sources)
+        self.assertEqual(staging, prefetcher.cache.path)
+        self.assertEqual(1024 ** 3, prefetcher.budget)
+        self.assertEqual({'path': staging, 'max_size': 1024 ** 3},
+                         prefetcher.cache_config())
+        prefetcher.cleanup()
+        self.assertTrue(os.path.exists(staging))
+
+    def test_temporary_staging_cache(self):
+        """A temporary staging cache is removed by cleanup."""
+        staging = self.tmp_path('staging', self.tmp_dir())
+        os.mkdir(staging)
+        cfg = {'sources': self.sources, 'prefetch': {'max_size': '1G'}}
+        with mock.patch('curtin.prefetch.tempfile.mkdtemp') as m_mkdtemp:
+            m_mkdtemp.return_value = staging
+            prefetcher = prefetch.from_config(cfg)
+        self.assertEqual(staging, prefetcher.cache.path)
+        prefetcher.cleanup()
+        self.assertFalse(os.path.exists(staging))
+
+    def test_cleanup_waits_for_download(self):
+        """The staging cache is removed only after the prefetch thread
+        has stopped, and kept if it does not stop in time."""
+        staging = self.tmp_path('staging', self.tmp_dir())
+        os.mkdir(staging)
+        prefetcher = prefetch.Prefetcher(mock.Mock(), [], 1000,
+                                         staging=staging)
+        with mock.patch.object(prefetcher, 'wait') as m_wait:
+            m_wait.return_value = False
+            prefetcher.cleanup()
+            self.assertTrue(os.path.exists(staging))
+            m_wait.return_value = True
+            prefetcher.cleanup()
+            self.assertFalse(os.path.exists(staging))
+        m_wait.assert_called_with(prefetch.CLEANUP_TIMEOUT)
+
+    def test_image_cache_used(self):
+        """A configured image_cache is prefetched into and kept."""
+        path = self.tmp_dir()
+        cfg = {'sources': self.sources, 'prefetch': {'max_size': '1G'},
+               'image_cache': {'path': path, 'max_size': '1M'}}
+        prefetcher = prefetch.from_config(cfg)
+        self.assertEqual(path, prefetcher.cache.path)
+        self.assertEqual(1024 * 1024, prefetcher.budget)
+        prefetcher.cleanup()
+        self.assertTrue(os.path.exists(path))
+
+
+class TestPrefetcher(CiTestCase):
+
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        self.tmpd = self.tmp_dir()
+        self.cache = image_cache.ImageCache(
+            self.tmp_path('cache', self.tmpd), max_size=10000)
+
+    def _image(self, name, content):
+        path = self.tmp_path(name, self.tmpd)
+        util.write_file(path, content, omode='wb')
+        return _source('file://' + path)
+
+    def test_fetches_sources_in_order(self):
+        """Sources are fetched into the cache on a thread."""
+        sources = [self._image('a', b'a' * 100), self._image('b', b'b' * 10)]
+        prefetcher = prefetch.Prefetcher(self.cache, sources, 1000)
+        prefetcher.start()
+        self.assertTrue(prefetcher.wait(10))
+        self.assertEqual(2, len(prefetcher.fetched))
+        self.assertEqual(110, prefetcher.used)
+        self.assertEqual(prefetcher.fetched[0],
+                         self.cache.find(sources[0]['uri']))
+
+    def test_budget(self):
+        """Sources exceeding the remaining budget are skipped."""
+        sources = [self._image('a', b'a' * 600), self._image('b', b'b' * 600),
+                   self._image('c', b'c' * 300)]
+        prefetcher = prefetch.Prefetcher(self.cache, sources, 1000)
+        prefetcher.start()
+        prefetcher.wait(10)
+        self.assertEqual(900, prefetcher.used)
+        self.assertIsNone(self.cache.find(sources[1]['uri']))
+
+    @mock.patch('curtin.prefetch.LOG')
+    def test_failure_logged(self, m_log):
+        """A failed prefetch is logged and the next source fetched."""
+        sources = [self._image('a', b'a' * 10), self._image('b', b'b' * 10)]
+        fetch = self.cache.fetch
+        self.cache.fetch = mock.Mock(
+            side_effect=[IOError('failed'), fetch(sources[1]['uri'])])
+        prefetcher = prefetch.Prefetcher(self.cache, sources, 1000)
+        prefetcher.start()
+        prefetcher.wait(10)
+        self.assertEqual(1, m_log.warn.call_count)
+        self.assertEqual(1, len(prefetcher.fetched))
+
+# vi: ts=4 expandtab syntax=python
@@ -134,6 +134,15 @@ class TestReporter(CiTestCase):
         self.assertEqual(event_dict.get('description'), self.ev_desc)
         self.assertEqual(event_dict.get('event_type'), events.START_EVENT_TYPE)
 
+    @patch('curtin.reporter.events.report_event')
+    def test_report_progress_event(self, mock_report_event):
+        events.report_progress_event(self.ev_name, self.ev_desc)
+        event_dict = self._get_reported_event(mock_report_event).as_dict()
+        self.assertEqual(event_dict.get('name'), self.ev_name)
+        self.assertEqual(event_dict.get('description'), self.ev_desc)
+        self.assertEqual(event_dict.get('event_type'),
+                         events.PROGRESS_EVENT_TYPE)
+
     @patch('curtin.reporter.events.report_event')
     def test_report_finish_event(self, mock_report_event):
         events.report_finish_event(self.ev_name, self.ev_desc)
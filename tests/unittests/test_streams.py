@@ -0,0 +1,355 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import bz2
+import gzip
+import hashlib
+import io
+import mock
+from unittest import skipUnless
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # python2 without backports.lzma
+    lzma = None
+
+from curtin import streams
+from curtin import util
+
+from .helpers import CiTestCase
+
+skipUnlessZstd = skipUnless(streams.zstandard, "python zstandard missing")
+skipUnlessLz4 = skipUnless(streams.lz4_frame, "python lz4 missing")
+skipUnlessLzma = skipUnless(lzma, "python lzma missing")
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+class TestDetectCompression(CiTestCase):
+
+    def test_known_magics(self):
+        """detect_compression identifies gz and bz2 streams."""
+        data = b'curtin' * 100
+        self.assertEqual('gz', streams.detect_compression(gzip_bytes(data)))
+        self.assertEqual('bz2',
+                         streams.detect_compression(bz2.compress(data)))
+
+    @skipUnlessLzma
+    def test_xz_magic(self):
+        """detect_compression identifies xz streams."""
+        data = b'curtin' * 100
+        self.assertEqual('xz', streams.detect_compression(lzma.compress(data)))
+
+    def test_unknown_is_none(self):
+        """detect_compression returns None for uncompressed data."""
+        self.assertIsNone(streams.detect_compression(b'plain old data'))
+
+
+class TestDecompressChunks(CiTestCase):
+
+    def _chunked(self, data, size=7):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_decompress_small_chunks(self):
+        """decompress_chunks handles input split at arbitrary points."""
+        data = b'the quick brown fox\n' * 1000
+        blobs = [('gz', gzip_bytes(data)), ('bz2', bz2.compress(data))]
+        if lzma:
+            blobs.append(('xz', lzma.compress(data)))
+        for ctype, blob in blobs:
+            out = b''.join(
+                streams.decompress_chunks(self._chunked(blob), ctype))
+            self.assertEqual(data, out, "%s did not round trip" % ctype)
+
+    def test_concatenated_streams(self):
+        """decompress_chunks decompresses concatenated (pigz) members."""
+        blob = gzip_bytes(b'part1\n') + gzip_bytes(b'part2\n')
+        self.assertEqual(
+            b'part1\npart2\n',
+            b''.join(streams.decompress_chunks(self._chunked(blob), 'gz')))
+
+    def test_none_passes_through(self):
+        """decompress_chunks with ctype None returns the input."""
+        self.assertEqual(
+            b'abc', b''.join(streams.decompress_chunks([b'a', b'bc'], None)))
+
+    def test_unsupported_raises(self):
+        """decompress_chunks raises ValueError on unknown compression."""
+        with self.assertRaises(ValueError):
+            list(streams.decompress_chunks([b'abc'], 'rar'))
+
+
+def _chunked(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@skipUnlessZstd
+class TestZstdDecompress(CiTestCase):
+
+    def setUp(self):
+        super(TestZstdDecompress, self).setUp()
+        self.data = b''.join(b'%08d\n' % i for i in range(200000))
+        self.cctx = streams.zstandard.ZstdCompressor(write_checksum=True)
+
+    def test_multi_frame_parallel(self):
+        """Multiple zstd frames are decompressed in order in parallel."""
+        blob = b''.join(self.cctx.compress(self.data[i:i + 100000])
+                        for i in range(0, len(self.data), 100000))
+        # a skippable frame produces no output
+        blob += b'\x5a\x2a\x4d\x18\x03\x00\x00\x00abc'
+        units = list(streams.zstd_units(streams.ChunkBuffer([blob])))
+        self.assertEqual(18, len(units))
+        self.assertEqual(set(['unit']), set(kind for kind, _ in units))
+        self.assertEqual(
+            self.data,
+            b''.join(streams.decompress_chunks(_chunked(blob), 'zst',
+                                               workers=4)))
+
+    def test_large_frame_streamed(self):
+        """zstd frames larger than max_unit are streamed."""
+        blob = self.cctx.compress(self.data)
+        units = streams.zstd_units(streams.ChunkBuffer(_chunked(blob)),
+                                   max_unit=1024)
+        kind, parts = next(units)
+        self.assertEqual('stream', kind)
+        self.assertEqual(blob, b''.join(parts))
+        self.assertEqual([], list(units))
+
+    def test_single_worker_and_autodetect(self):
+        """decompressed_reader detects zstd and works with one worker."""
+        blob = self.cctx.compress(self.data)
+        with streams.decompressed_reader(io.BytesIO(blob),
+                                         workers=1) as reader:
+            self.assertEqual(self.data, reader.read())
+
+    def test_bad_magic_raises(self):
+        """A corrupt zstd stream raises ValueError."""
+        blob = self.cctx.compress(self.data) + b'garbage!'
+        with self.assertRaises(ValueError):
+            b''.join(streams.decompress_chunks([blob], 'zst', workers=2))
+
+
+@skipUnlessLz4
+class TestLz4Decompress(CiTestCase):
+
+    def setUp(self):
+        super(TestLz4Decompress, self).setUp()
+        self.data = b''.join(b'%08d\n' % i for i in range(200000))
+
+    def test_independent_blocks_parallel(self):
+        """Independent lz4 blocks are decompressed in parallel."""
+        lz4f = streams.lz4_frame
+        blob = lz4f.compress(self.data, block_size=lz4f.BLOCKSIZE_MAX64KB,
+                             block_linked=False, block_checksum=True,
+                             content_checksum=True)
+        units = list(streams.lz4_units(streams.ChunkBuffer([blob])))
+        self.assertEqual(28, len(units))
+        self.assertEqual(set(['unit']), set(kind for kind, _ in units))
+        self.assertEqual(
+            self.data,
+            b''.join(streams.decompress_chunks(_chunked(blob), 'lz4',
+                                               workers=4)))
+
+    def test_linked_blocks_streamed(self):
+        """lz4 frames with linked blocks are streamed."""
+        blob = streams.lz4_frame.compress(self.data, block_linked=True)
+        units = streams.lz4_units(streams.ChunkBuffer([blob]))
+        kind, parts = next(units)
+        self.assertEqual('stream', kind)
+        self.assertEqual(blob, b''.join(parts))
+        self.assertEqual([], list(units))
+        self.assertEqual(
+            self.data,
+            b''.join(streams.decompress_chunks([blob], 'lz4', workers=4)))
+
+
+class TestCommandChunks(CiTestCase):
+
+    def test_filter_through_command(self):
+        """command_chunks feeds stdin and yields stdout."""
+        self.assertEqual(
+            b'abcdef',
+            b''.join(streams.command_chunks(['cat'], [b'abc', b'def'])))
+
+    def test_command_failure_raises(self):
+        """command_chunks raises ProcessExecutionError on failure."""
+        with self.assertRaises(util.ProcessExecutionError):
+            list(streams.command_chunks(['sh', '-c', 'cat; exit 3'], [b'a']))
+
+    @mock.patch('curtin.streams.util.which')
+    def test_command_fallback(self, m_which):
+        """Without python modules, zstd uses pzstd with all workers."""
+        m_which.side_effect = lambda cmd: '/usr/bin/' + cmd
+        with mock.patch.dict(streams.DECOMPRESSORS, clear=True):
+            with mock.patch('curtin.streams.command_chunks') as m_cmd:
+                streams.decompress_chunks([b''], 'zst', workers=1)
+        m_cmd.assert_called_with(['pzstd', '-dc', '-p', '1'], [b''])
+
+
+class TestRandomChunks(CiTestCase):
+
+    def test_openssl_keystream(self):
+        """random_chunks yields full chunks that differ on every run."""
+        if not util.which('openssl'):
+            self.skipTest('openssl not installed')
+        chunks = streams.random_chunks(buflen=4096)
+        first = [next(chunks) for _ in range(3)]
+        chunks.close()
+        self.assertEqual([4096] * 3, [len(chunk) for chunk in first])
+        self.assertEqual(3, len(set(first)))
+        self.assertNotEqual(first[0], next(streams.random_chunks(4096)))
+
+    @mock.patch('curtin.streams.util.which')
+    def test_urandom_fallback(self, m_which):
+        """Without openssl random_chunks reads /dev/urandom."""
+        m_which.return_value = None
+        with mock.patch('curtin.streams.subprocess.Popen') as m_popen:
+            chunks = streams.random_chunks(buflen=16)
+            self.assertEqual(16, len(next(chunks)))
+            chunks.close()
+        self.assertEqual(0, m_popen.call_count)
+
+    @mock.patch('curtin.streams.RANDOM_COMMAND', ['sh', '-c', 'exit 3'])
+    def test_command_failure_raises(self):
+        """A random command stopping early raises ProcessExecutionError."""
+        with self.assertRaises(util.ProcessExecutionError):
+            next(streams.random_chunks(buflen=16))
+
+    def test_random_reader(self):
+        """random_reader reads requested sizes of random data."""
+        with streams.random_reader(buflen=1024, depth=2) as reader:
+            data = reader.read(5000)
+        self.assertEqual(5000, len(data))
+        self.assertNotEqual(b'\0' * 5000, data)
+
+
+class TestQueueReader(CiTestCase):
+
+    def test_read_sizes(self):
+        """QueueReader returns exactly the requested sizes."""
+        reader = streams.QueueReader(lambda: iter([b'abc', b'defg', b'h']))
+        with reader:
+            self.assertEqual(b'ab', reader.read(2))
+            self.assertEqual(b'cdef', reader.peek(4))
+            self.assertEqual(b'cdefgh', reader.read(10))
+            self.assertEqual(b'', reader.read(1))
+
+    def test_read_all(self):
+        """QueueReader.read() with no size returns everything."""
+        reader = streams.QueueReader(lambda: iter([b'abc', b'def']))
+        with reader:
+            self.assertEqual(b'a', reader.read(1))
+            self.assertEqual(b'bcdef', reader.read())
+
+    def test_producer_error_raised_in_reader(self):
+        """Exceptions raised by the producer are re-raised by read."""
+        def producer():
+            yield b'data'
+            raise IOError("network went away")
+
+        with streams.QueueReader(producer) as reader:
+            self.assertEqual(b'data', reader.read(4))
+            with self.assertRaises(IOError):
+                reader.read(4)
+
+    def test_close_before_consumed(self):
+        """Closing a reader stops a producer blocked on a full queue."""
+        def producer():
+            while True:
+                yield b'x' * 1024
+
+        reader = streams.QueueReader(producer, depth=1)
+        reader.read(1)
+        reader.close()
+        self.assertFalse(reader._thread.is_alive())
+
+
+class TestDecompressedReader(CiTestCase):
+
+    @skipUnlessLzma
+    def test_autodetect(self):
+        """decompressed_reader detects compression and decompresses."""
+        data = b'root filesystem content\n' * 10000
+        meter = streams.ProgressMeter(None, 'testing')
+        with streams.decompressed_reader(io.BytesIO(lzma.compress(data)),
+                                         buflen=100, meter=meter) as reader:
+            self.assertEqual(data, reader.read())
+        self.assertEqual(len(lzma.compress(data)), meter.count)
+
+    def test_corrupt_stream_raises(self):
+        """decompressed_reader surfaces decompression errors."""
+        blob = bytearray(gzip_bytes(b'x' * 10000))
+        blob[20:30] = b'\xff' * 10
+        with streams.decompressed_reader(io.BytesIO(bytes(blob))) as reader:
+            with self.assertRaises(zlib.error):
+                reader.read()
+
+
+class TestProgressMeter(CiTestCase):
+
+    @mock.patch('curtin.reporter.events.report_progress_event')
+    def test_finish_reports_rate(self, m_report):
+        """ProgressMeter.finish sends a progress event with a summary."""
+        meter = streams.ProgressMeter('my/stack', 'writing', total=4096)
+        list(meter([b'x' * 1024] * 4))
+        meter.finish()
+        self.assertEqual(4096, meter.count)
+        m_report.assert_called_once_with('my/stack', mock.ANY)
+        self.assertIn('writing: 4K of 4K', m_report.call_args[0][1])
+
+    @mock.patch('curtin.reporter.events.report_progress_event')
+    def test_no_name_no_report(self, m_report):
+        """ProgressMeter without a name only logs."""
+        meter = streams.ProgressMeter(None, 'writing', interval=0)
+        meter.update(10)
+        meter.finish()
+        self.assertEqual(0, m_report.call_count)
+
+
+class TestChecksum(CiTestCase):
+
+    data = b'image data' * 1000
+
+    def test_source_checksum(self):
+        """source_checksum prefers sha512 and normalizes the digest."""
+        self.assertIsNone(streams.source_checksum({'uri': 'a'}))
+        self.assertEqual(('sha256', 'ab'),
+                         streams.source_checksum({'sha256': ' AB '}))
+        self.assertEqual(('sha512', 'cd'),
+                         streams.source_checksum({'sha256': 'ab',
+                                                  'sha512': 'cd'}))
+
+    def test_reader_verifies_at_end(self):
+        """ChecksumReader checks the digest when the data ends."""
+        checksum = ('sha512', hashlib.sha512(self.data).hexdigest())
+        reader = streams.ChecksumReader(io.BytesIO(self.data), checksum)
+        self.assertEqual(self.data, b''.join(streams.read_chunks(reader, 7)))
+        self.assertTrue(reader.verified)
+
+    def test_reader_mismatch_raises(self):
+        """ChecksumReader raises ChecksumError on the last read."""
+        reader = streams.ChecksumReader(io.BytesIO(self.data),
+                                        ('sha256', '0' * 64), name='img')
+        reader.read(len(self.data))
+        with self.assertRaises(streams.ChecksumError) as ctx:
+            reader.read(10)
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(),
+                         ctx.exception.actual)
+        self.assertIn('img', str(ctx.exception))
+
+    def test_verify_file(self):
+        """verify_file raises ChecksumError unless the content matches."""
+        path = self.tmp_path('img')
+        util.write_file(path, self.data, omode='wb')
+        streams.verify_file(
+            path, ('sha256', hashlib.sha256(self.data).hexdigest()))
+        with self.assertRaises(streams.ChecksumError):
+            streams.verify_file(path, ('sha256', '0' * 64))
+
+# vi: ts=4 expandtab syntax=python
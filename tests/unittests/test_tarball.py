@@ -0,0 +1,132 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import hashlib
+import io
+import os
+import tarfile
+
+from curtin import streams
+from curtin import tarball
+from curtin import util
+
+from .helpers import CiTestCase
+
+
+def _add_file(tfile, name, content, **attrs):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    for key, val in attrs.items():
+        setattr(info, key, val)
+    tfile.addfile(info, io.BytesIO(content))
+
+
+class TestMemberXattrs(CiTestCase):
+
+    def test_xattrs_from_pax_headers(self):
+        """member_xattrs returns SCHILY.xattr pax headers as bytes."""
+        info = tarfile.TarInfo('foo')
+        info.pax_headers = {
+            'SCHILY.xattr.user.foo': 'bar',
+            'SCHILY.xattr.security.capability':
+                b'\x01\x00\x00\x02'.decode('utf-8', 'surrogateescape'),
+            'path': 'foo'}
+        self.assertEqual(
+            {'user.foo': b'bar', 'security.capability': b'\x01\x00\x00\x02'},
+            tarball.member_xattrs(info))
+
+
+class TestExtractStream(CiTestCase):
+
+    def setUp(self):
+        super(TestExtractStream, self).setUp()
+        self.target = self.tmp_path('target')
+
+    def _make_tarball(self, mode='w:gz'):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode=mode,
+                          format=tarfile.PAX_FORMAT) as tfile:
+            info = tarfile.TarInfo('etc')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tfile.addfile(info)
+            _add_file(tfile, 'etc/hostname', b'curtin\n', mode=0o644,
+                      pax_headers={'SCHILY.xattr.user.curtin': 'yes'})
+            _add_file(tfile, 'bin/sudo', b'#!/bin/sh\n', mode=0o4755,
+                      uid=1234, gid=5678)
+            info = tarfile.TarInfo('etc/hosts.link')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'etc/hostname'
+            tfile.addfile(info)
+            info = tarfile.TarInfo('etc/hostname.sym')
+            info.type = tarfile.SYMTYPE
+            info.linkname = 'hostname'
+            tfile.addfile(info)
+        buf.seek(0)
+        return buf
+
+    def test_extract_compressed_formats(self):
+        """extract_stream detects and extracts gz, bz2, xz and plain tar."""
+        for mode in ('w:gz', 'w:bz2', 'w:xz', 'w'):
+            target = self.tmp_dir()
+            tarball.extract_stream(self._make_tarball(mode), target)
+            with open(os.path.join(target, 'etc/hostname'), 'rb') as fp:
+                self.assertEqual(b'curtin\n', fp.read(), mode)
+
+    def test_checksum_covers_whole_stream(self):
+        """The stream is read past the archive, so checksums complete."""
+        data = self._make_tarball('w').getvalue() + b'\0' * 20000
+        checksum = ('sha256', hashlib.sha256(data).hexdigest())
+        reader = streams.ChecksumReader(io.BytesIO(data), checksum)
+        tarball.extract_stream(reader, self.target)
+        self.assertTrue(reader.verified)
+        with self.assertRaises(streams.ChecksumError):
+            tarball.extract_stream(
+                streams.ChecksumReader(io.BytesIO(data), ('sha256', '0')),
+                self.tmp_dir())
+
+    def test_extract_preserves_metadata(self):
+        """extract_stream keeps links, modes, numeric owners and xattrs."""
+        tarball.extract_stream(self._make_tarball(), self.target)
+        hostname = os.path.join(self.target, 'etc/hostname')
+        link = os.path.join(self.target, 'etc/hosts.link')
+        sudo = os.path.join(self.target, 'bin/sudo')
+        self.assertEqual(os.stat(hostname).st_ino, os.stat(link).st_ino)
+        self.assertEqual(
+            'hostname',
+            os.readlink(os.path.join(self.target, 'etc/hostname.sym')))
+        self.assertEqual(0o4755, os.stat(sudo).st_mode & 0o7777)
+        if os.geteuid() == 0:
+            self.assertEqual((1234, 5678),
+                             (os.stat(sudo).st_uid, os.stat(sudo).st_gid))
+        try:
+            value = os.getxattr(hostname, 'user.curtin')
+        except OSError:
+            self.skipTest("user xattrs not supported on %s" % self.target)
+        self.assertEqual(b'yes', value)
+
+    def test_extract_sparse_member(self):
+        """extract_stream restores GNU sparse members with holes."""
+        src = self.tmp_path('sparse.img')
+        with open(src, 'wb') as fp:
+            fp.write(b'start')
+            fp.seek(16 * 1024 * 1024)
+            fp.write(b'end')
+        tarfile_path = self.tmp_path('sparse.tar')
+        util.subp(['tar', '-C', os.path.dirname(src), '-Scf', tarfile_path,
+                   'sparse.img'])
+        with open(tarfile_path, 'rb') as fp:
+            buf = io.BytesIO(fp.read())
+        tarball.extract_stream(buf, self.target)
+        dest = os.path.join(self.target, 'sparse.img')
+        self.assertEqual(os.path.getsize(src), os.path.getsize(dest))
+        self.assertLess(os.stat(dest).st_blocks * 512, 1024 * 1024)
+        with open(dest, 'rb') as fp:
+            self.assertEqual(b'start', fp.read(5))
+
+    def test_truncated_stream_raises(self):
+        """extract_stream fails on a truncated tarball."""
+        data = self._make_tarball('w').getvalue()
+        with self.assertRaises(tarfile.ReadError):
+            tarball.extract_stream(io.BytesIO(data[:1500]), self.target)
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,129 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import mock
+import os
+import stat
+from unittest import skipUnless
+
+from curtin import streams
+from curtin import treecopy
+from curtin import util
+from .helpers import CiTestCase
+
+
+@skipUnless(treecopy.supported(), "tree copier needs python3")
+class TestCopyTree(CiTestCase):
+
+    def setUp(self):
+        super(TestCopyTree, self).setUp()
+        self.tmpd = self.tmp_dir()
+        self.source = self.tmp_path('source', self.tmpd)
+        self.target = self.tmp_path('target', self.tmpd)
+        os.makedirs(os.path.join(self.source, 'etc', 'sub'))
+        util.write_file(os.path.join(self.source, 'etc', 'hosts'),
+                        'hosts\n', mode=0o640)
+        util.write_file(os.path.join(self.source, 'etc', 'sub', 'big'),
+                        b'x' * 300000, omode='wb')
+        os.symlink('hosts', os.path.join(self.source, 'etc', 'link'))
+        os.link(os.path.join(self.source, 'etc', 'hosts'),
+                os.path.join(self.source, 'hosts.hard'))
+        os.mkfifo(os.path.join(self.source, 'fifo'))
+        os.chmod(os.path.join(self.source, 'etc', 'sub'), 0o750)
+        os.utime(os.path.join(self.source, 'etc'), (1000000, 1000000))
+
+    def src(self, *path):
+        return os.path.join(self.source, *path)
+
+    def dst(self, *path):
+        return os.path.join(self.target, *path)
+
+    def test_copies_tree(self):
+        """copy_tree copies files, symlinks, fifos and directories."""
+        treecopy.copy_tree(self.source, self.target)
+        self.assertEqual('hosts\n', util.load_file(self.dst('etc', 'hosts')))
+        self.assertEqual(b'x' * 300000,
+                         util.load_file(self.dst('etc', 'sub', 'big'),
+                                        decode=False))
+        self.assertEqual('hosts', os.readlink(self.dst('etc', 'link')))
+        self.assertTrue(stat.S_ISFIFO(os.lstat(self.dst('fifo')).st_mode))
+
+    def test_preserves_metadata(self):
+        """Modes and timestamps of files and directories are kept."""
+        treecopy.copy_tree(self.source, self.target)
+        for path in (('etc',), ('etc', 'hosts'), ('etc', 'sub')):
+            src, dst = os.lstat(self.src(*path)), os.lstat(self.dst(*path))
+            self.assertEqual(src.st_mode, dst.st_mode)
+            self.assertEqual(src.st_mtime_ns, dst.st_mtime_ns)
+
+    def test_preserves_hardlinks(self):
+        """Hardlinked files are linked in the target."""
+        treecopy.copy_tree(self.source, self.target)
+        self.assertEqual(os.stat(self.dst('etc', 'hosts')).st_ino,
+                         os.stat(self.dst('hosts.hard')).st_ino)
+
+    def test_preserves_holes(self):
+        """Holes in sparse files are not written."""
+        size = 8 * 1024 * 1024
+        with open(self.src('sparse'), 'wb') as fp:
+            fp.write(b'a')
+            fp.seek(size - 1)
+            fp.write(b'b')
+        meter = streams.ProgressMeter(None, 'copying')
+        treecopy.copy_tree(self.source, self.target, meter=meter)
+        with open(self.dst('sparse'), 'rb') as fp:
+            data = fp.read()
+        self.assertEqual(size, len(data))
+        self.assertEqual((b'a', b'b'), (data[:1], data[-1:]))
+        if os.stat(self.src('sparse')).st_blocks * 512 < size:
+            # the source filesystem kept the hole, so should the target
+            self.assertLess(os.stat(self.dst('sparse')).st_blocks * 512,
+                            size)
+            self.assertLess(meter.count, 300000 + size)
+
+    def test_replaces_existing_target(self):
+        """Existing files in the target are replaced."""
+        os.makedirs(self.dst('etc'))
+        util.write_file(self.dst('etc', 'hosts'), 'old contents, longer\n')
+        os.symlink('/nonexistent', self.dst('fifo'))
+        treecopy.copy_tree(self.source, self.target)
+        self.assertEqual('hosts\n', util.load_file(self.dst('etc', 'hosts')))
+        self.assertTrue(stat.S_ISFIFO(os.lstat(self.dst('fifo')).st_mode))
+
+    def test_copy_file_range_unsupported(self):
+        """Data is read and written when copy_file_range is unavailable."""
+        copier = treecopy.TreeCopier(self.source, self.target)
+        copier._copy_file_range = True
+        err = OSError(errno.EXDEV, 'cross device')
+        with mock.patch('curtin.treecopy._clone', return_value=False):
+            with mock.patch('curtin.treecopy.os.copy_file_range',
+                            create=True, side_effect=err) as m_copy:
+                copier.copy()
+        self.assertEqual(1, m_copy.call_count)
+        self.assertEqual(b'x' * 300000,
+                         util.load_file(self.dst('etc', 'sub', 'big'),
+                                        decode=False))
+
+    def test_copy_error_raised(self):
+        """Errors copying a file are raised from copy_tree."""
+        err = IOError(errno.EIO, 'io error')
+        with mock.patch('curtin.treecopy._clone', side_effect=err):
+            with self.assertRaises(IOError):
+                treecopy.copy_tree(self.source, self.target)
+
+
+class TestClone(CiTestCase):
+
+    @mock.patch('curtin.treecopy.fcntl.ioctl')
+    def test_clone(self, m_ioctl):
+        """_clone issues FICLONE on the target with the source fd."""
+        self.assertTrue(treecopy._clone(3, 4))
+        m_ioctl.assert_called_with(4, treecopy.FICLONE, 3)
+
+    @mock.patch('curtin.treecopy.fcntl.ioctl')
+    def test_clone_unsupported(self, m_ioctl):
+        """_clone returns False when the filesystems cannot share data."""
+        m_ioctl.side_effect = IOError(errno.EXDEV, 'cross device')
+        self.assertFalse(treecopy._clone(3, 4))
+
+# vi: ts=4 expandtab syntax=python
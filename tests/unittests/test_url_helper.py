@@ -1,14 +1,103 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import filecmp
+import hashlib
 import json
 import mock
+import os
+import re
+import threading
 
+try:
+    from http import server as http_server
+except ImportError:
+    # python2
+    import BaseHTTPServer as http_server  # pylint: disable=import-error
+
+from curtin import streams
 from curtin import url_helper
 
 from .helpers import CiTestCase
 
 
+class RangeRequestHandler(http_server.BaseHTTPRequestHandler):
+    """Serve server.content, honoring Range headers if server.ranges."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.content
+        rheader = self.headers.get('Range')
+        self.server.requests.append(rheader)
+        match = re.match(r'bytes=(\d+)-(\d*)$', rheader or '')
+        if_range = self.headers.get('If-Range')
+        if (not (self.server.ranges and match) or
+                (if_range and if_range != self.server.etag)):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            self.write_body(None, content)
+            return
+        first = int(match.group(1))
+        last = int(match.group(2) or len(content) - 1)
+        total = '*' if self.server.unknown_size else str(len(content))
+        if first >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(content))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        last = min(last, len(content) - 1)
+        body = content[first:last + 1]
+        self.send_response(206)
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%s' % (first, last, total))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+        self.write_body(first, body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+
+    def write_body(self, first, body):
+        if first in self.server.fail_once:
+            # send a truncated body and drop the connection
+            self.server.fail_once.remove(first)
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class RangeServerTestCase(CiTestCase):
+    """Run a local http server of self.content for the test."""
+
+    content = b''.join([b'%06d\n' % i for i in range(2000)])
+
+    def setUp(self):
+        super(RangeServerTestCase, self).setUp()
+        self.server = http_server.HTTPServer(('127.0.0.1', 0),
+                                             RangeRequestHandler)
+        self.server.content = self.content
+        self.server.ranges = True
+        self.server.requests = []
+        self.server.fail_once = set()
+        self.server.etag = '"1"'
+        self.server.unknown_size = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/image' % self.server.server_port
+        self.target = self.tmp_path('image', self.tmp_dir())
+
+
 class TestDownload(CiTestCase):
     def test_download_file_url(self):
         """Download a file to another file."""
@@ -26,6 +115,228 @@ class TestDownload(CiTestCase):
                         "Downloaded file differed from source file.")
 
 
+class TestContentRange(CiTestCase):
+
+    def test_content_range(self):
+        """content_range parses a Content-Range header."""
+        self.assertEqual((0, 9, 100), url_helper.content_range(
+            {'content-range': 'bytes 0-9/100'}))
+        self.assertEqual((5, 9, None), url_helper.content_range(
+            {'content-range': 'bytes 5-9/*'}))
+        self.assertIsNone(url_helper.content_range({}))
+
+
+class TestRangedDownload(RangeServerTestCase):
+
+    def load_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_download_in_ranges(self):
+        """download fetches large objects as concurrent ranges."""
+        hook = mock.Mock()
+        url_helper.download(self.url, self.target, reporthook=hook,
+                            workers=3, chunk_size=1000)
+        self.assertEqual(self.content, self.load_target())
+        ranges = sorted(self.server.requests,
+                        key=lambda r: int(r.split('=')[1].split('-')[0]))
+        self.assertEqual(
+            ['bytes=%d-%d' % (i, i + 999)
+             for i in range(0, len(self.content), 1000)], ranges)
+        hook.assert_called_with(mock.ANY, mock.ANY, len(self.content))
+
+    def test_no_range_support(self):
+        """download reads the whole object if the server ignores Range."""
+        self.server.ranges = False
+        url_helper.download(self.url, self.target, chunk_size=1000)
+        self.assertEqual(self.content, self.load_target())
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_unknown_size(self):
+        """Range replies without the object size are not used."""
+        self.server.unknown_size = True
+        url_helper.download(self.url, self.target, chunk_size=1000)
+        self.assertEqual(self.content, self.load_target())
+        self.assertEqual(['bytes=0-999', None], self.server.requests)
+
+    def test_single_worker(self):
+        """download does not send Range requests with a single worker."""
+        url_helper.download(self.url, self.target, workers=1)
+        self.assertEqual(self.content, self.load_target())
+        self.assertEqual([None], self.server.requests)
+
+    def test_small_object(self):
+        """Objects within one chunk are fetched with a single request."""
+        url_helper.download(self.url, self.target, chunk_size=1024 * 1024)
+        self.assertEqual(self.content, self.load_target())
+        self.assertEqual(['bytes=0-1048575'], self.server.requests)
+
+    def test_empty_object(self):
+        """download handles 416 replies for empty objects."""
+        self.server.content = b''
+        url_helper.download(self.url, self.target, chunk_size=1000)
+        self.assertEqual(b'', self.load_target())
+
+    def test_checksum_verified(self):
+        """Ranged and streamed downloads are verified against a checksum."""
+        checksum = ('sha256', hashlib.sha256(self.content).hexdigest())
+        with mock.patch('curtin.url_helper.streams.verify_file') as m_verify:
+            url_helper.download(self.url, self.target, chunk_size=1000,
+                                checksum=checksum)
+        self.assertEqual(0, m_verify.call_count)
+        self.assertEqual(self.content, self.load_target())
+        url_helper.download(self.url, self.target, workers=1,
+                            checksum=checksum)
+        self.assertEqual(self.content, self.load_target())
+
+    def test_checksum_mismatch_removes_download(self):
+        """A download not matching its checksum is removed."""
+        for workers in (1, 3):
+            with self.assertRaises(streams.ChecksumError):
+                url_helper.download(self.url, self.target, workers=workers,
+                                    chunk_size=1000, resume=True,
+                                    checksum=('sha256', '0' * 64))
+            self.assertFalse(os.path.exists(self.target))
+            self.assertFalse(os.path.exists(self.target + '.state'))
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_failed_chunk_retried(self, m_sleep):
+        """A failed chunk is resumed from the last byte received."""
+        self.server.fail_once.update([0, 5000])
+        url_helper.download(self.url, self.target, workers=3,
+                            chunk_size=1000)
+        self.assertEqual(self.content, self.load_target())
+        self.assertIn('bytes=500-999', self.server.requests)
+        self.assertIn('bytes=5500-5999', self.server.requests)
+        self.assertEqual(2, m_sleep.call_count)
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_retries_exhausted(self, m_sleep):
+        """download raises UrlError once the retries are used up."""
+        self.server.fail_once.add(3000)
+        with mock.patch('curtin.url_helper.DOWNLOAD_RETRIES', ()):
+            with self.assertRaises(url_helper.UrlError):
+                url_helper.download(self.url, self.target, workers=3,
+                                    chunk_size=1000)
+        self.assertTrue(os.path.exists(self.target))
+
+
+class TestResumableReader(RangeServerTestCase):
+
+    def read_all(self, reader):
+        data = b''
+        while True:
+            buf = reader.read(1000)
+            if not buf:
+                return data
+            data += buf
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_resume_after_failure(self, m_sleep):
+        """ResumableReader continues with a Range request after a failure."""
+        self.server.fail_once.add(None)
+        with url_helper.ResumableReader(self.url) as reader:
+            self.assertEqual(self.content, self.read_all(reader))
+        self.assertEqual(None, self.server.requests[0])
+        self.assertEqual(2, len(self.server.requests))
+        self.assertTrue(self.server.requests[1].startswith('bytes='))
+        self.assertEqual(1, m_sleep.call_count)
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_changed_object_not_resumed(self, m_sleep):
+        """ResumableReader does not resume when the object changed."""
+        self.server.fail_once.add(None)
+        with url_helper.ResumableReader(self.url, retries=[1]) as reader:
+            reader.read(1000)
+            self.server.etag = '"2"'
+            with self.assertRaises(url_helper.UrlError):
+                self.read_all(reader)
+
+
+class TestResumedDownload(RangeServerTestCase):
+
+    def load_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_resume_download(self, m_sleep):
+        """A resumed download only fetches the chunks not completed."""
+        self.server.fail_once.add(5000)
+        with mock.patch('curtin.url_helper.DOWNLOAD_RETRIES', ()):
+            with self.assertRaises(url_helper.UrlError):
+                url_helper.download(self.url, self.target, workers=2,
+                                    chunk_size=1000, resume=True)
+        with open(self.target + '.state') as fp:
+            done = json.load(fp)['done']
+        self.assertNotIn(5000, done)
+        self.assertIn(0, done)
+
+        self.server.requests = []
+        url_helper.download(self.url, self.target, workers=2,
+                            chunk_size=1000, resume=True)
+        self.assertEqual(self.content, self.load_target())
+        fetched = [int(r.split('=')[1].split('-')[0])
+                   for r in self.server.requests[1:]]
+        self.assertIn(5000, fetched)
+        self.assertEqual([], [start for start in fetched if start in done])
+        self.assertFalse(os.path.exists(self.target + '.state'))
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_resume_download_checksum(self, m_sleep):
+        """Chunks completed before a resume are included in the checksum."""
+        checksum = ('sha256', hashlib.sha256(self.content).hexdigest())
+        self.server.fail_once.add(5000)
+        with mock.patch('curtin.url_helper.DOWNLOAD_RETRIES', ()):
+            with self.assertRaises(url_helper.UrlError):
+                url_helper.download(self.url, self.target, workers=2,
+                                    chunk_size=1000, resume=True,
+                                    checksum=checksum)
+        url_helper.download(self.url, self.target, workers=2,
+                            chunk_size=1000, resume=True, checksum=checksum)
+        self.assertEqual(self.content, self.load_target())
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_resume_changed_object(self, m_sleep):
+        """A download of a changed object starts over."""
+        self.server.fail_once.add(5000)
+        with mock.patch('curtin.url_helper.DOWNLOAD_RETRIES', ()):
+            with self.assertRaises(url_helper.UrlError):
+                url_helper.download(self.url, self.target, workers=2,
+                                    chunk_size=1000, resume=True)
+        self.server.etag = '"2"'
+        self.server.content = self.content[::-1]
+        self.server.requests = []
+        url_helper.download(self.url, self.target, workers=2,
+                            chunk_size=1000, resume=True)
+        self.assertEqual(self.content[::-1], self.load_target())
+        self.assertEqual(len(range(0, len(self.content), 1000)),
+                         len(self.server.requests))
+
+
+class TestRangeDigest(CiTestCase):
+
+    def test_ranges_out_of_order(self):
+        """Ranges written ahead are read back once the gap is filled."""
+        content = os.urandom(10000)
+        path = self.tmp_path('download', self.tmp_dir())
+        checksum = ('sha512', hashlib.sha512(content).hexdigest())
+        with open(path, 'wb+') as fp:
+            fp.write(content)
+            fp.flush()
+            digest = url_helper._RangeDigest(fp.fileno(), checksum, path)
+            digest.add_done(8000, 10000)
+            digest.add(4000, 4000, content[4000:6000])
+            digest.add(0, 0, content[:3000])
+            self.assertEqual(3000, digest.offset)
+            digest.add(4000, 6000, content[6000:7000])
+            digest.add(0, 3000, content[3000:4000])
+            self.assertEqual(7000, digest.offset)
+            digest.add(4000, 7000, content[7000:8000])
+            self.assertEqual(10000, digest.offset)
+            digest.verify()
+
+
 class TestGetMaasVersion(CiTestCase):
     @mock.patch('curtin.url_helper.geturl')
     def test_get_maas_version(self, mock_get_url):
@@ -1097,4 +1097,19 @@ class TestParseDpkgVersion(CiTestCase):
             util.parse_dpkg_version(mver))
 
 
+class TestSanitizeSource(CiTestCase):
+
+    def test_zstd_and_lz4_types(self):
+        """sanitize_source recognizes zstd and lz4 source types."""
+        for stype in ('tzst', 'tlz4', 'dd-zst', 'dd-lz4'):
+            self.assertEqual(
+                {'type': stype, 'uri': 'http://host/image'},
+                util.sanitize_source(stype + ':http://host/image'))
+
+    def test_unknown_defaults_to_tgz(self):
+        """sanitize_source defaults to tgz for untyped sources."""
+        self.assertEqual(
+            {'type': 'tgz', 'uri': 'http://host/root.tar.zst'},
+            util.sanitize_source('http://host/root.tar.zst'))
+
 # vi: ts=4 expandtab syntax=python